@@ -3,6 +3,7 @@
 import asyncio
 from dataclasses import dataclass
 import logging
+import os
 import time
 from datetime import timedelta
 from typing import Any, NamedTuple
@@ -11,7 +12,12 @@ import homeassistant.helpers.config_validation as cv
 import homeassistant.helpers.device_registry as dr
 import homeassistant.helpers.entity_registry as er
 import voluptuous as vol
-from homeassistant.config_entries import ConfigEntry, ConfigEntryState
+from homeassistant.config_entries import (
+    SIGNAL_CONFIG_ENTRY_CHANGED,
+    ConfigEntry,
+    ConfigEntryChange,
+    ConfigEntryState,
+)
 from homeassistant.const import (
     CONF_CLIENT_ID,
     CONF_CLIENT_SECRET,
@@ -22,27 +28,63 @@ from homeassistant.const import (
     CONF_ID,
     CONF_PLATFORM,
     CONF_REGION,
+    EVENT_HOMEASSISTANT_CLOSE,
     EVENT_HOMEASSISTANT_STOP,
     SERVICE_RELOAD,
 )
-from homeassistant.core import Event, HomeAssistant, ServiceCall, callback
+from homeassistant.core import (
+    Event,
+    HomeAssistant,
+    ServiceCall,
+    ServiceResponse,
+    SupportsResponse,
+    callback,
+)
 from homeassistant.exceptions import HomeAssistantError
+from homeassistant.helpers.dispatcher import async_dispatcher_connect
 from homeassistant.helpers.event import async_track_time_interval
 
-from .coordinator import TuyaDevice, HassLocalTuyaData, TuyaCloudApi
+from .coordinator import (
+    CLOUD_STORAGE_KEY,
+    PRODUCTS_STORAGE_KEY,
+    QUIRKS_STORAGE_KEY,
+    PersistentData,
+    TuyaDevice,
+    HassLocalTuyaData,
+    TuyaCloudApi,
+    async_connect_devices,
+)
 from .config_flow import ENTRIES_VERSION
 from .const import (
     ATTR_UPDATED_AT,
+    CONF_CLOUD_MAX_REQUESTS,
+    CONF_CLOUD_REQUESTS_PER_SECOND,
     CONF_GATEWAY_ID,
+    CONF_IO_PROCESSES,
+    CONF_IO_THREAD,
     CONF_NODE_ID,
     CONF_NO_CLOUD,
     CONF_PRODUCT_KEY,
     CONF_USER_ID,
+    DATA_CLOUD_CACHE,
+    DATA_DEVICE_INDEX,
     DATA_DISCOVERY,
+    DATA_IO_THREAD,
+    DATA_SHARDS,
+    DATA_PRODUCTS,
+    DATA_QUIRKS,
     DOMAIN,
     PLATFORMS,
 )
 
+from .core.cloud_api import (
+    CLOUD_MAX_CONCURRENT_REQUESTS,
+    CLOUD_REQUESTS_PER_SECOND,
+    CloudCache,
+    CloudRequestScheduler,
+)
+from .core.pytuya.io_thread import TuyaIOThread
+from .core.pytuya.shard import TuyaShardPool
 from .discovery import TuyaDiscovery
 
 _LOGGER = logging.getLogger(__name__)
@@ -67,11 +109,22 @@ SERVICE_UPDATE_DPS_SCHEMA = vol.Schema(
     }
 )
 
+SERVICE_DUMP_TRACE = "dump_trace"
+SERVICE_DUMP_TRACE_SCHEMA = vol.Schema({vol.Required(CONF_DEVICE_ID): cv.string})
+
 
 async def async_setup(hass: HomeAssistant, config: dict):
     """Set up the LocalTuya integration component."""
     hass.data.setdefault(DOMAIN, {})
 
+    for data_key, storage_key in (
+        (DATA_QUIRKS, QUIRKS_STORAGE_KEY),
+        (DATA_PRODUCTS, PRODUCTS_STORAGE_KEY),
+        (DATA_CLOUD_CACHE, CLOUD_STORAGE_KEY),
+    ):
+        storage = hass.data[DOMAIN][data_key] = PersistentData(hass, storage_key)
+        await storage.async_load()
+
     current_entries = hass.config_entries.async_entries(DOMAIN)
     device_cache = {}
 
@@ -126,13 +179,36 @@ async def async_setup(hass: HomeAssistant, config: dict):
         except TimeoutError:
             pass
 
+    async def _handle_dump_trace(event: ServiceCall) -> ServiceResponse:
+        """Handle dump_trace service call - writes the device frames trace to a file."""
+        dev_id = event.data[CONF_DEVICE_ID]
+        entry: ConfigEntry = async_config_entry_by_device_id(hass, dev_id)
+        if not entry or not entry.entry_id:
+            raise HomeAssistantError("unknown device id")
+
+        if (device := async_get_tuya_device(hass, entry, dev_id)) is None:
+            raise HomeAssistantError("device is not set up")
+        trace = await device.async_dump_trace()
+
+        path = hass.config.path(DOMAIN, f"trace_{dev_id}_{int(time.time())}.bin")
+
+        def _write_trace():
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as file:
+                file.write(trace)
+
+        await hass.async_add_executor_job(_write_trace)
+        _LOGGER.info("Frames trace of %s written to %s", dev_id, path)
+        return {"path": path, "size": len(trace)}
+
     def _device_discovered(device: dict):
         """Update address of device if it has changed."""
         device_ip = device["ip"]
         device_id = device["gwId"]
         product_key = device["productKey"]
         # If device is not in cache, check if a config entry exists
-        entry: ConfigEntry = async_config_entry_by_device_id(hass, device_id)
+        device_index = async_get_device_index(hass)
+        entry: ConfigEntry = device_index.entry(device_id)
 
         if entry is None:
             return
@@ -148,14 +224,10 @@ async def async_setup(hass: HomeAssistant, config: dict):
                 host_ip = entry.data[CONF_DEVICES][device_id][CONF_HOST]
                 device_cache[device_id] = {device_id: host_ip}
 
-        for subdev_id, dev_config in entry.data[CONF_DEVICES].items():
-            if dev_config.get(CONF_NODE_ID):
-                if gateway_id := dev_config.get(CONF_GATEWAY_ID):
-                    if entry and device_id == gateway_id:
-                        device_cache[device_id] = device_cache.get(device_id, {})
-                        device_cache[device_id].update(
-                            {subdev_id: dev_config.get(CONF_HOST)}
-                        )
+        for subdev_id in device_index.sub_devices(device_id):
+            dev_config = entry.data[CONF_DEVICES][subdev_id]
+            device_cache[device_id] = device_cache.get(device_id, {})
+            device_cache[device_id].update({subdev_id: dev_config.get(CONF_HOST)})
 
         if device_id not in device_cache:
             return
@@ -207,6 +279,14 @@ async def async_setup(hass: HomeAssistant, config: dict):
         schema=SERVICE_UPDATE_DPS_SCHEMA,
     )
 
+    hass.services.async_register(
+        DOMAIN,
+        SERVICE_DUMP_TRACE,
+        _handle_dump_trace,
+        schema=SERVICE_DUMP_TRACE_SCHEMA,
+        supports_response=SupportsResponse.OPTIONAL,
+    )
+
     discovery = TuyaDiscovery(_device_discovered)
     try:
         await discovery.start()
@@ -341,8 +421,20 @@ async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry):
     client_id = entry.data[CONF_CLIENT_ID]
     secret = entry.data[CONF_CLIENT_SECRET]
     user_id = entry.data[CONF_USER_ID]
-    tuya_api = TuyaCloudApi(region, client_id, secret, user_id)
     no_cloud = entry.data.get(CONF_NO_CLOUD, True)
+    cache = None
+    if not no_cloud:
+        # The cloud metadata is kept by account, across restarts.
+        storage: PersistentData = hass.data[DOMAIN][DATA_CLOUD_CACHE]
+        cache_data = storage.get(f"{region}_{user_id}")
+        cache = CloudCache(cache_data, storage.async_schedule_save)
+    scheduler = CloudRequestScheduler(
+        entry.data.get(CONF_CLOUD_MAX_REQUESTS, CLOUD_MAX_CONCURRENT_REQUESTS),
+        entry.data.get(CONF_CLOUD_REQUESTS_PER_SECOND, CLOUD_REQUESTS_PER_SECOND),
+    )
+    tuya_api = TuyaCloudApi(
+        region, client_id, secret, user_id, scheduler=scheduler, cache=cache
+    )
 
     if no_cloud:
         _LOGGER.info(f"Cloud API account not configured.")
@@ -351,6 +443,11 @@ async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry):
             hass, tuya_api.async_connect(), "localtuya-cloudAPI"
         )
 
+    if processes := entry.data.get(CONF_IO_PROCESSES):
+        async_get_shard_pool(hass, processes)
+    elif entry.data.get(CONF_IO_THREAD):
+        async_get_io_thread(hass)
+
     hass_localtuya = HassLocalTuyaData(tuya_api, {})
     hass.data[DOMAIN][entry.entry_id] = hass_localtuya
 
@@ -397,15 +494,17 @@ async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry):
 
     # Note: entry.async_on_unload items are called in LIFO order!
 
+    entry.async_create_task(hass, async_connect_devices(hass, connect_to_devices))
     for dev in connect_to_devices:
-        entry.async_create_task(hass, dev.async_connect())
         entry.async_on_unload(dev.close)
 
     entry.async_on_unload(entry.add_update_listener(update_listener))
+    entry.async_on_unload(tuya_api.async_close)
 
     async def _shutdown(event):
         """Clean up resources when shutting down."""
         await asyncio.gather(*[dev.close() for dev in connect_to_devices])
+        await tuya_api.async_close()
         _LOGGER.info(f"{entry.title}: Shutdown completed")
 
     entry.async_on_unload(
@@ -535,18 +634,117 @@ def _device_id_by_identifiers(identifiers: set[tuple[str, str]]):
     return list(identifiers)[0][1].split("_")[-1]
 
 
+@callback
+def async_get_io_thread(hass: HomeAssistant) -> TuyaIOThread:
+    """Return the I/O thread shared by the entries, start it on first use."""
+    if (io_thread := hass.data[DOMAIN].get(DATA_IO_THREAD)) is None:
+        io_thread = hass.data[DOMAIN][DATA_IO_THREAD] = TuyaIOThread()
+        io_thread.start()
+
+        @callback
+        def _stop(event):
+            io_thread.stop()
+
+        # Devices are closed on stop, the thread goes once they are all closed.
+        hass.bus.async_listen_once(EVENT_HOMEASSISTANT_CLOSE, _stop)
+
+    return io_thread
+
+
+@callback
+def async_get_shard_pool(hass: HomeAssistant, processes: int) -> TuyaShardPool:
+    """Return the shard processes shared by the entries, start them on first use."""
+    if (pool := hass.data[DOMAIN].get(DATA_SHARDS)) is None:
+        pool = hass.data[DOMAIN][DATA_SHARDS] = TuyaShardPool(processes)
+        pool.start()
+
+        @callback
+        def _stop(event):
+            pool.stop()
+
+        hass.bus.async_listen_once(EVENT_HOMEASSISTANT_CLOSE, _stop)
+    elif len(pool.shards) != processes:
+        _LOGGER.warning(
+            "Using %s worker processes, restart Home Assistant to apply %s",
+            len(pool.shards),
+            processes,
+        )
+
+    return pool
+
+
+class DeviceEntryIndex:
+    """Config entry of every device id and gateway id, rebuilt once entries change."""
+
+    def __init__(self, hass: HomeAssistant):
+        """Initialize a new DeviceEntryIndex."""
+        self._hass = hass
+        self._entries: dict[str, str] | None = None
+        self._sub_devices: dict[str, list[str]] = {}
+
+    @callback
+    def async_invalidate(self):
+        self._entries = None
+
+    def _build(self):
+        entries, sub_devices = {}, {}
+        # The first entry holding a device, or its gateway, owns it.
+        for entry in self._hass.config_entries.async_entries(DOMAIN):
+            for dev_id, dev_conf in entry.data[CONF_DEVICES].items():
+                entries.setdefault(dev_id, entry.entry_id)
+                if gw_id := dev_conf.get(CONF_GATEWAY_ID):
+                    entries.setdefault(gw_id, entry.entry_id)
+                    if dev_conf.get(CONF_NODE_ID) and entries[gw_id] == entry.entry_id:
+                        sub_devices.setdefault(gw_id, []).append(dev_id)
+        self._entries, self._sub_devices = entries, sub_devices
+
+    def entry(self, device_id: str) -> ConfigEntry | None:
+        """Return the config entry of a device or a gateway."""
+        if self._entries is None:
+            self._build()
+        if (entry_id := self._entries.get(device_id)) is None:
+            return None
+        return self._hass.config_entries.async_get_entry(entry_id)
+
+    def sub_devices(self, gateway_id: str) -> list[str]:
+        """Return the sub-devices of a gateway, within the gateway entry."""
+        if self._entries is None:
+            self._build()
+        return self._sub_devices.get(gateway_id, [])
+
+
+@callback
+def async_get_device_index(hass: HomeAssistant) -> DeviceEntryIndex:
+    """Return the devices index, kept up to date with the config entries."""
+    if (index := hass.data[DOMAIN].get(DATA_DEVICE_INDEX)) is None:
+        index = hass.data[DOMAIN][DATA_DEVICE_INDEX] = DeviceEntryIndex(hass)
+
+        @callback
+        def _entry_changed(change: ConfigEntryChange, entry: ConfigEntry):
+            if entry.domain == DOMAIN:
+                index.async_invalidate()
+
+        async_dispatcher_connect(hass, SIGNAL_CONFIG_ENTRY_CHANGED, _entry_changed)
+
+    return index
+
+
 @callback
 def async_config_entry_by_device_id(hass: HomeAssistant, device_id: str):
     """Look up config entry by device id."""
-    current_entries = hass.config_entries.async_entries(DOMAIN)
-    for entry in current_entries:
-        if device_id in entry.data[CONF_DEVICES]:
-            return entry
-        # Search for gateway_id
-        for dev_conf in entry.data[CONF_DEVICES].values():
-            if (gw_id := dev_conf.get(CONF_GATEWAY_ID)) and gw_id == device_id:
-                return entry
-    return None
+    return async_get_device_index(hass).entry(device_id)
+
+
+@callback
+def async_get_tuya_device(
+    hass: HomeAssistant, entry: ConfigEntry, device_id: str
+) -> TuyaDevice | None:
+    """Look up the TuyaDevice of a device id, sub-devices included."""
+    config = entry.data[CONF_DEVICES][device_id]
+    host = config.get(CONF_HOST)
+    if node_id := config.get(CONF_NODE_ID):
+        host = f"{host}_{node_id}"
+    return hass.data[DOMAIN][entry.entry_id].devices.get(host)
 
 
 @callback
@@ -13,6 +13,7 @@ from typing import Any
 
 import homeassistant.helpers.config_validation as cv
 import homeassistant.helpers.entity_registry as er
+from homeassistant.helpers.aiohttp_client import async_get_clientsession
 from homeassistant.helpers.selector import (
     SelectSelector,
     SelectSelectorConfig,
@@ -42,9 +43,9 @@ from homeassistant.const import (
     EntityCategory,
 )
 
-from .coordinator import HassLocalTuyaData
+from .coordinator import HassLocalTuyaData, PersistentData
 from .core import pytuya
-from .core.cloud_api import TUYA_ENDPOINTS, TuyaCloudApi
+from .core.cloud_api import CLOUD_CONNECTIONS_PER_HOST, TUYA_ENDPOINTS, TuyaCloudApi
 from .core.helpers import templates, get_gateway_by_deviceid, gen_localtuya_entities
 from .const import (
     ATTR_UPDATED_AT,
@@ -59,6 +60,10 @@ from .const import (
     CONF_MANUAL_DPS,
     CONF_MODEL,
     CONF_NODE_ID,
+    CONF_IO_PROCESSES,
+    CONF_CLOUD_MAX_REQUESTS,
+    CONF_CLOUD_REQUESTS_PER_SECOND,
+    CONF_IO_THREAD,
     CONF_NO_CLOUD,
     CONF_PRODUCT_KEY,
     CONF_PRODUCT_NAME,
@@ -69,17 +74,24 @@ from .const import (
     CONF_TUYA_VERSION,
     CONF_USER_ID,
     DATA_DISCOVERY,
+    DATA_PRODUCTS,
     DEFAULT_CATEGORIES,
     DOMAIN,
     ENTITY_CATEGORY,
     PLATFORMS,
     SUPPORTED_PROTOCOL_VERSIONS,
     CONF_DEVICE_SLEEP_TIME,
+    CONF_COMMANDS_DELAY,
+    CONF_WRITE_INTERVAL,
+    CONF_WRITE_BURST,
 )
 from .discovery import discover
 
 _LOGGER = logging.getLogger(__name__)
 
+# The progress of the cloud DPS query is logged every this many devices.
+CLOUD_PROGRESS_LOG_INTERVAL = 10
+
 ENTRIES_VERSION = 4
 
 PLATFORM_TO_ADD = "platform_to_add"
@@ -137,6 +149,16 @@ CLOUD_CONFIGURE_SCHEMA = vol.Schema(
         vol.Optional(CONF_USER_ID): cv.string,
         vol.Optional(CONF_USERNAME, default=DOMAIN): cv.string,
         vol.Required(CONF_NO_CLOUD, default=False): bool,
+        vol.Optional(CONF_IO_THREAD, default=False): bool,
+        vol.Optional(CONF_IO_PROCESSES, default=0): vol.All(
+            int, vol.Range(min=0, max=16)
+        ),
+        vol.Optional(CONF_CLOUD_MAX_REQUESTS): vol.All(
+            int, vol.Range(min=1, max=CLOUD_CONNECTIONS_PER_HOST)
+        ),
+        vol.Optional(CONF_CLOUD_REQUESTS_PER_SECOND): vol.All(
+            int, vol.Range(min=1, max=100)
+        ),
     }
 )
 
@@ -154,6 +176,9 @@ DEVICE_SCHEMA = vol.Schema(
         vol.Optional(CONF_MANUAL_DPS): cv.string,
         vol.Optional(CONF_RESET_DPIDS): str,
         vol.Optional(CONF_DEVICE_SLEEP_TIME): int,
+        vol.Optional(CONF_COMMANDS_DELAY): vol.All(int, vol.Range(min=0, max=1000)),
+        vol.Optional(CONF_WRITE_INTERVAL): vol.All(int, vol.Range(min=10, max=500)),
+        vol.Optional(CONF_WRITE_BURST): vol.All(int, vol.Range(min=1, max=20)),
         vol.Optional(CONF_NODE_ID, default=None): vol.Any(None, cv.string),
     }
 )
@@ -167,6 +192,10 @@ CONF_MASS_CONFIGURE = "mass_configure"
 MASS_CONFIGURE_SCHEMA = {vol.Optional(CONF_MASS_CONFIGURE, default=False): bool}
 CUSTOM_DEVICE = {"Add Device Manually": "..."}
 
+# Seconds to connect and detect DPS, and to try the discovered version alone.
+PROBE_TIMEOUT = 5
+PROBE_HEAD_START = 1
+
 
 class LocaltuyaConfigFlow(ConfigFlow, domain=DOMAIN):
     """Handle a config flow for LocalTuya integration."""
@@ -192,7 +221,7 @@ class LocaltuyaConfigFlow(ConfigFlow, domain=DOMAIN):
                     user_input[i] = ""
                 return await self._create_entry(user_input)
 
-            cloud_api, res = await attempt_cloud_connection(user_input)
+            cloud_api, res = await attempt_cloud_connection(self.hass, user_input)
 
             if not res:
                 return await self._create_entry(user_input)
@@ -289,7 +318,7 @@ class LocalTuyaOptionsFlowHandler(OptionsFlow):
 
                 return self._update_entry(new_data, new_title=username)
 
-            cloud_api, res = await attempt_cloud_connection(user_input)
+            cloud_api, res = await attempt_cloud_connection(self.hass, user_input)
 
             if not res:
                 new_data = self.config_entry.data.copy()
@@ -328,7 +357,9 @@ class LocalTuyaOptionsFlowHandler(OptionsFlow):
 
             if user_input.pop(CONF_MASS_CONFIGURE, False):
                 # Handle auto configure all recognized devices.
-                await self.cloud_data.async_get_devices_dps_query()
+                await self.cloud_data.async_get_devices_dps_query(
+                    log_dps_query_progress
+                )
                 devices, fails = await setup_localtuya_devices(
                     self.hass,
                     self.localtuya_data,
@@ -517,7 +548,13 @@ class LocalTuyaOptionsFlowHandler(OptionsFlow):
                         ]
                         return await self.async_step_configure_entity()
 
-                valid_data = await validate_input(self.localtuya_data, user_input)
+                discovered = self.discovered_devices.get(user_input[CONF_DEVICE_ID], {})
+                valid_data = await validate_input(
+                    self.localtuya_data,
+                    self.device_data,
+                    discovered.get(CONF_TUYA_VERSION),
+                    self.hass.data[DOMAIN].get(DATA_PRODUCTS),
+                )
                 self.dps_strings = valid_data[CONF_DPS_STRINGS]
                 # We will also get protocol version from valid date in case auto used.
                 self.device_data[CONF_PROTOCOL_VERSION] = valid_data[
@@ -917,9 +954,24 @@ async def setup_localtuya_devices(
             # Store device to device_data.
             devices_cfg.append(device_data)
 
+    # Validate a device of each product first, so the others only confirm its DPS.
+    products = hass.data[DOMAIN].get(DATA_PRODUCTS)
+    first_devices, other_devices, product_keys = [], [], set()
+    for dev in devices_cfg:
+        product_key = dev.get(CONF_PRODUCT_KEY)
+        (other_devices if product_key in product_keys else first_devices).append(dev)
+        if product_key:
+            product_keys.add(product_key)
+    devices_cfg = first_devices + other_devices
+
     # Connect to the devices to ensure the are usable.
-    validate_devices = [validate_input(localtuya_data, dev) for dev in devices_cfg]
-    results = await asyncio.gather(*validate_devices, return_exceptions=True)
+    results = []
+    for devices_group in (first_devices, other_devices):
+        validate_devices = [
+            validate_input(localtuya_data, dev, products=products)
+            for dev in devices_group
+        ]
+        results += await asyncio.gather(*validate_devices, return_exceptions=True)
 
     # Merge test results with devices config
     for dev_cfg, result in zip(devices_cfg, results):
@@ -1055,6 +1107,9 @@ def options_schema(entities):
             vol.Optional(CONF_MANUAL_DPS): cv.string,
             vol.Optional(CONF_RESET_DPIDS): cv.string,
             vol.Optional(CONF_DEVICE_SLEEP_TIME): int,
+            vol.Optional(CONF_COMMANDS_DELAY): vol.All(int, vol.Range(min=0, max=1000)),
+            vol.Optional(CONF_WRITE_INTERVAL): vol.All(int, vol.Range(min=10, max=500)),
+            vol.Optional(CONF_WRITE_BURST): vol.All(int, vol.Range(min=1, max=20)),
             vol.Required(
                 CONF_ENTITIES, description={"suggested_value": entity_names}
             ): cv.multi_select(entity_names),
@@ -1171,7 +1226,106 @@ def flow_schema(platform, dps_strings):
     return import_module("." + platform, integration_module).flow_schema(dps_strings)
 
 
-async def validate_input(entry_runtime: HassLocalTuyaData, data):
+async def detect_dps(interface: pytuya.TuyaProtocol, cid=None, product: dict = None):
+    """Return the device DPS, devices of a known product confirm them with one query."""
+    if product and product.get("version") == interface.version:
+        dps, dev_type = product["dps"], product.get("dev_type")
+        if detected_dps := await interface.confirm_dps(dps, dev_type, cid=cid):
+            return detected_dps
+
+    return await interface.detect_available_dps(cid=cid)
+
+
+async def probe_protocol_versions(
+    logger, data, versions: list[str], cid=None, product: dict = None
+):
+    """Connect to the device with the first protocol version that detects its DPS.
+
+    The first version gets a head start, then the others are tried in parallel and
+    cancelled once a version detected the DPS. Return the connected interface,
+    its version and the detected DPS; a connected interface without DPS is returned
+    when no version detected any.
+    """
+
+    async def _connect(version):
+        logger.info(f"Connecting with protocol version: {version}")
+        interface = None
+        try:
+            async with asyncio.timeout(PROBE_TIMEOUT):
+                interface = await pytuya.connect(
+                    data[CONF_HOST],
+                    data[CONF_DEVICE_ID],
+                    data[CONF_LOCAL_KEY],
+                    float(version),
+                    data[CONF_ENABLE_DEBUG],
+                )
+                logger.info(f"Connected attempt to detect the device DPS")
+                return interface, await detect_dps(interface, cid, product)
+        except BaseException:
+            if interface:
+                await interface.close()
+            raise
+
+    first = asyncio.create_task(_connect(versions[0]))
+    tasks = {first: versions[0]}
+    waiting = versions[1:]
+    pending = set(tasks)
+    found, connected, result = None, [], None
+    try:
+        while pending and found is None:
+            head_start = PROBE_HEAD_START if waiting else None
+            done, pending = await asyncio.wait(
+                pending, timeout=head_start, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                try:
+                    interface, dps = task.result()
+                # The device drops or ignores the requests of other versions, the
+                # dropped connection cancels the pending requests.
+                except (
+                    asyncio.CancelledError,
+                    ConnectionAbortedError,
+                    ConnectionResetError,
+                    TimeoutError,
+                ):
+                    continue
+                # Wrong address or local key, no version will do better. The parallel
+                # attempts may be refused by devices taking a single connection.
+                except (OSError, ValueError):
+                    if task is first:
+                        raise
+                    continue
+                except Exception:  # pylint: disable=broad-except
+                    continue
+                connected.append((interface, tasks[task], dps))
+                if dps and found is None:
+                    found = connected[-1]
+
+            if found is None and waiting:
+                # The head start is over or the first guess failed, probe the others.
+                for version in waiting:
+                    tasks[asyncio.create_task(_connect(version))] = version
+                pending.update(task for task in tasks if not task.done())
+                waiting = []
+
+        # Fallback on a connected version even without DPS, the caller will retry.
+        result = found or (connected[0] if connected else (None, None, {}))
+        return result
+    finally:
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        for interface, _, _ in connected:
+            if result is None or interface is not result[0]:
+                await interface.close()
+
+
+async def validate_input(
+    entry_runtime: HassLocalTuyaData,
+    data,
+    discovered_version: str = None,
+    products: PersistentData = None,
+):
     """Validate the user input allows us to connect."""
     logger = pytuya.ContextualLogger()
     logger.set_logger(_LOGGER, data[CONF_DEVICE_ID], True, data[CONF_FRIENDLY_NAME])
@@ -1186,6 +1340,10 @@ async def validate_input(entry_runtime: HassLocalTuyaData, data):
 
     cid = data.get(CONF_NODE_ID, None)
     localtuya_devices = entry_runtime.devices
+    # DPS detected on a device are reused for the devices of the same product.
+    product = None
+    if products is not None and not cid and (product_key := data.get(CONF_PRODUCT_KEY)):
+        product = products.get(product_key)
     try:
         conf_protocol = data[CONF_PROTOCOL_VERSION]
         auto_protocol = conf_protocol == "auto"
@@ -1198,51 +1356,53 @@ async def validate_input(entry_runtime: HassLocalTuyaData, data):
         ):
             interface = existed_interface._interface
             close = False
+        elif auto_protocol:
+            # Start with the version advertised by the device then probe the others.
+            versions = sorted(
+                SUPPORTED_PROTOCOL_VERSIONS, key=lambda ver: ver != discovered_version
+            )
+            try:
+                interface, version, detected_dps = await probe_protocol_versions(
+                    logger, data, versions, cid, product
+                )
+                # If Auto: using DPS detected we will assume this is the correct version if dps found.
+                if len(detected_dps) > 0:
+                    # Set the conf_protocol to the worked version to return it and update self.device_data.
+                    logger.info(f"Detected DPS: {detected_dps}")
+                    conf_protocol = version
+            except (OSError, ValueError) as ex:
+                logger.error(f"Connection failed! {ex}")
+                error = ex
+            finally:
+                if not error and not interface:
+                    error = InvalidAuth
         else:
-            # If 'auto' will be loop through supported protocols.
-            for ver in SUPPORTED_PROTOCOL_VERSIONS:
-                try:
-                    version = ver if auto_protocol else conf_protocol
-                    logger.info(f"Connecting with protocol version: {version}")
-                    async with asyncio.timeout(5):
-                        interface = await pytuya.connect(
-                            data[CONF_HOST],
-                            data[CONF_DEVICE_ID],
-                            data[CONF_LOCAL_KEY],
-                            float(version),
-                            data[CONF_ENABLE_DEBUG],
-                        )
-                        logger.info(f"Connected attempt to detect the device DPS")
-                        detected_dps = await interface.detect_available_dps(cid=cid)
-
-                    # Break the loop if input isn't auto.
-                    if not auto_protocol:
-                        break
-
-                    # If Auto: using DPS detected we will assume this is the correct version if dps found.
-                    if len(detected_dps) > 0:
-                        # Set the conf_protocol to the worked version to return it and update self.device_data.
-                        logger.info(f"Detected DPS: {detected_dps}")
-                        conf_protocol = version
-                        break
-
-                # If connection to host is failed raise wrong address.
-                except ConnectionAbortedError:
-                    # Protocol mismatch (e.g. v3.4 negotiation against v3.5 device);
-                    # keep trying other versions.
-                    continue
-                except (OSError, ValueError) as ex:
-                    logger.error(f"Connection failed! {ex}")
-                    error = ex
-                    break
-                except:
-                    continue
-                finally:
-                    if not auto_protocol and data.get(CONF_DEVICE_SLEEP_TIME, 0) > 0:
-                        logger.info("Low-power device configured — handshake skipped")
-                        bypass_connection = True
-                    if not error and not interface:
-                        error = InvalidAuth
+            try:
+                logger.info(f"Connecting with protocol version: {conf_protocol}")
+                async with asyncio.timeout(PROBE_TIMEOUT):
+                    interface = await pytuya.connect(
+                        data[CONF_HOST],
+                        data[CONF_DEVICE_ID],
+                        data[CONF_LOCAL_KEY],
+                        float(conf_protocol),
+                        data[CONF_ENABLE_DEBUG],
+                    )
+                    logger.info(f"Connected attempt to detect the device DPS")
+                    detected_dps = await detect_dps(interface, cid, product)
+            # If connection to host is failed raise wrong address.
+            except ConnectionAbortedError:
+                pass
+            except (OSError, ValueError) as ex:
+                logger.error(f"Connection failed! {ex}")
+                error = ex
+            except:
+                pass
+            finally:
+                if data.get(CONF_DEVICE_SLEEP_TIME, 0) > 0:
+                    logger.info("Low-power device configured — handshake skipped")
+                    bypass_connection = True
+                if not error and not interface:
+                    error = InvalidAuth
 
         if conf_reset_dpids := data.get(CONF_RESET_DPIDS):
             reset_ids_str = conf_reset_dpids.split(",")
@@ -1260,7 +1420,7 @@ async def validate_input(entry_runtime: HassLocalTuyaData, data):
 
             # Detect any other non-manual DPS strings
             if not detected_dps:
-                detected_dps = await interface.detect_available_dps(cid=cid)
+                detected_dps = await detect_dps(interface, cid, product)
 
         except (ValueError, pytuya.parser.DecodeError) as ex:
             error = ex
@@ -1272,6 +1432,13 @@ async def validate_input(entry_runtime: HassLocalTuyaData, data):
         # detected_dps_device used to prevent user from bypass handshake manual dps.
         detected_dps_device = detected_dps.copy()
         logger.debug("Detected DPS: %s", detected_dps)
+        if product is not None and detected_dps_device and interface:
+            product.update(
+                version=interface.version,
+                dps=sorted(detected_dps_device),
+                dev_type=interface.dev_type,
+            )
+            products.async_schedule_save()
         if CONF_MANUAL_DPS in data:
             manual_dps_list = [dps.strip() for dps in data[CONF_MANUAL_DPS].split(",")]
             logger.debug(
@@ -1320,13 +1487,21 @@ async def validate_input(entry_runtime: HassLocalTuyaData, data):
     }
 
 
-async def attempt_cloud_connection(user_input):
+def log_dps_query_progress(done: int, total: int):
+    """Log the progress of the cloud DPS query of the devices, every few devices."""
+    if done % CLOUD_PROGRESS_LOG_INTERVAL == 0 or done == total:
+        _LOGGER.debug("Fetched the cloud DPS of %s/%s devices", done, total)
+
+
+async def attempt_cloud_connection(hass: HomeAssistant, user_input):
     """Create device."""
+    # The flow API is short-lived, it uses the shared session of Home Assistant.
     cloud_api = TuyaCloudApi(
         user_input.get(CONF_REGION),
         user_input.get(CONF_CLIENT_ID),
         user_input.get(CONF_CLIENT_SECRET),
         user_input.get(CONF_USER_ID),
+        async_get_clientsession(hass),
     )
 
     msg, res = await cloud_api.async_connect()
@@ -15,6 +15,12 @@ from homeassistant.const import (
 
 DOMAIN = "localtuya"
 DATA_DISCOVERY = "discovery"
+DATA_QUIRKS = "quirks"
+DATA_PRODUCTS = "products"
+DATA_IO_THREAD = "io_thread"
+DATA_SHARDS = "shards"
+DATA_DEVICE_INDEX = "device_index"
+DATA_CLOUD_CACHE = "cloud_cache"
 
 # Order on priority
 SUPPORTED_PROTOCOL_VERSIONS = ["3.3", "3.1", "3.2", "3.4", "3.5"]
@@ -73,11 +79,24 @@ CONF_ADD_DEVICE = "add_device"
 CONF_EDIT_DEVICE = "edit_device"
 CONF_CONFIGURE_CLOUD = "configure_cloud"
 CONF_NO_CLOUD = "no_cloud"
+CONF_IO_THREAD = "io_thread"
+CONF_IO_PROCESSES = "io_processes"
+CONF_CLOUD_MAX_REQUESTS = "cloud_max_requests"
+CONF_CLOUD_REQUESTS_PER_SECOND = "cloud_requests_per_second"
 CONF_MANUAL_DPS = "manual_dps_strings"
 CONF_DEFAULT_VALUE = "dps_default_value"
 CONF_RESET_DPIDS = "reset_dpids"
 CONF_PASSIVE_ENTITY = "is_passive_entity"
 CONF_DEVICE_SLEEP_TIME = "device_sleep_time"
+CONF_COMMANDS_DELAY = "commands_delay"
+CONF_WRITE_INTERVAL = "write_interval"
+CONF_WRITE_BURST = "write_burst"
+
+# Commands sent to a device within this time (ms) are combined into one payload.
+DEFAULT_COMMANDS_DELAY = 10
+# Initial gap (ms) between the frames written to a device, and the frames sent back to back.
+DEFAULT_WRITE_INTERVAL = 50
+DEFAULT_WRITE_BURST = 4
 
 # ALARM
 CONF_ALARM_SUPPORTED_STATES = "alarm_supported_states"
@@ -283,6 +302,15 @@ class DeviceConfig:
         self.entities: list = self.device_config[CONF_ENTITIES]
         self.protocol_version: str = self.device_config[CONF_PROTOCOL_VERSION]
         self.sleep_time: int = self.device_config.get(CONF_DEVICE_SLEEP_TIME, 0)
+        self.commands_delay: int = self.device_config.get(
+            CONF_COMMANDS_DELAY, DEFAULT_COMMANDS_DELAY
+        )
+        self.write_interval: int = self.device_config.get(
+            CONF_WRITE_INTERVAL, DEFAULT_WRITE_INTERVAL
+        )
+        self.write_burst: int = self.device_config.get(
+            CONF_WRITE_BURST, DEFAULT_WRITE_BURST
+        )
         self.scan_interval: int = self.device_config.get(CONF_SCAN_INTERVAL, 0)
         self.enable_debug: bool = self.device_config.get(CONF_ENABLE_DEBUG, False)
         self.name: str = self.device_config.get(CONF_FRIENDLY_NAME)
@@ -6,17 +6,17 @@ import errno
 import logging
 import time
 from datetime import timedelta
-from typing import Any, NamedTuple
+from types import MappingProxyType
+from typing import Any, Callable, Mapping, NamedTuple
 
 
 from homeassistant.core import HomeAssistant, CALLBACK_TYPE, callback, State
 from homeassistant.config_entries import ConfigEntry
 from homeassistant.const import CONF_ID, CONF_DEVICES, CONF_HOST, CONF_DEVICE_ID
+from homeassistant.exceptions import HomeAssistantError
 from homeassistant.helpers.event import async_track_time_interval, async_call_later
-from homeassistant.helpers.dispatcher import (
-    async_dispatcher_connect,
-    dispatcher_send,
-)
+from homeassistant.helpers.storage import Store
+from homeassistant.helpers.dispatcher import async_dispatcher_connect
 
 from .core.cloud_api import TuyaCloudApi
 from .core.pytuya import (
@@ -26,18 +26,27 @@ from .core.pytuya import (
     SubdeviceState,
     TuyaListener,
     TuyaProtocol,
+    WritePacer,
     connect as pytuya_connect,
 )
+from .core.pytuya.io_thread import TuyaIOThread
 from .core.pytuya.parser import DecodeError
+from .core.pytuya.shard import TuyaShardPool
+from .core.pytuya.trace import FrameTrace
 
 from .const import (
     ATTR_UPDATED_AT,
     CONF_GATEWAY_ID,
     CONF_LOCAL_KEY,
     CONF_NODE_ID,
+    CONF_IO_PROCESSES,
+    CONF_IO_THREAD,
     CONF_NO_CLOUD,
     CONF_TUYA_IP,
     DATA_DISCOVERY,
+    DATA_IO_THREAD,
+    DATA_SHARDS,
+    DATA_QUIRKS,
     DOMAIN,
     DeviceConfig,
     RESTORE_STATES,
@@ -47,6 +56,14 @@ _LOGGER = logging.getLogger(__name__)
 RECONNECT_INTERVAL = timedelta(seconds=5)
 # Subdevice: Offline events before disconnecting the device, around 5 minutes
 MIN_OFFLINE_EVENTS = 5 * 60 // HEARTBEAT_INTERVAL
+# Startup: maximum number of devices connecting at the same time.
+STARTUP_CONNECT_LIMIT = 10
+
+STORAGE_VERSION = 1
+STORAGE_SAVE_DELAY = 10
+QUIRKS_STORAGE_KEY = "localtuya_quirks"
+PRODUCTS_STORAGE_KEY = "localtuya_products"
+CLOUD_STORAGE_KEY = "localtuya_cloud"
 
 
 class HassLocalTuyaData(NamedTuple):
@@ -56,6 +73,31 @@ class HassLocalTuyaData(NamedTuple):
     devices: dict[str, TuyaDevice]
 
 
+class PersistentData:
+    """Data learned about devices or products, kept across reconnects and restarts."""
+
+    def __init__(self, hass: HomeAssistant, storage_key: str):
+        """Initialize the storage."""
+        self._store = Store(hass, STORAGE_VERSION, storage_key)
+        self._data: dict[str, dict] = {}
+
+    async def async_load(self):
+        """Load the data from storage."""
+        self._data.update(await self._store.async_load() or {})
+
+    def get(self, key: str) -> dict:
+        """Return the data dict of key, to be updated in place."""
+        return self._data.setdefault(key, {})
+
+    @callback
+    def async_schedule_save(self):
+        """Save the data once the burst of changes is over."""
+        self._store.async_delay_save(
+            lambda: {key: data for key, data in self._data.items() if data},
+            STORAGE_SAVE_DELAY,
+        )
+
+
 class TuyaDevice(TuyaListener, ContextualLogger):
     """Cache wrapper for pytuya.TuyaInterface."""
 
@@ -76,8 +118,27 @@ class TuyaDevice(TuyaListener, ContextualLogger):
         self.id = self._device_config.id
         self.local_key = self._device_config.local_key
 
+        # The DP state store of this device, entities read it through status_view.
         self._status = {}
+        self.status_view: Mapping[str, Any] = MappingProxyType(self._status)
+        # Bumped every time a DP value changes.
+        self.status_version = 0
         self._interface: TuyaProtocol = None
+        # Kept across reconnects, so the learned pacing survives connection drops.
+        self._write_pacer = WritePacer(
+            interval=self._device_config.write_interval / 1000,
+            burst=self._device_config.write_burst,
+        )
+        # Frames sent and received by the device, across reconnects too.
+        self._frame_trace = FrameTrace()
+        # Connections run in the shard processes or on the I/O thread when enabled.
+        self._io_thread: TuyaShardPool | TuyaIOThread | None = None
+        if entry.data.get(CONF_IO_PROCESSES):
+            self._io_thread = hass.data[DOMAIN].get(DATA_SHARDS)
+        elif entry.data.get(CONF_IO_THREAD):
+            self._io_thread = hass.data[DOMAIN].get(DATA_IO_THREAD)
+        self._devices_quirks: PersistentData = hass.data[DOMAIN].get(DATA_QUIRKS)
+        self._quirks = self._devices_quirks.get(self.id) if self._devices_quirks else {}
 
         # For SubDevices
         self.gateway: TuyaDevice = None
@@ -89,12 +150,24 @@ class TuyaDevice(TuyaListener, ContextualLogger):
 
         # last_update_time: Sleep timer, a device that reports the status every x seconds then goes into sleep.
         self._last_update_time = time.monotonic() - 5
+        # Seconds between the setup of the device and its first reported status.
+        self._setup_time = time.monotonic()
+        self.time_to_first_state: float | None = None
         self._pending_status: dict[str, dict[str, Any]] = {}
+        # DP id -> handlers of the entities using it, None key for handlers of all DPs.
+        self._dps_subscribers: dict[str | None, list[Callable]] = {}
+        # DPs to be reported as changed on their next update even if the value is the same.
+        self._reset_dps: set[str] = set()
+        # The first status after connecting is dispatched to all entities.
+        self._dispatch_all = True
 
         self.is_closing = False
         self._task_connect: asyncio.Task | None = None
         self._task_reconnect: asyncio.Task | None = None
         self._task_shutdown_entities: asyncio.Task | None = None
+        self._task_set_status: asyncio.Task | None = None
+        # The set status task is sending its payload, new commands start a new one.
+        self._status_sending = False
         self._unsub_refresh: CALLBACK_TYPE | None = None
         self._unsub_new_entity: CALLBACK_TYPE | None = None
 
@@ -205,13 +278,19 @@ class TuyaDevice(TuyaListener, ContextualLogger):
                     if self._device_config.enable_debug:
                         self._interface.enable_debug(True, gateway.friendly_name)
                 else:
-                    self._interface = await pytuya_connect(
+                    connect = (
+                        self._io_thread.connect if self._io_thread else pytuya_connect
+                    )
+                    self._interface = await connect(
                         self._device_config.host,
                         self._device_config.id,
                         self.local_key,
                         float(self._device_config.protocol_version),
                         self._device_config.enable_debug,
                         self,
+                        pacer=self._write_pacer,
+                        trace=self._frame_trace,
+                        quirks=self._quirks,
                     )
                     self._interface.enable_debug(
                         self._device_config.enable_debug, self.friendly_name
@@ -342,6 +421,24 @@ class TuyaDevice(TuyaListener, ContextualLogger):
             await self._interface.close()
             self._interface = None
 
+    async def async_dump_trace(self) -> bytes:
+        """Return the frames trace file of the device connection."""
+        if self.is_subdevice and (gateway := self._get_gateway()):
+            return await gateway.async_dump_trace()
+        if self.connected:
+            try:
+                return await self._interface.dump_trace()
+            except ConnectionError:
+                pass
+        version = float(self._device_config.protocol_version)
+        if isinstance(self._io_thread, TuyaShardPool):
+            # Connections in shard processes record the trace there.
+            try:
+                return await self._io_thread.dump_trace(self.id, version)
+            except ConnectionError:
+                pass
+        return self._frame_trace.dump(self.id, version)
+
     async def check_connection(self):
         """Ensure that the device is not still connecting; if it is, wait for it."""
         if not self.connected and self._task_connect:
@@ -358,7 +455,12 @@ class TuyaDevice(TuyaListener, ContextualLogger):
 
         self.is_closing = True
 
-        tasks = [self._task_shutdown_entities, self._task_reconnect, self._task_connect]
+        tasks = [
+            self._task_shutdown_entities,
+            self._task_reconnect,
+            self._task_connect,
+            self._task_set_status,
+        ]
         pending_tasks = [task for task in tasks if task and task.cancel()]
         await asyncio.gather(*pending_tasks, return_exceptions=True)
 
@@ -381,7 +483,7 @@ class TuyaDevice(TuyaListener, ContextualLogger):
             self.gateway.filter_subdevices()
         self.debug("Closed connection", force=True)
 
-    async def set_status(self):
+    async def set_status(self, raise_errors=False):
         """Send self._pending_status payload to device."""
         await self.check_connection()
         if self._interface and self._pending_status:
@@ -394,15 +496,52 @@ class TuyaDevice(TuyaListener, ContextualLogger):
                     self.status_updated(payload)
             except (TimeoutError, Exception) as ex:
                 self.debug(f"Failed to set values {payload} --> {ex}", force=True)
+                if raise_errors:
+                    raise HomeAssistantError(
+                        f"Failed to set values {payload} on {self.friendly_name}: {ex!r}"
+                    ) from ex
         elif not self.connected:
             self.error(f"Device is not connected.")
 
+    async def _set_status_coalesced(self):
+        """Wait for the pending status to be sent along with the commands that follow it.
+
+        Commands received within the device "commands_delay" are merged into one payload,
+        all the callers are released once the device acknowledged that payload, or get
+        the error of the send as a HomeAssistantError.
+        """
+        task = self._task_set_status
+        if task is None or self._status_sending:
+            task = asyncio.create_task(self._delayed_set_status(task))
+            task.add_done_callback(self._set_status_done)
+            self._task_set_status, self._status_sending = task, False
+        # Shield the shared task so a cancelled caller doesn't cancel the others.
+        await asyncio.shield(task)
+
+    async def _delayed_set_status(self, previous: asyncio.Task | None):
+        """Send the pending status once the previous send and commands delay passed."""
+        if previous is not None:
+            # Awaited so close() cancels the send in flight through this task.
+            try:
+                await previous
+            except (TimeoutError, Exception):
+                pass
+        await asyncio.sleep(self._device_config.commands_delay / 1000)
+        self._status_sending = True
+        await self.set_status(raise_errors=True)
+
+    def _set_status_done(self, task: asyncio.Task):
+        if self._task_set_status is task:
+            self._task_set_status = None
+        # The callers may all be gone, the error was logged by set_status.
+        if not task.cancelled():
+            task.exception()
+
     async def set_dp(self, state, dp_index):
         """Change value of a DP of the Tuya device."""
         if self._interface is not None:
             self._pending_status.update({dp_index: state})
-            await asyncio.sleep(0.001)
-            await self.set_status()
+            await self._set_status_coalesced()
         else:
             if self.is_sleep:
                 return self._pending_status.update({str(dp_index): state})
@@ -411,8 +550,7 @@ class TuyaDevice(TuyaListener, ContextualLogger):
         """Change value of a DPs of the Tuya device."""
         if self._interface is not None:
             self._pending_status.update(states)
-            await asyncio.sleep(0.001)
-            await self.set_status()
+            await self._set_status_coalesced()
         else:
             if self.is_sleep:
                 return self._pending_status.update(states)
@@ -487,8 +625,7 @@ class TuyaDevice(TuyaListener, ContextualLogger):
                 self._task_shutdown_entities = None
                 return
 
-        signal = f"localtuya_{self._device_config.id}"
-        dispatcher_send(self.hass, signal, None)
+        self._notify_subscribers(None)
 
         if self.is_closing:
             return
@@ -512,7 +649,10 @@ class TuyaDevice(TuyaListener, ContextualLogger):
         self.info(f"Trying to update local-key...")
         dev_id = self._device_config.id
         cloud_api = self._hass_entry.cloud_data
-        await cloud_api.async_get_devices_list(force_update=True)
+        # The devices asking together share batch requests, a sub-device gateway
+        # is looked up in the whole devices list.
+        if self._node_id or not await cloud_api.async_get_device_details(dev_id):
+            await cloud_api.async_get_devices_list(force_update=True)
 
         cloud_devs = cloud_api.device_list
         if dev_id in cloud_devs:
@@ -552,9 +692,55 @@ class TuyaDevice(TuyaListener, ContextualLogger):
             k: v for k, v in self.sub_devices.items() if not v.is_closing
         }
 
-    def _dispatch_status(self):
-        signal = f"localtuya_{self._device_config.id}"
-        dispatcher_send(self.hass, signal, self._status)
+    @callback
+    def async_subscribe_dps(
+        self,
+        dps: set[str] | None,
+        handler: Callable[[Mapping | None, set | None], None],
+    ) -> CALLBACK_TYPE:
+        """Call handler(status, changed_dps) when one of dps changed, None for all DPs.
+
+        changed_dps is None when the whole status is dispatched, e.g. on connect.
+        """
+        keys = (None,) if dps is None else dps
+        for dp in keys:
+            self._dps_subscribers.setdefault(dp, []).append(handler)
+
+        def _unsubscribe():
+            for dp in keys:
+                self._dps_subscribers[dp].remove(handler)
+                if not self._dps_subscribers[dp]:
+                    del self._dps_subscribers[dp]
+
+        return _unsubscribe
+
+    def reset_dp_state(self, dp: str):
+        """Report the next update of dp as a change, even if it sends the same value."""
+        self._reset_dps.add(str(dp))
+
+    def _dispatch_status(self, changed: set[str] | None = None):
+        self._notify_subscribers(self.status_view, changed)
+
+    def _notify_subscribers(
+        self, status: Mapping | None, changed: set[str] | None = None
+    ):
+        """Call the handlers of the changed DPs once, all handlers if changed is None."""
+        if status is None:
+            self._dispatch_all = True
+
+        subscribers = self._dps_subscribers
+        if changed is None:
+            handlers = {h: None for handlers in subscribers.values() for h in handlers}
+        else:
+            handlers = dict.fromkeys(subscribers.get(None, ()))
+            for dp in changed:
+                handlers.update(dict.fromkeys(subscribers.get(dp, ())))
+
+        for handler in handlers:
+            try:
+                handler(status, changed)
+            except Exception:  # pylint: disable=broad-except
+                self.exception(f"Failed to update entity with status: {status}")
 
     def _handle_event(self, old_status: dict, new_status: dict):
         """Handle events in HA when devices updated."""
@@ -604,9 +790,31 @@ class TuyaDevice(TuyaListener, ContextualLogger):
             return
 
         self._last_update_time = time.monotonic()
+        if self.time_to_first_state is None and status is not RESTORE_STATES:
+            self.time_to_first_state = self._last_update_time - self._setup_time
         self._handle_event(self._status, status)
+        old_status, reset_dps = self._status, self._reset_dps
+        changed = {
+            dp
+            for dp, value in status.items()
+            if dp in reset_dps or dp not in old_status or old_status[dp] != value
+        }
+        if changed:
+            self.status_version += 1
+        if self._dispatch_all:
+            self._dispatch_all, changed = False, None
+        elif not changed:
+            return
+
+        reset_dps.difference_update(status)
         self._status.update(status)
-        self._dispatch_status()
+        self._dispatch_status(changed)
+
+    @callback
+    def quirks_updated(self, quirks: dict):
+        """Device learned new protocol quirks."""
+        if self._devices_quirks is not None:
+            self._devices_quirks.async_schedule_save()
 
     @callback
     def disconnected(self, exc=""):
@@ -674,3 +882,46 @@ class TuyaDevice(TuyaListener, ContextualLogger):
                 self.warning(f"Sub-device is offline {node_id}")
             elif off_count == MIN_OFFLINE_EVENTS:
                 self.disconnected("Device is offline")
+
+
+def _connect_priority(device: TuyaDevice, discovered: dict) -> int:
+    """Startup order: gateways, devices seen by discovery, others then sleepy devices."""
+    if device.sub_devices:
+        # Sub-devices can't connect before their gateway.
+        return 0
+    if device._device_config.sleep_time > 0:
+        return 3
+    return 1 if device.id in discovered else 2
+
+
+async def async_connect_devices(
+    hass: HomeAssistant, devices: list[TuyaDevice], limit=STARTUP_CONNECT_LIMIT
+):
+    """Connect to the devices by priority, with at most limit devices connecting at once."""
+    start = time.monotonic()
+    discovered = {}
+    if discovery := hass.data[DOMAIN].get(DATA_DISCOVERY):
+        discovered = discovery.devices
+
+    queue = iter(sorted(devices, key=lambda dev: _connect_priority(dev, discovered)))
+
+    async def _worker():
+        # Workers share the queue, the next device is taken once a connect is done.
+        for device in queue:
+            try:
+                await device.async_connect()
+            except Exception as ex:  # pylint: disable=broad-except
+                device.warning(f"Failed to connect on startup: {ex}")
+
+    await asyncio.gather(*[_worker() for _ in range(min(limit, len(devices)))])
+
+    # Sub-devices connect later through their gateways, diagnostics show their times.
+    first_states = [d.time_to_first_state for d in devices if not d._fake_gateway]
+    ready = [t for t in first_states if t is not None]
+    _LOGGER.info(
+        "Startup connect done in %.2fs: %s/%s devices reported their state%s",
+        time.monotonic() - start,
+        len(ready),
+        len(first_states),
+        f", slowest after {max(ready):.2f}s" if ready else "",
+    )
@@ -6,12 +6,37 @@ import hashlib
 import hmac
 import json
 import logging
+import random
 import time
+from collections.abc import Callable
+from contextlib import asynccontextmanager
 
 
 DEVICES_UPDATE_INTERVAL = 300
 DEVICES_UPDATE_INTERVAL_FORCED = 10
 
+# Connections kept open to the API host, reused by the requests of an account.
+CLOUD_CONNECTIONS_PER_HOST = 8
+CLOUD_KEEPALIVE_TIMEOUT = 60
+CLOUD_DNS_CACHE_TTL = 300
+
+# Requests budget of an account, Tuya rejects the requests over its rate limits.
+CLOUD_MAX_CONCURRENT_REQUESTS = CLOUD_CONNECTIONS_PER_HOST
+CLOUD_REQUESTS_PER_SECOND = 10
+CLOUD_REQUEST_RETRIES = 3
+CLOUD_RETRY_BACKOFF = 0.5
+CLOUD_RETRY_BACKOFF_MAX = 8
+# HTTP "too many requests" and server errors, the API reports them as codes too.
+CLOUD_RETRY_CODES = frozenset({429, 500, 501, 502, 503, 504})
+
+# Devices per request of the batch endpoints, the API maximum.
+CLOUD_BATCH_SIZE = 20
+# Seconds a single device request waits to be grouped with the concurrent ones.
+CLOUD_BATCH_WINDOW = 0.1
+
+# Cloud metadata kept across restarts: seconds before a cached field is refreshed.
+CLOUD_CACHE_TTL = {"devices": 24 * 3600, "dps_data": 7 * 24 * 3600}
+
 TUYA_ENDPOINTS = {
     # Regions code
     "Central Europe Data Center": "eu",
@@ -46,54 +71,167 @@ class CustomAdapter(logging.LoggerAdapter):
         return f"[{self.extra.get('prefix', '')}] {msg}", kwargs
 
 
-class AioHttpSession:
-    """
-    A class to manage a shared aiohttp.ClientSession.
-    Ensures that only one session is created, based on active usage counts.
-    """
+class CloudCache:
+    """Cloud metadata of an account: the devices list and the DPS of the devices.
 
-    _session: aiohttp.ClientSession = None
-    _lock = asyncio.Lock()
-    _active_requests = 0
+    data is the JSON-serializable dict of the cache, the owner keeps it across
+    restarts and on_change is called after every change so it can be saved.
+    A device dps_data is dropped once the device update_time changes.
+    """
 
-    async def __get_session(self):
-        """
-        Create ClientSession if it doesn't exist yet.
-        Increases the active requests to keep track of current session uses.
+    def __init__(
+        self,
+        data: dict | None = None,
+        on_change: Callable[[], None] | None = None,
+        ttl: dict[str, int] | None = None,
+    ):
+        """Initialize a new CloudCache."""
+        self.data = {} if data is None else data
+        self.ttl = {**CLOUD_CACHE_TTL, **(ttl or {})}
+        self._on_change = on_change
+
+    def _changed(self):
+        if self._on_change:
+            self._on_change()
+
+    def _is_fresh(self, field: str, cached: dict) -> bool:
+        return time.time() - cached["time"] < self.ttl[field]
+
+    def devices(self) -> tuple[dict[str, dict] | None, float, bool]:
+        """Return the cached devices list, the time it was fetched and if it's fresh."""
+        if not (cached := self.data.get("devices")):
+            return None, 0, False
+        return cached["data"], cached["time"], self._is_fresh("devices", cached)
+
+    def set_devices(self, devices: dict[str, dict]):
+        """Cache the devices list, drop the dps_data of the updated devices."""
+        self.data["devices"] = {"time": time.time(), "data": devices}
+        self._drop_dps_data(devices, missing=True)
+        self._changed()
+
+    def update_devices(self, devices: dict[str, dict]):
+        """Update some devices of the cached list, the list fetch time is kept."""
+        if not (cached := self.data.get("devices")):
+            return
+        cached["data"].update(devices)
+        self._drop_dps_data(devices)
+        self._changed()
+
+    def _drop_dps_data(self, devices: dict[str, dict], missing=False):
+        """Drop the dps_data of the updated devices, and of the missing ones."""
+        dps_data = self.data.get("dps_data", {})
+        for device_id, cached in list(dps_data.items()):
+            if (device := devices.get(device_id)) is None:
+                if missing:
+                    dps_data.pop(device_id)
+            elif device.get("update_time") != cached["update_time"]:
+                dps_data.pop(device_id)
+
+    def dps_data(self, device_id: str, update_time) -> tuple[dict | None, bool]:
+        """Return the cached dps_data of a device and if it's fresh."""
+        cached = self.data.get("dps_data", {}).get(device_id)
+        if not cached or cached["update_time"] != update_time:
+            return None, False
+        return cached["data"], self._is_fresh("dps_data", cached)
+
+    def set_dps_data(self, device_id: str, update_time, dps_data: dict):
+        self.data.setdefault("dps_data", {})[device_id] = {
+            "time": time.time(),
+            "update_time": update_time,
+            "data": dps_data,
+        }
+        self._changed()
 
-        Returns: aiohttp.ClientSession
-        """
-        if self._session is None:
-            self._session = aiohttp.ClientSession()
-        self._active_requests += 1
-        return self._session
 
-    async def __close_session(self):
-        """Close session only if this is the last used of session."""
-        self._active_requests -= 1
+class CloudRequestScheduler:
+    """Budget of the requests of an account: concurrency, rate and retries.
 
-        async with self._lock:
-            if self._session and self._active_requests <= 0:
-                await self._session.close()
-                self._session = None
+    A request waits for a free slot among max_concurrent and for its turn in the
+    requests_per_second budget. Failed requests and the responses with a retry
+    code are retried with a jittered exponential backoff.
+    """
 
-    async def __aenter__(self):
-        return await self.__get_session()
+    def __init__(
+        self,
+        max_concurrent: int = CLOUD_MAX_CONCURRENT_REQUESTS,
+        requests_per_second: float = CLOUD_REQUESTS_PER_SECOND,
+        retries: int = CLOUD_REQUEST_RETRIES,
+        backoff: float = CLOUD_RETRY_BACKOFF,
+        retry_codes: frozenset[int] = CLOUD_RETRY_CODES,
+    ):
+        """Initialize a new CloudRequestScheduler."""
+        self.retries = retries
+        self.retry_codes = retry_codes
+        self._backoff = backoff
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self._interval = 1 / requests_per_second if requests_per_second else 0
+        self._next_slot = 0.0
+
+    @asynccontextmanager
+    async def slot(self):
+        """Wait for a request slot within the concurrency and rate budgets."""
+        async with self._semaphore:
+            if self._interval:
+                now = time.monotonic()
+                slot = max(now, self._next_slot)
+                self._next_slot = slot + self._interval
+                if slot > now:
+                    await asyncio.sleep(slot - now)
+            yield
+
+    def should_retry(self, method: str, resp) -> bool:
+        """Return whether the response of a request is worth a retry.
+
+        Only the rate limited commands are sent again, the others may have run.
+        """
+        if resp is False:  # Connection failed or timed out.
+            return method == "GET"
+        if not isinstance(resp, dict) or resp.get("success"):
+            return False
+        if method != "GET":
+            return resp.get("code") == 429
+        return resp.get("code") in self.retry_codes
 
-    async def __aexit__(self, exc_type, exc, tb):
-        await self.__close_session()
+    def backoff(self, attempt: int) -> float:
+        """Return the delay before the retry attempt, from 0."""
+        delay = min(CLOUD_RETRY_BACKOFF_MAX, self._backoff * 2**attempt)
+        return delay * random.uniform(0.5, 1.5)
 
 
 class TuyaCloudApi:
-    """Class to send API calls."""
+    """Class to send API calls.
+
+    The requests share a keep-alive connection pool, so the TLS handshake is made
+    once per connection instead of once per request. Without a session given, the
+    pool is created on the first request and closed by async_close.
+    """
 
-    def __init__(self, region_code, client_id, secret, user_id):
+    def __init__(
+        self,
+        region_code,
+        client_id,
+        secret,
+        user_id,
+        session: aiohttp.ClientSession | None = None,
+        scheduler: CloudRequestScheduler | None = None,
+        cache: CloudCache | None = None,
+    ):
         """Initialize the class."""
         self._logger = CustomAdapter(
             logging.getLogger(__name__), {"prefix": user_id[:3] + "..." + user_id[-3:]}
         )
 
-        self._session = AioHttpSession()
+        self._session = session
+        self._owns_session = session is None
+        self.scheduler = scheduler or CloudRequestScheduler()
+        self.cache = cache or CloudCache()
+        # Background refreshes of stale cached data, by data key.
+        self._revalidations: dict[str, asyncio.Task] = {}
+        # The token refresh and the GET requests in flight, shared by their callers.
+        self._in_flight: dict[str | tuple, asyncio.Task] = {}
+        # The devices waiting for their details, grouped in batch requests.
+        self._pending_details: dict[str, asyncio.Future] = {}
+        self._details_batches: set[asyncio.Task] = set()
         self._client_id = client_id
         self._secret = secret
         self._user_id = user_id
@@ -110,10 +248,53 @@ class TuyaCloudApi:
             self._base_url = f"https://openapi.tuya{region_code}.com"
 
         self.device_list = {}
-        self.cached_device_list = {}
 
         self._last_devices_update = int(time.time())
 
+    def _get_session(self) -> aiohttp.ClientSession:
+        """Return the session of the requests, create the connection pool if needed."""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit_per_host=CLOUD_CONNECTIONS_PER_HOST,
+                keepalive_timeout=CLOUD_KEEPALIVE_TIMEOUT,
+                ttl_dns_cache=CLOUD_DNS_CACHE_TTL,
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+            self._owns_session = True
+        return self._session
+
+    @staticmethod
+    def _single_flight(tasks: dict, key, coro) -> asyncio.Task:
+        """Return the task of key in tasks, coro is run as the task if there is none."""
+        if (task := tasks.get(key)) is not None:
+            coro.close()
+            return task
+
+        task = asyncio.get_running_loop().create_task(coro)
+        tasks[key] = task
+        task.add_done_callback(lambda _: tasks.pop(key, None))
+        return task
+
+    def _revalidate(self, key: str, coro):
+        """Refresh stale cached data in the background, once at a time per key."""
+        self._single_flight(self._revalidations, key, coro)
+
+    async def async_close(self):
+        """Close the connection pool, a shared session is left open."""
+        for task in [
+            *self._revalidations.values(),
+            *self._in_flight.values(),
+            *self._details_batches,
+        ]:
+            task.cancel()
+        # The devices still waiting for a batch get no details.
+        pending, self._pending_details = self._pending_details, {}
+        for future in pending.values():
+            future.set_result(None)
+        if self._owns_session and self._session is not None:
+            await self._session.close()
+            self._session = None
+
     def generate_payload(self, method, timestamp, url, headers, body=None):
         """Generate signed payload for requests."""
         payload = self._client_id + self._access_token + timestamp
@@ -137,12 +318,38 @@ class TuyaCloudApi:
         return payload
 
     async def async_make_request(self, method, url, body=None, headers={}):
-        """Perform requests."""
+        """Perform requests, within the budget of the scheduler.
+
+        Identical GET requests in flight are sent once, the callers share the response.
+        """
         # obtain new token if expired.
-        if not self.token_validate and self._token_expire_time != -1:
+        if not self.token_validate:
             if (res := await self.async_get_access_token()) and res != "ok":
                 return self._logger.debug(f"Refresh Token failed due to: {res}")
 
+        if method != "GET":
+            return await self._async_request(method, url, body, headers)
+
+        request = self._async_request(method, url, body, headers)
+        key = (url, *sorted(headers.items()))
+        # Shielded, a cancelled caller does not cancel the request of the others.
+        return await asyncio.shield(self._single_flight(self._in_flight, key, request))
+
+    async def _async_request(self, method, url, body=None, headers={}):
+        """Send a request, retry it as the scheduler allows."""
+        scheduler = self.scheduler
+        for attempt in range(scheduler.retries + 1):
+            async with scheduler.slot():
+                resp = await self._async_send(method, url, body, headers)
+            if attempt == scheduler.retries or not scheduler.should_retry(method, resp):
+                return resp
+
+            delay = scheduler.backoff(attempt)
+            self._logger.debug("Retrying %s %s in %.1fs: %s", method, url, delay, resp)
+            await asyncio.sleep(delay)
+
+    async def _async_send(self, method, url, body=None, headers={}):
+        """Sign and send a request, return the response data."""
         timestamp = str(int(time.time() * 1000))
         payload = self.generate_payload(method, timestamp, url, headers, body)
         default_par = {
@@ -154,47 +361,57 @@ class TuyaCloudApi:
         }
         full_url = self._base_url + url
 
-        async with self._session as session:
-            try:
-                if method == "GET":
-                    async with session.get(
-                        full_url, headers=dict(default_par, **headers)
-                    ) as resp:
-                        return await resp.json()
-
-                if method == "POST":
-                    async with session.post(
-                        full_url,
-                        headers=dict(default_par, **headers),
-                        data=json.dumps(body),
-                    ) as resp:
-                        return await resp.json()
-
-                if method == "PUT":
-                    async with session.put(
-                        full_url,
-                        headers=dict(default_par, **headers),
-                        data=json.dumps(body),
-                    ) as resp:
-                        return await resp.json()
-            except (aiohttp.ClientConnectionError, TimeoutError) as ex:
-                self._logger.debug(f"Failed to send request to tuya cloud: {ex}")
-                return False
+        session = self._get_session()
+        try:
+            if method == "GET":
+                async with session.get(
+                    full_url, headers=dict(default_par, **headers)
+                ) as resp:
+                    return await self._async_response_data(resp)
+
+            if method == "POST":
+                async with session.post(
+                    full_url,
+                    headers=dict(default_par, **headers),
+                    data=json.dumps(body),
+                ) as resp:
+                    return await self._async_response_data(resp)
+
+            if method == "PUT":
+                async with session.put(
+                    full_url,
+                    headers=dict(default_par, **headers),
+                    data=json.dumps(body),
+                ) as resp:
+                    return await self._async_response_data(resp)
+        except (aiohttp.ClientConnectionError, TimeoutError) as ex:
+            self._logger.debug(f"Failed to send request to tuya cloud: {ex}")
+            return False
+
+    @staticmethod
+    async def _async_response_data(resp: aiohttp.ClientResponse):
+        """Return the JSON of a response, an API error for the HTTP errors."""
+        if resp.status == 429 or resp.status >= 500:
+            return {"success": False, "code": resp.status, "msg": resp.reason}
+        return await resp.json()
 
     async def async_get_access_token(self) -> str | None:
-        """Obtain a valid access token."""
-        # Reset access token
-        self._token_expire_time = -1
+        """Obtain a valid access token, the concurrent callers share one refresh."""
+        refresh = self._async_refresh_token()
+        return await asyncio.shield(
+            self._single_flight(self._in_flight, "token", refresh)
+        )
+
+    async def _async_refresh_token(self) -> str | None:
+        """Request a new access token, the requests wait for it meanwhile."""
+        # Reset access token, the token request is signed without it.
+        self._token_expire_time = 0
         self._access_token = ""
 
-        if not (
-            resp := await self.async_make_request("GET", "/v1.0/token?grant_type=1")
-        ):
-            self._token_expire_time = 0
+        if not (resp := await self._async_request("GET", "/v1.0/token?grant_type=1")):
             return self._logger.debug(f"Failed to retrieve a valid token")
 
         if not resp["success"]:
-            self._token_expire_time = 0
             return f"Error {resp['code']}: {resp['msg']}"
 
         req_results = resp["result"]
@@ -215,6 +432,10 @@ class TuyaCloudApi:
         ):
             return self._logger.debug(f"Devices has been updated a minutes ago.")
 
+        return await self._async_fetch_devices_list()
+
+    async def _async_fetch_devices_list(self) -> str | None:
+        """Fetch the list of devices, and store it in the cache."""
         if not (
             resp := await self.async_make_request(
                 "GET", url=f"/v1.0/users/{self._user_id}/devices"
@@ -225,19 +446,105 @@ class TuyaCloudApi:
         if not resp["success"]:
             return f"Error {resp['code']}: {resp['msg']}"
 
-        self.device_list.update({dev["id"]: dev for dev in resp["result"]})
+        devices = {dev["id"]: dev for dev in resp["result"]}
+        self.device_list.update(devices)
+        # device_list entries get the dps_data, the cache keeps them apart.
+        self.cache.set_devices({dev_id: dict(dev) for dev_id, dev in devices.items()})
 
         self._last_devices_update = int(time.time())
         return "ok"
 
-    async def async_get_devices_dps_query(self):
-        """Update All the devices dps_data."""
-        # Get Devices DPS Data.
-        await asyncio.wait(
-            asyncio.create_task(self.async_get_device_functions(devid))
-            for devid in self.device_list
+    async def async_get_devices_details(self, device_ids) -> dict[str, dict]:
+        """Fetch the details of devices, up to CLOUD_BATCH_SIZE devices per request.
+
+        The fetched devices are updated in device_list, the others are left out.
+        """
+        device_ids = list(device_ids)
+        batches = [
+            device_ids[i : i + CLOUD_BATCH_SIZE]
+            for i in range(0, len(device_ids), CLOUD_BATCH_SIZE)
+        ]
+        results = await asyncio.gather(
+            *(self._async_fetch_devices_details(batch) for batch in batches)
         )
-        return "ok"
+        devices = {dev["id"]: dev for result in results for dev in result}
+        for dev_id, dev in devices.items():
+            self.device_list.setdefault(dev_id, {}).update(dev)
+        if devices:
+            self.cache.update_devices({k: dict(v) for k, v in devices.items()})
+        return devices
+
+    async def _async_fetch_devices_details(self, device_ids) -> list[dict]:
+        """Fetch the details of a batch of devices."""
+        url = f"/v1.0/devices?device_ids={','.join(device_ids)}"
+        if not (resp := await self.async_make_request("GET", url)):
+            self._logger.debug("Failed to retrieve %s devices details", len(device_ids))
+            return []
+
+        if not resp["success"]:
+            self._logger.debug(
+                "Failed to retrieve devices details: Error %s: %s",
+                resp["code"],
+                resp["msg"],
+            )
+            return []
+
+        result = resp["result"]
+        return result.get("devices", []) if isinstance(result, dict) else result
+
+    async def async_get_device_details(self, device_id) -> dict | None:
+        """Fetch the details of a device, in one batch with the concurrent calls.
+
+        The devices asking within CLOUD_BATCH_WINDOW share the batch requests.
+        """
+        loop = asyncio.get_running_loop()
+        if (future := self._pending_details.get(device_id)) is None:
+            if not self._pending_details:
+                task = loop.create_task(self._async_flush_details())
+                self._details_batches.add(task)
+                task.add_done_callback(self._details_batches.discard)
+            future = self._pending_details[device_id] = loop.create_future()
+        return await asyncio.shield(future)
+
+    async def _async_flush_details(self):
+        """Fetch the details of the pending devices once the batch window ends."""
+        await asyncio.sleep(CLOUD_BATCH_WINDOW)
+        pending, self._pending_details = self._pending_details, {}
+        devices = {}
+        try:
+            devices = await self.async_get_devices_details(pending)
+        finally:
+            for device_id, future in pending.items():
+                future.set_result(devices.get(device_id))
+
+    async def async_get_devices_dps_query(
+        self, progress: Callable[[int, int], None] | None = None
+    ) -> dict[str, dict]:
+        """Update All the devices dps_data, return the dps_data of the fetched devices.
+
+        The requests are throttled by the scheduler, the devices that failed are left
+        out of the results. progress is called with the devices done and the total.
+        """
+        device_ids = list(self.device_list)
+        results: dict[str, dict] = {}
+        done = 0
+
+        async def _fetch(device_id):
+            nonlocal done
+            try:
+                if dps_data := await self.async_get_device_functions(device_id):
+                    results[device_id] = dps_data
+            finally:
+                done += 1
+                if progress:
+                    progress(done, len(device_ids))
+
+        await asyncio.gather(*(_fetch(device_id) for device_id in device_ids))
+        if failed := len(device_ids) - len(results):
+            self._logger.debug(
+                "Failed to get DPS functions of %s/%s devices", failed, len(device_ids)
+            )
+        return results
 
     async def async_get_device_specifications(self, device_id) -> dict[str, dict]:
         """Obtain the DP ID mappings for a device."""
@@ -288,11 +595,19 @@ class TuyaCloudApi:
 
     async def async_get_device_functions(self, device_id) -> dict[str, dict]:
         """Pull Devices Properties and Specifications to devices_list"""
-        cached = device_id in self.cached_device_list
-        if cached and (dps_data := self.cached_device_list[device_id].get("dps_data")):
+        update_time = self.device_list[device_id].get("update_time")
+        dps_data, fresh = self.cache.dps_data(device_id, update_time)
+        if dps_data:
             self.device_list[device_id]["dps_data"] = dps_data
+            if not fresh:
+                coro = self._async_fetch_device_functions(device_id)
+                self._revalidate(f"dps_data_{device_id}", coro)
             return dps_data
 
+        return await self._async_fetch_device_functions(device_id)
+
+    async def _async_fetch_device_functions(self, device_id) -> dict[str, dict]:
+        """Fetch the DPS of a device from its specifications, properties and model."""
         device_data = {}
         get_data = [
             self.async_get_device_specifications(device_id),
@@ -300,10 +615,13 @@ class TuyaCloudApi:
             self.async_get_device_query_things_data_model(device_id),
         ]
         try:
-            specs, query_props, query_model = await asyncio.gather(*get_data)
+            results = await asyncio.gather(*get_data)
         except (Exception,) as ex:
             self._logger.debug(f"Failed to get DPS functions for {device_id} - {ex}")
             return
+        # The requests that failed to be sent return None.
+        failed = ({}, "failed")
+        specs, query_props, query_model = (result or failed for result in results)
 
         if query_props[1] == "ok":
             device_data = {str(p["dp_id"]): p for p in query_props[0].get("properties")}
@@ -337,12 +655,22 @@ class TuyaCloudApi:
 
         if device_data:
             self.device_list[device_id]["dps_data"] = device_data
-            self.cached_device_list.update({device_id: self.device_list[device_id]})
+            update_time = self.device_list[device_id].get("update_time")
+            self.cache.set_dps_data(device_id, update_time, device_data)
 
         return device_data
 
     async def async_connect(self):
-        """Connect to cloudAPI"""
+        """Connect to cloudAPI, the cached devices list is used if any."""
+        devices, fetch_time, fresh = self.cache.devices()
+        if devices is not None:
+            self.device_list.update({k: dict(v) for k, v in devices.items()})
+            self._last_devices_update = int(fetch_time)
+            if not fresh:
+                self._revalidate("devices", self._async_fetch_devices_list())
+            self._logger.info("Cloud API devices loaded from cache.")
+            return True, "ok"
+
         if (res := await self.async_get_access_token()) and res != "ok":
             self._logger.warning("Cloud API connection failed: %s", res)
             return "authentication_failed", res
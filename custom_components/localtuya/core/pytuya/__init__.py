@@ -37,19 +37,34 @@ Credits
 
 import os
 import asyncio
+import random
 import errno
-import base64
 import binascii
-import hmac
 import json
 import logging
 import struct
 import time
 import weakref
 from abc import ABC, abstractmethod
+from collections.abc import Callable
 from typing import Self
-from hashlib import md5, sha256
-from .cipher import AESCipher
+from hashlib import md5
+from .cipher import SessionCrypto
+from .heartbeat import (
+    HEARTBEAT_INTERVAL,
+    HEARTBEAT_MAX_IDLE,
+    HeartbeatTimer,
+    get_heartbeat_wheel,
+)
+from .pacer import WritePacer
+from .trace import (
+    TRACE_IN,
+    TRACE_KEY,
+    TRACE_LOCAL_KEY,
+    TRACE_OUT,
+    TRACE_SESSION_KEY,
+    FrameTrace,
+)
 
 
 from . import parser
@@ -61,6 +76,7 @@ from .const import (
     TuyaMessage,
     MessagePayload,
     MessagesFormat,
+    PayloadTemplate,
 )
 
 version_tuple = (2025, 7, 0)
@@ -107,6 +123,14 @@ error_codes = {
 
 UPDATE_DPS_LIST = [3.2, 3.3, 3.4, 3.5]  # 3.2 behaves like 3.3 with type_0d
 
+# Device behaviours learned at runtime, the listener keeps them across reconnects.
+QUIRK_DEV_TYPE = "dev_type"
+QUIRK_NO_UPDATEDPS_REPLY = "no_updatedps_reply"
+# Consecutive UPDATEDPS timeouts, counted across reconnects but not saved on its own.
+QUIRK_UPDATEDPS_TIMEOUTS = "updatedps_timeouts"
+# The UPDATEDPS timeouts of a connected device before it is known to never reply.
+NO_UPDATEDPS_REPLY_TIMEOUTS = 3
+
 PROTOCOL_VERSION_BYTES_31 = b"3.1"
 PROTOCOL_VERSION_BYTES_33 = b"3.3"
 PROTOCOL_VERSION_BYTES_34 = b"3.4"
@@ -129,9 +153,17 @@ NO_PROTOCOL_HEADER_CMDS = [
     CMDType.LAN_EXT_STREAM,
 ]
 
-HEARTBEAT_INTERVAL = 8.3
+PREFIX_LEN = len(Affix.prefix_55aa.bin)
+SUFFIX_LEN = len(Affix.suffix_55aa.bin)
+PREFIXES_BIN = tuple(prefix.bin for prefix in Affix.prefixes)
+SUFFIXES_BIN = tuple(suffix.bin for suffix in Affix.suffixes)
+HEADER_LEN_55AA = struct.calcsize(MessagesFormat.HEADER_55AA)
+HEADER_LEN_6699 = struct.calcsize(MessagesFormat.HEADER_6699)
+
 TIMEOUT_CONNECT = 5
 TIMEOUT_REPLY = 5
+# Requests that can be waiting for a reply at the same time on one connection.
+MAX_PENDING_REQUESTS = 8
 
 # DPS that are known to be safe to use with update_dps (0x12) command
 UPDATE_DPS_WHITELIST = [18, 19, 20]  # Socket (Wi-Fi)
@@ -192,6 +224,48 @@ payload_dict = {
     },
 }
 
+# Compiled payload_dict entries, keyed by (dev_type, command).
+PAYLOAD_TEMPLATES: dict[tuple[str, CMDType], PayloadTemplate] = {}
+PAYLOAD_ENCODER = json.JSONEncoder(separators=(",", ":"))
+
+
+def get_payload_template(dev_type: str, command: CMDType) -> PayloadTemplate:
+    """Return the compiled payload template of command for dev_type."""
+    if (template := PAYLOAD_TEMPLATES.get((dev_type, command))) is not None:
+        return template
+
+    json_data = command_override = None
+    # Devices types inherit the missing commands and payloads from type_0a.
+    for device_type in dict.fromkeys((dev_type, "type_0a")):
+        command_payload = payload_dict[device_type].get(command, {})
+        if json_data is None:
+            json_data = command_payload.get("command")
+        if command_override is None:
+            command_override = command_payload.get("command_override")
+
+    if command_override is None:
+        command_override = command
+    if json_data is None:
+        # I have yet to see a device complain about included but unneeded attribs, but they *will*
+        # complain about missing attribs, so just include them all unless otherwise specified
+        json_data = {"gwId": "", "devId": "", "uid": "", "t": "", "cid": ""}
+
+    template = PayloadTemplate(command_override, json_data)
+    PAYLOAD_TEMPLATES[(dev_type, command)] = template
+    return template
+
+
+def derive_session_key(
+    crypto: SessionCrypto, version: float, local_nonce: bytes, remote_nonce: bytes
+) -> bytes:
+    """Return the session key negotiated with the nonces, crypto is the local key's."""
+    session_key = bytes([a ^ b for (a, b) in zip(local_nonce, remote_nonce)])
+    if version == 3.4:
+        return crypto.cipher.encrypt(session_key, False, pad=False)
+    return crypto.cipher.encrypt(
+        session_key, use_base64=False, pad=False, iv=local_nonce[:12]
+    )[12:28]
+
 
 class TuyaLoggingAdapter(logging.LoggerAdapter):
     """Adapter that adds device id to all log points."""
@@ -208,18 +282,22 @@ class TuyaLoggingAdapter(logging.LoggerAdapter):
 
 
 class ContextualLogger:
-    """Contextual logger adding device id to log points."""
+    """Contextual logger adding device id to log points.
+
+    debug_enabled is updated by set_logger, the hot paths check it before building
+    the arguments of a debug log so nothing is formatted when the debug is off.
+    """
 
     def __init__(self):
         """Initialize a new ContextualLogger."""
         self._logger = None
-        self._enable_debug = False
+        self.debug_enabled = False
 
         self._last_warning = ""
 
     def set_logger(self, logger, device_id, enable_debug=False, name=None):
         """Set base logger to use."""
-        self._enable_debug = enable_debug
+        self.debug_enabled = bool(enable_debug)
         self._logger = TuyaLoggingAdapter(
             logger, {"device_id": device_id, "name": name}
         )
@@ -227,9 +305,8 @@ class ContextualLogger:
 
     def debug(self, msg, *args, force=False):
         """Debug level log for device. force will ignore device debug check."""
-        if not self._enable_debug and not force:
-            return
-        return self._logger.log(logging.DEBUG, msg, *args)
+        if self.debug_enabled or force:
+            return self._logger.log(logging.DEBUG, msg, *args)
 
     def info(self, msg, *args, clear_warning=False):
         """Info level log. clear_warning to re-enable warnings msgs if duplicated"""
@@ -266,106 +343,134 @@ class MessageDispatcher(ContextualLogger):
     SESS_KEY_SEQNO = -102
     SUB_DEVICE_QUERY_SEQNO = -103
 
-    def __init__(self, dev_id, callback_status_update, protocol_version, local_key):
+    def __init__(
+        self, dev_id, callback_status_update, protocol_version, crypto: SessionCrypto
+    ):
         """Initialize a new MessageBuffer."""
         super().__init__()
-        self.buffer = b""
-        self.listeners: dict[str, asyncio.Future] = {}
+        self.buffer = bytearray()
+        self.listeners: dict[int, list[asyncio.Future]] = {}
         self.callback_status_update = callback_status_update
         self.version = protocol_version
-        self.local_key = local_key
+        self.crypto = crypto
+        self.last_frame_time = 0.0  # The time last valid frame was received
+        # Called when the device answers an UPDATEDPS command.
+        self.on_updatedps_reply: Callable[[], None] | None = None
 
     def abort(self):
         """Abort all waiting clients."""
-        for feat in self.listeners.copy():
-            feature = self.listeners.pop(feat)
-            feature.cancel("aborted")
+        for seqno in self.listeners.copy():
+            for future in self.listeners.pop(seqno):
+                future.cancel("aborted")
 
     async def wait_for(self, seqno, cmd, timeout=TIMEOUT_REPLY):
-        """Wait for response to a sequence number to be received and return it."""
-        if seqno in self.listeners:
-            self.debug(f"listener exists for {seqno}")
-            if seqno == self.HEARTBEAT_SEQNO:
-                raise Exception(f"listener exists for {seqno}")
+        """Wait for response to a sequence number to be received and return it.
 
+        Special sequence numbers (heartbeat, reset, etc...) can have several waiters,
+        these are released in the same order the requests were sent.
+        """
         self.debug("Command %d waiting for seq. number %d", cmd, seqno)
         future = asyncio.Future()
-        self.listeners[seqno] = future
+        waiters = self.listeners.setdefault(seqno, [])
+        waiters.append(future)
         try:
-            response = await asyncio.wait_for(future, timeout=timeout)
-            return response
+            return await asyncio.wait_for(future, timeout=timeout)
         except asyncio.TimeoutError:
-            self.abort()
+            # Only this request gives up, the other requests keep waiting.
             raise TimeoutError(
                 f"Command {cmd} timed out waiting for sequence number {seqno}"
             )
         finally:
-            self.listeners.pop(seqno, True)
+            waiters.remove(future)
+            if not waiters and self.listeners.get(seqno) is waiters:
+                self.listeners.pop(seqno)
 
     def _release_listener(self, seqno, msg):
         if seqno not in self.listeners:
             return
 
-        future = self.listeners[seqno]
-        if isinstance(future, asyncio.Future) and not future.done():
-            future.set_result(msg)
-        else:
-            self.debug(f"{seqno} - Got additional message without request: skip {msg}")
+        for future in self.listeners[seqno]:
+            if not future.done():
+                return future.set_result(msg)
+
+        self.debug("%s - Got additional message without request: skip %s", seqno, msg)
+
+    @staticmethod
+    def _find_prefix(buffer: bytearray, start: int) -> int:
+        """Return the index of the first known prefix at or after start, else -1."""
+        index_55aa = buffer.find(Affix.prefix_55aa.bin, start)
+        index_6699 = buffer.find(Affix.prefix_6699.bin, start)
+        if index_55aa == -1 or (index_6699 != -1 and index_6699 < index_55aa):
+            return index_6699
+        return index_55aa
 
     def add_data(self, data: bytes):
-        """Add new data to the buffer and try to parse messages."""
-        self.buffer += data
-        prefixes_bin = {prefix.bin for prefix in Affix.prefixes}
-        suffixes_bin = {suffix.bin for suffix in Affix.suffixes}
-        header_len = struct.calcsize(MessagesFormat.END_55AA)
-        while self.buffer:
-
-            # Check if enough data for measage header
-            if len(self.buffer) < header_len:
-                break
-
-            if (prefix_index := self.buffer.find(Affix.prefix_55aa.bin)) == -1:
-                prefix_index = self.buffer.find(Affix.prefix_6699.bin)
-
-            if prefix_index == -1:
-                self.debug(f"Invalid prefix: {self.buffer!r}")
-                self.buffer = b""
-            elif self.buffer[:4] not in (prefixes_bin) and prefix_index > 0:
-                self.debug(f"prefix is not at the end: {self.buffer}")
-                self.buffer = self.buffer[prefix_index:]
-
-            if (suffix_index := self.buffer.find(Affix.suffix_55aa.bin)) == -1:
-                suffix_index = self.buffer.find(Affix.suffix_6699.bin)
-
-            # if not any (self.buffer.endswith(suffix) for suffix in suffixes)
-            if suffix_index == -1:
-                self.debug(f"Invalid suffix: {self.buffer!r}")
-                self.buffer = b""
-            if not any(self.buffer.endswith(suffix_bin) for suffix_bin in suffixes_bin):
-                self.debug(f"suffix is not at the end: {self.buffer!r}")
-                break
-                # self.buffer = self.buffer[: suffix_index + 4]
-
-            header = parser.parse_header(self.buffer, logger=self)
-            if len(self.buffer) < header.total_length:
-                self.debug(f"Not enough data to parse: {self.buffer}")
-                break  # not enough data.
-
-            hmac_key = self.local_key if self.version >= 3.4 else None
-            no_retcode = False
-            msg = parser.unpack_message(
-                self.buffer,
-                header=header,
-                hmac_key=hmac_key,
-                no_retcode=no_retcode,
-                logger=self,
-            )
-            self.buffer = self.buffer[header.total_length :]
-            self._dispatch(msg)
+        """Add new data to the buffer and dispatch every complete message in it.
+
+        Frames are located with a read cursor over the buffer, so a read that holds
+        several messages plus the start of the next one is handled in a single pass
+        and the incomplete tail stays in the buffer until the rest of it arrives.
+        """
+        buffer = self.buffer
+        buffer += data
+        pos = 0
+        view = memoryview(buffer)
+        try:
+            while len(buffer) - pos >= PREFIX_LEN:
+                if not buffer.startswith(PREFIXES_BIN, pos):
+                    if (prefix_index := self._find_prefix(buffer, pos)) == -1:
+                        # Keep the tail in case it is the beginning of a prefix.
+                        end = len(buffer) - PREFIX_LEN + 1
+                        if self.debug_enabled:
+                            self.debug("Invalid prefix: %r", bytes(view[pos:end]))
+                        pos = end
+                        break
+                    self.debug("Skipping %d bytes before prefix", prefix_index - pos)
+                    pos = prefix_index
+
+                if buffer.startswith(Affix.prefix_6699.bin, pos):
+                    header_len = HEADER_LEN_6699
+                else:
+                    header_len = HEADER_LEN_55AA
+
+                if len(buffer) - pos < header_len:
+                    break  # not enough data for the header.
+
+                try:
+                    header = parser.parse_header(
+                        view[pos : pos + header_len], logger=self
+                    )
+                except parser.DecodeError:
+                    pos += PREFIX_LEN  # resync on the next prefix.
+                    continue
+
+                end = pos + header.total_length
+                if len(buffer) < end:
+                    break  # not enough data for the full message.
+
+                if not buffer.startswith(SUFFIXES_BIN, end - SUFFIX_LEN):
+                    self.debug("Invalid suffix for message at %d, resyncing", pos)
+                    pos += PREFIX_LEN
+                    continue
+
+                frame = bytes(view[pos:end])
+                pos = end
+                msg = parser.unpack_message(
+                    frame,
+                    header=header,
+                    hmac_key=self.crypto if self.version >= 3.4 else None,
+                    no_retcode=False,
+                    logger=self,
+                )
+                self.last_frame_time = time.monotonic()
+                self._dispatch(msg)
+        finally:
+            view.release()
+            if pos > 0:
+                del buffer[:pos]
 
     def _dispatch(self, msg: TuyaMessage):
         """Dispatch a message to someone that is listening."""
-
         self.debug("Dispatching message CMD %r %s", msg.cmd, msg)
 
         if msg.seqno in self.listeners:
@@ -378,6 +483,8 @@ class MessageDispatcher(ContextualLogger):
         elif msg.cmd == CMDType.UPDATEDPS:
             self.debug("Got normal updatedps response")
             self._release_listener(self.RESET_SEQNO, msg)
+            if self.on_updatedps_reply is not None:
+                self.on_updatedps_reply()
         elif msg.cmd == CMDType.SESS_KEY_NEG_RESP:
             self.debug("Got key negotiation response")
             self._release_listener(self.SESS_KEY_SEQNO, msg)
@@ -391,12 +498,14 @@ class MessageDispatcher(ContextualLogger):
         elif msg.cmd == CMDType.LAN_EXT_STREAM:
             self._release_listener(self.SUB_DEVICE_QUERY_SEQNO, msg)
             if msg.payload:
-                self.debug(f"Got Sub-devices status update")
+                self.debug("Got Sub-devices status update")
                 self.callback_status_update(msg)
         else:
             if msg.cmd == CMDType.CONTROL_NEW or not msg.payload:
                 self.debug(
-                    "Got ACK message for command %d: ignoring it %s", msg.cmd, msg.seqno
+                    "Got ACK message for command %d: ignoring it %s",
+                    msg.cmd,
+                    msg.seqno,
                 )
                 self.callback_status_update(msg, ack=True)
             elif msg.seqno not in self.listeners:
@@ -425,6 +534,9 @@ class TuyaListener(ABC):
     def subdevice_state_updated(self, state: SubdeviceState):
         """Device is offline or online."""
 
+    def quirks_updated(self, quirks: dict):
+        """Device learned new protocol quirks."""
+
 
 class EmptyListener(TuyaListener):
     """Listener doing nothing."""
@@ -449,6 +561,9 @@ class TuyaProtocol(asyncio.Protocol, ContextualLogger):
         protocol_version: float,
         enable_debug: bool,
         listener: TuyaListener,
+        pacer: WritePacer = None,
+        quirks: dict = None,
+        trace: FrameTrace = None,
     ):
         """
         Initialize a new TuyaInterface.
@@ -457,6 +572,9 @@ class TuyaProtocol(asyncio.Protocol, ContextualLogger):
             dev_id (str): The device id.
             address (str): The network address.
             local_key (str, optional): The encryption key. Defaults to None.
+            pacer (WritePacer, optional): Write pacer, can be shared across reconnects.
+            quirks (dict, optional): Quirks learned by previous connections.
+            trace (FrameTrace, optional): Frames trace, can be shared across reconnects.
 
         Attributes:
             port (int): The port to connect to.
@@ -469,6 +587,7 @@ class TuyaProtocol(asyncio.Protocol, ContextualLogger):
         self.id = dev_id
         self.local_key = local_key.encode("latin1")
         self.real_local_key = self.local_key
+        self.real_crypto = self.crypto = SessionCrypto(self.local_key)
         self.dev_type = "type_0a"
         self.dps_to_request = {}
 
@@ -479,12 +598,19 @@ class TuyaProtocol(asyncio.Protocol, ContextualLogger):
             # them (such as BulbDevice) make connections when called
             TuyaProtocol.set_version(self, 3.1)
 
-        self.cipher = AESCipher(self.local_key)
+        self.quirks = {} if quirks is None else quirks
+        if self.version == 3.3 and (dev_type := self.quirks.get(QUIRK_DEV_TYPE)):
+            # Skip the dev_type detection round trip.
+            self.dev_type = dev_type
+
         self.seqno = 1
         self.transport = None
         self.listener = weakref.ref(listener)
         self.dispatcher = self._setup_dispatcher()
-        self.heartbeater: asyncio.Task | None = None
+        self._heartbeat_timer: HeartbeatTimer | None = None
+        self._heartbeat_task: asyncio.Task | None = None
+        self._heartbeat_action = self.heartbeat
+        self._heartbeat_failures = 0
         self._sub_devs_query_task: asyncio.Task | None = None
         self.dps_cache = {}
         self.local_nonce = b"0123456789abcdef"  # not-so-random random key
@@ -493,6 +619,11 @@ class TuyaProtocol(asyncio.Protocol, ContextualLogger):
         self.dispatched_dps = {}  # Store payload so we can trigger an event in HA.
         self._last_command_sent = 1  # The time last command was sent
         self._write_lock = asyncio.Lock()  # To serialize writes
+        self.pacer = pacer or WritePacer()
+        self.trace = FrameTrace() if trace is None else trace
+        self._session_key_lock = asyncio.Lock()
+        # Bound the number of requests waiting for a reply on this connection.
+        self._pending_requests = asyncio.Semaphore(MAX_PENDING_REQUESTS)
         self.enable_debug(enable_debug)
 
     def set_version(self, protocol_version):
@@ -508,6 +639,16 @@ class TuyaProtocol(asyncio.Protocol, ContextualLogger):
         elif protocol_version == 3.5:
             self.dev_type = "v3.5"
 
+    def _learn_quirk(self, quirk: str, value):
+        """Remember a device behaviour and let the listener persist it."""
+        if self.quirks.get(quirk) == value:
+            return
+
+        self.debug("Learned device quirk %s=%s", quirk, value)
+        self.quirks[quirk] = value
+        if (listener := self.listener and self.listener()) is not None:
+            listener.quirks_updated(self.quirks)
+
     def error_json(self, number=None, payload=None):
         """Return error details in JSON."""
         try:
@@ -529,7 +670,11 @@ class TuyaProtocol(asyncio.Protocol, ContextualLogger):
 
         async def _action(on_devs, off_devs):
             try:
-                self.debug(f"Sub-Devices States Update: {on_devs=} {off_devs=}")
+                self.debug(
+                    "Sub-Devices States Update: on_devs=%s off_devs=%s",
+                    on_devs,
+                    off_devs,
+                )
                 listener = self.listener and self.listener()
                 if listener is None:
                     return
@@ -561,7 +706,9 @@ class TuyaProtocol(asyncio.Protocol, ContextualLogger):
                     self.seqno = msg.seqno + 1
                 if ack:
                     self.debug(
-                        f"Got update ack message update seqno only. msg.seqno={msg.seqno} self.seqno={self.seqno}"
+                        "Got update ack message update seqno only. msg.seqno=%s self.seqno=%s",
+                        msg.seqno,
+                        self.seqno,
                     )
                     return
 
@@ -589,7 +736,8 @@ class TuyaProtocol(asyncio.Protocol, ContextualLogger):
                     # Don't pass sub-device's payload to the (fake)gateway!
                     if not (listener := listener.sub_devices.get(cid, None)):
                         return self.debug(
-                            f'Payload for missing sub-device discarded: "{decoded_message}"'
+                            'Payload for missing sub-device discarded: "%s"',
+                            decoded_message,
                         )
                     status = self.dps_cache.get(cid, {})
                 else:
@@ -597,7 +745,17 @@ class TuyaProtocol(asyncio.Protocol, ContextualLogger):
 
                 listener.status_updated(status)
 
-        return MessageDispatcher(self.id, _status_update, self.version, self.local_key)
+        dispatcher = MessageDispatcher(
+            self.id, _status_update, self.version, self.crypto
+        )
+        dispatcher.on_updatedps_reply = self._updatedps_replied
+        return dispatcher
+
+    def _updatedps_replied(self):
+        """The device answers UPDATEDPS, forget the timeouts and the learned quirk."""
+        self.quirks.pop(QUIRK_UPDATEDPS_TIMEOUTS, None)
+        if self.quirks.get(QUIRK_NO_UPDATEDPS_REPLY):
+            self._learn_quirk(QUIRK_NO_UPDATEDPS_REPLY, False)
 
     def connection_made(self, transport):
         """Did connect to the device."""
@@ -608,58 +766,76 @@ class TuyaProtocol(asyncio.Protocol, ContextualLogger):
         Start the heartbeat transmissions with the device.
             is_gateway: will use subdevices_query as heartbeat.
         """
+        if self._heartbeat_timer is not None:
+            # Prevent duplicates heartbeat timer
+            return
 
-        async def keep_alive_loop(action):
-            """Continuously send heart beat updates."""
-            self.debug("Started keep alive loop.")
-            fail_attempt = 0
-            delta = 0
-            while True:
-                start = time.monotonic()
-                try:
-                    await asyncio.sleep(HEARTBEAT_INTERVAL - delta)
-                    await action()
-                    fail_attempt = 0
-                except asyncio.CancelledError:
-                    self.debug("Stopped heartbeat loop")
-                    break
-                except asyncio.TimeoutError:
-                    fail_attempt += 1
-                    if fail_attempt >= 2:
-                        self.debug("Heartbeat failed due to timeout, disconnecting")
-                        break
-                except Exception as ex:  # pylint: disable=broad-except
-                    self.exception("Heartbeat failed (%s), disconnecting", ex)
-                    break
-                # Adjusts sleep time to maintain the heartbeat interval
-                delta = (time.monotonic() - start) - HEARTBEAT_INTERVAL
-                delta = max(0, min(delta, HEARTBEAT_INTERVAL))
-
-            self.heartbeater = None
-            if self.transport is not None:
-                self.clean_up_session()
-
-            self.debug("Stopped heartbeat loop")
-
-        if self.heartbeater is None:
-            # Prevent duplicates heartbeat task
-            self.heartbeater = self.loop.create_task(
-                keep_alive_loop(
-                    # Ver. 3.3 gateways don't respond to subdevice query
-                    self.subdevices_query
-                    if is_gateway and self.version >= 3.4
-                    else self.heartbeat
-                )
-            )
+        self.debug("Started keep alive loop.")
+        # Ver. 3.3 gateways don't respond to subdevice query
+        if is_gateway and self.version >= 3.4:
+            self._heartbeat_action = self.subdevices_query
+        self._heartbeat_timer = HeartbeatTimer(self._heartbeat_due)
+        # Spread the first heartbeats of devices connected at the same time.
+        get_heartbeat_wheel(self.loop).schedule(
+            self._heartbeat_timer, HEARTBEAT_INTERVAL * random.uniform(0.5, 1)
+        )
+
+    def _heartbeat_due(self):
+        """Send the heartbeat unless the device proved to be alive recently."""
+        last_frame = time.monotonic() - self.dispatcher.last_frame_time
+        # Sub-devices query doubles as the sub-devices presence check, always send it.
+        if (
+            self._heartbeat_action == self.heartbeat
+            and last_frame < HEARTBEAT_INTERVAL
+            and self.last_command_sent < HEARTBEAT_MAX_IDLE
+        ):
+            self.debug("Skipped heartbeat, received a message %.1fs ago", last_frame)
+            delay = HEARTBEAT_INTERVAL - last_frame
+            return get_heartbeat_wheel(self.loop).schedule(self._heartbeat_timer, delay)
+
+        self._heartbeat_task = self.loop.create_task(self._send_heartbeat())
+
+    async def _send_heartbeat(self):
+        """Send a heartbeat and schedule the next one, disconnect if it keeps failing."""
+        try:
+            await self._heartbeat_action()
+            self._heartbeat_failures = 0
+        except asyncio.CancelledError:
+            return self.debug("Stopped heartbeat loop")
+        except asyncio.TimeoutError:
+            self._heartbeat_failures += 1
+            if self._heartbeat_failures >= 2:
+                self.debug("Heartbeat failed due to timeout, disconnecting")
+                return self._stop_heartbeat()
+        except Exception as ex:  # pylint: disable=broad-except
+            self.exception("Heartbeat failed (%s), disconnecting", ex)
+            return self._stop_heartbeat()
+        finally:
+            self._heartbeat_task = None
+
+        if self._heartbeat_timer is not None:
+            get_heartbeat_wheel(self.loop).schedule(self._heartbeat_timer)
+
+    def _stop_heartbeat(self):
+        """Stop the heartbeats after a failure and clean up the session."""
+        self._heartbeat_task = None
+        if self.transport is not None:
+            self.clean_up_session()
+
+        self.debug("Stopped heartbeat loop")
 
     def data_received(self, data):
         """Received data from device."""
         # self.debug("received data=%r", binascii.hexlify(data), force=True)
+        self.trace.record(TRACE_IN, data)
         self.dispatcher.add_data(data)
 
     def connection_lost(self, exc):
         """Disconnected from device."""
         self.debug("Connection lost: %s", exc, force=True)
+        if exc is not None:
+            # The device reset the connection, it may be overloaded.
+            self.pacer.backoff()
 
         listener = self.listener and self.listener()
         self.clean_up_session()
@@ -673,30 +849,35 @@ class TuyaProtocol(asyncio.Protocol, ContextualLogger):
     async def transport_write(self, data):
         """Write data on transport, ensure that no massive requests happen all at once."""
         async with self._write_lock:
-            while self.last_command_sent < 0.050:
-                await asyncio.sleep(0.010)
+            if (delay := self.pacer.reserve()) > 0:
+                await asyncio.sleep(delay)
 
             self._last_command_sent = time.monotonic()
             self.transport.write(data)
+            self.trace.record(TRACE_OUT, data)
 
     async def close(self):
         """Close connection and abort all outstanding listeners."""
         self.debug("Closing connection")
         self.clean_up_session()
 
-        if self.heartbeater:
-            await self.heartbeater
+        if self._heartbeat_task:
+            await asyncio.wait([self._heartbeat_task])
 
         if self._sub_devs_query_task:
             await self._sub_devs_query_task
 
     def clean_up_session(self):
         """Clean up session."""
-        self.debug(f"Cleaning up session.")
-        self.local_key = self.real_local_key
+        self.debug("Cleaning up session.")
+        self._set_session_key(self.real_local_key)
+
+        if self._heartbeat_timer:
+            get_heartbeat_wheel(self.loop).cancel(self._heartbeat_timer)
+            self._heartbeat_timer = None
 
-        if self.heartbeater:
-            self.heartbeater.cancel()
+        if self._heartbeat_task:
+            self._heartbeat_task.cancel()
 
         if self._sub_devs_query_task:
             self._sub_devs_query_task.cancel()
@@ -753,40 +934,64 @@ class TuyaProtocol(asyncio.Protocol, ContextualLogger):
         dps: dict = None,
         nodeID: str = None,
         payload: dict = None,
+        wait: bool = True,
     ):
-        """Send and receive a message, returning response from device."""
+        """Send and receive a message, returning response from device.
+
+        Without wait, True is returned once the message is sent.
+        """
         if not self.is_connected:
             return None
 
         if self.version >= 3.4 and self.real_local_key == self.local_key:
-            self.debug("3.4 or 3.5 device: negotiating a new session key")
-            if not await self._negotiate_session_key():
-                return self.clean_up_session()
+            async with self._session_key_lock:
+                # Another request may have negotiated the key while we were waiting.
+                if self.real_local_key == self.local_key:
+                    self.debug("3.4 or 3.5 device: negotiating a new session key")
+                    if not await self._negotiate_session_key():
+                        return self.clean_up_session()
 
         self.debug(
-            "Sending command %s (device type: %s) DPS: %s", command, self.dev_type, dps
+            "Sending command %s (device type: %s) DPS: %s",
+            command,
+            self.dev_type,
+            dps,
         )
         payload = payload or self._generate_payload(command, dps, nodeId=nodeID)
         real_cmd = payload.cmd
         dev_type = self.dev_type
 
-        # Wait for special sequence number
-        seqno = self.seqno
+        async with self._pending_requests:
+            if not self.is_connected:
+                return None
 
-        if payload.cmd == CMDType.HEART_BEAT:
-            seqno = MessageDispatcher.HEARTBEAT_SEQNO
-        elif payload.cmd == CMDType.UPDATEDPS:
-            seqno = MessageDispatcher.RESET_SEQNO
-        elif payload.cmd == CMDType.LAN_EXT_STREAM:
-            seqno = MessageDispatcher.SUB_DEVICE_QUERY_SEQNO
+            # Wait for special sequence number
+            seqno = self.seqno
 
-        enc_payload = self._encode_message(payload)
+            if payload.cmd == CMDType.HEART_BEAT:
+                seqno = MessageDispatcher.HEARTBEAT_SEQNO
+            elif payload.cmd == CMDType.UPDATEDPS:
+                seqno = MessageDispatcher.RESET_SEQNO
+            elif payload.cmd == CMDType.LAN_EXT_STREAM:
+                seqno = MessageDispatcher.SUB_DEVICE_QUERY_SEQNO
+
+            enc_payload = self._encode_message(payload)
+
+            try:
+                await self.transport_write(enc_payload)
+            except Exception:  # pylint: disable=broad-except
+                return self.clean_up_session()
+            if not wait:
+                return True
+
+            sent_time = time.monotonic()
+            try:
+                msg = await self.dispatcher.wait_for(seqno, payload.cmd)
+            except TimeoutError:
+                self.pacer.backoff()
+                raise
+            self.pacer.acknowledged(time.monotonic() - sent_time)
 
-        try:
-            await self.transport_write(enc_payload)
-        except Exception:  # pylint: disable=broad-except
-            return self.clean_up_session()
-        msg = await self.dispatcher.wait_for(seqno, payload.cmd)
         if msg is None:
             self.debug("Wait was aborted for seqno %d", seqno)
             return None
@@ -798,7 +1003,7 @@ class TuyaProtocol(asyncio.Protocol, ContextualLogger):
         ):
             # device may send messages with empty payload in response
             # to a HEART_BEAT or CONTROL or CONTROL_NEW command: consider them an ACK
-            self.debug(f"ACK received for command {real_cmd}: ignoring: {msg.seqno}")
+            self.debug("ACK received for command %s: ignoring: %s", real_cmd, msg.seqno)
             return None
         payload = self._decode_payload(msg.payload)
 
@@ -833,9 +1038,28 @@ class TuyaProtocol(asyncio.Protocol, ContextualLogger):
     async def reset(self, dpIds=None, cid=None):
         """Send a reset message (3.3 only)."""
         if self.version == 3.3:
-            self.dev_type = "type_0a"
-            self.debug("reset switching to dev_type %s", self.dev_type)
-            return await self.exchange(CMDType.UPDATEDPS, dpIds, nodeID=cid)
+            # Known type_0d devices don't need the dev_type detection again.
+            if self.quirks.get(QUIRK_DEV_TYPE) != "type_0d":
+                self.dev_type = "type_0a"
+                self.debug("reset switching to dev_type %s", self.dev_type)
+
+            if self.quirks.get(QUIRK_NO_UPDATEDPS_REPLY):
+                return await self.exchange(
+                    CMDType.UPDATEDPS, dpIds, nodeID=cid, wait=False
+                )
+
+            try:
+                result = await self.exchange(CMDType.UPDATEDPS, dpIds, nodeID=cid)
+            except TimeoutError:
+                # A lost packet or a busy device is not enough to stop waiting.
+                if self.is_connected:
+                    timeouts = self.quirks.get(QUIRK_UPDATEDPS_TIMEOUTS, 0) + 1
+                    self.quirks[QUIRK_UPDATEDPS_TIMEOUTS] = timeouts
+                    if timeouts >= NO_UPDATEDPS_REPLY_TIMEOUTS:
+                        self._learn_quirk(QUIRK_NO_UPDATEDPS_REPLY, True)
+                raise
+            self.quirks.pop(QUIRK_UPDATEDPS_TIMEOUTS, None)
+            return result
 
         return True
 
@@ -917,6 +1141,23 @@ class TuyaProtocol(asyncio.Protocol, ContextualLogger):
 
         return self.dps_cache.get(cid or "parent", {})
 
+    async def confirm_dps(self, dps: list[str], dev_type: str = None, cid=None):
+        """Return the status if the device reports all the dps, detected on the same product.
+
+        A single query replaces the detection of the available dps.
+        """
+        if self.version == 3.3 and dev_type:
+            self.dev_type = dev_type
+        self.dps_to_request = {"1": None}
+        self.add_dps_to_request(dps)
+
+        status = await self.status(cid=cid)
+        if not set(dps).issubset(status):
+            self.debug("Device doesn't report the known dps %s: %s", dps, status)
+            return {}
+
+        return status
+
     def add_dps_to_request(self, dp_indicies):
         """Add a datapoint (DP) to be included in requests."""
         if isinstance(dp_indicies, int):
@@ -925,7 +1166,7 @@ class TuyaProtocol(asyncio.Protocol, ContextualLogger):
             self.dps_to_request.update({str(index): None for index in dp_indicies})
 
     def _decode_payload(self, payload):
-        cipher = AESCipher(self.local_key)
+        cipher = self.crypto.cipher
 
         if self.version == 3.4:
             # 3.4 devices encrypt the version header in addition to the payload
@@ -986,6 +1227,7 @@ class TuyaProtocol(asyncio.Protocol, ContextualLogger):
                         "'data unvalid' error detected: switching to dev_type %r",
                         self.dev_type,
                     )
+                    self._learn_quirk(QUIRK_DEV_TYPE, self.dev_type)
                 return None
         elif not payload.startswith(b"{"):
             self.debug("Unexpected payload=%r", payload)
@@ -1025,8 +1267,7 @@ class TuyaProtocol(asyncio.Protocol, ContextualLogger):
 
     async def _negotiate_session_key(self):
         self.remote_nonce = b""
-        self.local_key = self.real_local_key
-        self.dispatcher.local_key = self.real_local_key
+        self._set_session_key(self.real_local_key)
 
         rkey = None
         try:
@@ -1054,7 +1295,7 @@ class TuyaProtocol(asyncio.Protocol, ContextualLogger):
         if self.version == 3.4:
             try:
                 # self.debug("decrypting %r using %r", payload, self.real_local_key)
-                cipher = AESCipher(self.real_local_key)
+                cipher = self.real_crypto.cipher
                 payload = cipher.decrypt(payload, False, decode_text=False)
             except Exception as ex:
                 self.debug(
@@ -1072,7 +1313,7 @@ class TuyaProtocol(asyncio.Protocol, ContextualLogger):
             return False
 
         self.remote_nonce = payload[:16]
-        hmac_check = hmac.new(self.local_key, self.local_nonce, sha256).digest()
+        hmac_check = self.real_crypto.hmac_digest(self.local_nonce)
 
         if hmac_check != payload[16:48]:
             self.debug(
@@ -1082,40 +1323,40 @@ class TuyaProtocol(asyncio.Protocol, ContextualLogger):
             )
 
         # self.debug("session local nonce: %r remote nonce: %r", self.local_nonce, self.remote_nonce)
-        rkey_hmac = hmac.new(self.local_key, self.remote_nonce, sha256).digest()
+        rkey_hmac = self.real_crypto.hmac_digest(self.remote_nonce)
         await self.exchange_quick(
             MessagePayload(CMDType.SESS_KEY_NEG_FINISH, rkey_hmac), None
         )
 
-        self.local_key = bytes(
-            [a ^ b for (a, b) in zip(self.local_nonce, self.remote_nonce)]
+        session_key = derive_session_key(
+            self.real_crypto, self.version, self.local_nonce, self.remote_nonce
         )
-        # self.debug("Session nonce XOR'd: %r" % self.local_key)
-
-        cipher = AESCipher(self.real_local_key)
-        if self.version == 3.4:
-            self.local_key = self.dispatcher.local_key = cipher.encrypt(
-                self.local_key, False, pad=False
-            )
-        else:
-            iv = self.local_nonce[:12]
-            self.debug("Session IV: %r", iv)
-            self.local_key = self.dispatcher.local_key = cipher.encrypt(
-                self.local_key, use_base64=False, pad=False, iv=iv
-            )[12:28]
+        self._set_session_key(session_key)
 
         self.debug("Session key negotiate success! session key: %r", self.local_key)
         return True
 
+    def _set_session_key(self, key: bytes):
+        """Switch the key used for frames and (re)build its crypto context if needed."""
+        self.local_key = key
+        if key == self.real_local_key:
+            self.crypto = self.real_crypto
+        elif key != self.crypto.key:
+            self.crypto = SessionCrypto(key)
+        self.dispatcher.crypto = self.crypto
+        # The keys are never recorded, the trace may be shared.
+        local = key == self.real_local_key
+        self.trace.record(TRACE_KEY, TRACE_LOCAL_KEY if local else TRACE_SESSION_KEY)
+
     # adds protocol header (if needed) and encrypts
     def _encode_message(self, msg: MessagePayload):
         hmac_key = None
         iv = None
         payload = msg.payload
-        self.cipher = AESCipher(self.local_key)
+        cipher = self.crypto.cipher
 
         if self.version >= 3.4:
-            hmac_key = self.local_key
+            hmac_key = self.crypto
             if msg.cmd not in NO_PROTOCOL_HEADER_CMDS:
                 # add the 3.x header
                 payload = self.version_header + payload
@@ -1135,20 +1376,21 @@ class TuyaProtocol(asyncio.Protocol, ContextualLogger):
                     True,
                 )
                 self.seqno += 1  # increase message sequence number
-                data = parser.pack_message(msg, hmac_key=self.local_key)
-                self.debug("payload encrypted=%r", binascii.hexlify(data))
+                data = parser.pack_message(msg, hmac_key=self.crypto)
+                if self.debug_enabled:
+                    self.debug("payload encrypted=%r", binascii.hexlify(data))
                 return data
 
-            payload = self.cipher.encrypt(payload, False)
+            payload = cipher.encrypt(payload, False)
         elif self.version >= 3.2:
             # expect to connect and then disconnect to set new
-            payload = self.cipher.encrypt(payload, False)
+            payload = cipher.encrypt(payload, False)
             if msg.cmd not in NO_PROTOCOL_HEADER_CMDS:
                 # add the 3.x header
                 payload = self.version_header + payload
         elif msg.cmd == CMDType.CONTROL:
             # need to encrypt
-            payload = self.cipher.encrypt(payload)
+            payload = cipher.encrypt(payload)
             preMd5String = (
                 b"data="
                 + payload
@@ -1167,7 +1409,6 @@ class TuyaProtocol(asyncio.Protocol, ContextualLogger):
                 + payload
             )
 
-        self.cipher = None
         msg = TuyaMessage(
             self.seqno, msg.cmd, 0, payload, 0, True, Affix.prefix_55aa.value, False
         )
@@ -1200,43 +1441,11 @@ class TuyaProtocol(asyncio.Protocol, ContextualLogger):
             rawData (str, optional): Overrides the 'data' field in the payload.
             reqType (str, optional): Request type, used for gateway-level commands.
         """
-        json_data = command_override = None
-
-        # Create a deep copy of payload_dict. otherwise, the original references will be overwritten
-        def deepcopy_dict(_dict: dict):
-            output = _dict.copy()
-            for key, value in output.items():
-                output[key] = deepcopy_dict(value) if isinstance(value, dict) else value
-            return output
-
-        payloads = deepcopy_dict(payload_dict)
-
-        if command in payloads[self.dev_type]:
-            if "command" in payloads[self.dev_type][command]:
-                json_data = payloads[self.dev_type][command]["command"].copy()
-            if "command_override" in payloads[self.dev_type][command]:
-                command_override = payloads[self.dev_type][command]["command_override"]
-
-        if self.dev_type != "type_0a":
-            if (
-                json_data is None
-                and command in payloads["type_0a"]
-                and "command" in payloads["type_0a"][command]
-            ):
-                json_data = payloads["type_0a"][command]["command"].copy()
-            if (
-                command_override is None
-                and command in payloads["type_0a"]
-                and "command_override" in payloads["type_0a"][command]
-            ):
-                command_override = payloads["type_0a"][command]["command_override"]
-
-        if command_override is None:
-            command_override = command
-        if json_data is None:
-            # I have yet to see a device complain about included but unneeded attribs, but they *will*
-            # complain about missing attribs, so just include them all unless otherwise specified
-            json_data = {"gwId": "", "devId": "", "uid": "", "t": "", "cid": ""}
+        template = get_payload_template(self.dev_type, command)
+        # Only the nested "data" needs its own copy, the rest of values are replaced.
+        json_data = template.json_data.copy()
+        if isinstance(json_data.get("data"), dict):
+            json_data["data"] = json_data["data"].copy()
 
         if "gwId" in json_data:
             json_data["gwId"] = gwId if gwId is not None else self.id
@@ -1276,10 +1485,14 @@ class TuyaProtocol(asyncio.Protocol, ContextualLogger):
             t = time.time()
             json_data["uid"] = int(t) if json_data["t"] == "int" else str(int(t))
 
-        payload = json.dumps(json_data, separators=(",", ":")) if json_data else ""
+        payload = PAYLOAD_ENCODER.encode(json_data) if json_data else ""
 
         self.debug("Sending payload: %s", payload)
-        return MessagePayload(command_override, payload.encode())
+        return MessagePayload(template.cmd, payload.encode())
+
+    async def dump_trace(self) -> bytes:
+        """Return the frames trace file of the connection."""
+        return self.trace.dump(self.id, self.version)
 
     def enable_debug(self, enable=False, friendly_name=None):
         """Enable the debug logs for the device."""
@@ -1309,6 +1522,9 @@ async def connect(
     listener=None,
     port=6668,
     timeout=TIMEOUT_CONNECT,
+    pacer: WritePacer = None,
+    quirks: dict = None,
+    trace: FrameTrace = None,
 ):
     """Connect to a device."""
     loop = asyncio.get_running_loop()
@@ -1321,6 +1537,9 @@ async def connect(
                     protocol_version,
                     enable_debug,
                     listener or EmptyListener(),
+                    pacer,
+                    quirks,
+                    trace,
                 ),
                 address,
                 port,
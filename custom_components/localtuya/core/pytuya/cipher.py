@@ -2,9 +2,12 @@
 
 import logging
 import base64
+import hmac
 import time
+from hashlib import sha256
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -16,7 +19,9 @@ class AESCipher:
         """Initialize a new AESCipher."""
         self.block_size = 16
         self.key = key
-        self.cipher = Cipher(algorithms.AES(key), modes.ECB(), default_backend())
+        self.algorithm = algorithms.AES(key)
+        self.cipher = Cipher(self.algorithm, modes.ECB(), default_backend())
+        self.aesgcm = AESGCM(key)
 
     def encrypt(self, raw, use_base64=True, pad=True, iv=False, header=None):
         """Encrypt data to be sent to device."""
@@ -26,11 +31,8 @@ class AESCipher:
                     iv = b"0123456789ab"
                 else:
                     iv = str(time.time() * 10)[:12].encode("utf8")
-            encryptor = Cipher(algorithms.AES(self.key), modes.GCM(iv)).encryptor()
-            if header:
-                encryptor.authenticate_additional_data(header)
-            crypted_text = encryptor.update(raw) + encryptor.finalize()
-            crypted_text = iv + crypted_text + encryptor.tag
+            # AESGCM appends the tag to the cipher text.
+            crypted_text = iv + self.aesgcm.encrypt(iv, raw, header or None)
         else:
             encryptor = self.cipher.encryptor()
             if pad:
@@ -52,15 +54,11 @@ class AESCipher:
                 enc = enc[12:]
             if tag is None:
                 decryptor = Cipher(
-                    algorithms.AES(self.key), modes.CTR(iv + b"\x00\x00\x00\x02")
+                    self.algorithm, modes.CTR(iv + b"\x00\x00\x00\x02")
                 ).decryptor()
+                raw = decryptor.update(enc) + decryptor.finalize()
             else:
-                decryptor = Cipher(
-                    algorithms.AES(self.key), modes.GCM(iv, tag)
-                ).decryptor()
-            if header and (tag is not None):
-                decryptor.authenticate_additional_data(header)
-            raw = decryptor.update(enc) + decryptor.finalize()
+                raw = self.aesgcm.decrypt(iv, bytes(enc) + tag, header or None)
         else:
             decryptor = self.cipher.decryptor()
             raw = decryptor.update(enc) + decryptor.finalize()
@@ -75,3 +73,19 @@ class AESCipher:
     @staticmethod
     def _unpad(data):
         return data[: -ord(data[len(data) - 1 :])]
+
+
+class SessionCrypto:
+    """Crypto context of a device session, built once per key and reused by every frame."""
+
+    def __init__(self, key: bytes):
+        """Initialize a new SessionCrypto."""
+        self.key = key
+        self.cipher = AESCipher(key)
+        self._hmac = hmac.new(key, digestmod=sha256)
+
+    def hmac_digest(self, data) -> bytes:
+        """Return the HMAC-SHA256 digest of data using the pre-keyed template."""
+        digest = self._hmac.copy()
+        digest.update(data)
+        return digest.digest()
@@ -55,6 +55,13 @@ class MessagePayload:
     payload: bytes
 
 
+@dataclass(frozen=True)
+class PayloadTemplate:
+    # Resolved command to send and the JSON payload skeleton of a (dev_type, command).
+    cmd: int
+    json_data: dict
+
+
 @dataclass
 class TuyaMessage:
     # MessagePayload = namedtuple("MessagePayload", "cmd payload")
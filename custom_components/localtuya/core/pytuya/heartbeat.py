@@ -0,0 +1,142 @@
+"""Shared heartbeat scheduling for Tuya connections."""
+
+import asyncio
+import random
+import time
+import weakref
+from typing import Callable
+
+HEARTBEAT_INTERVAL = 8.3
+# Heartbeat deadlines are spread randomly by this fraction of the interval.
+HEARTBEAT_JITTER = 0.1
+# Devices drop connections that stay silent for a while, so a heartbeat is never
+# skipped when nothing else was sent to the device within this time.
+HEARTBEAT_MAX_IDLE = HEARTBEAT_INTERVAL * 2
+# Number of slots in the wheel, each slot covers interval / slots seconds.
+HEARTBEAT_WHEEL_SLOTS = 32
+
+_WHEELS: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, HeartbeatWheel]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+class HeartbeatTimer:
+    """A heartbeat deadline owned by a HeartbeatWheel."""
+
+    __slots__ = ("callback", "deadline", "slot")
+
+    def __init__(self, callback: Callable[[], None]):
+        """Initialize a new HeartbeatTimer."""
+        self.callback = callback
+        self.deadline: float = 0
+        self.slot: set | None = None
+
+    @property
+    def scheduled(self) -> bool:
+        return self.slot is not None
+
+
+class HeartbeatWheel:
+    """Hashed timer wheel firing the heartbeats of all connections of a loop.
+
+    Timers are hashed into slots by their deadline, a single loop callback walks
+    the slots every tick and runs the callbacks of the expired timers.
+    Deadlines get a random jitter so connections made at the same time don't send
+    their heartbeats in bursts. The wheel stops ticking while it is empty.
+    """
+
+    def __init__(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        interval: float = HEARTBEAT_INTERVAL,
+        slots: int = HEARTBEAT_WHEEL_SLOTS,
+        jitter: float = HEARTBEAT_JITTER,
+    ):
+        """Initialize a new HeartbeatWheel."""
+        self.loop = loop
+        self.interval = interval
+        self.jitter = jitter
+        self.tick = interval / slots
+        self._slots: list[set[HeartbeatTimer]] = [set() for _ in range(slots)]
+        self._count = 0
+        self._tick_index = 0
+        self._handle: asyncio.TimerHandle | None = None
+        self._firing = False
+
+    def __len__(self):
+        return self._count
+
+    def schedule(self, timer: HeartbeatTimer, delay: float = None):
+        """(Re)schedule the timer to fire after delay, defaults to one interval."""
+        self.cancel(timer)
+        delay = self.interval if delay is None else delay
+        delay += random.uniform(-self.jitter, self.jitter) * self.interval
+
+        now = time.monotonic()
+        if self._handle is None and not self._firing:
+            # The wheel was idle, restart walking the slots from now.
+            self._tick_index = int(now / self.tick)
+            self._schedule_tick()
+
+        timer.deadline = now + max(0, delay)
+        # Never place a timer in the slot being processed or already passed.
+        index = max(int(timer.deadline / self.tick), self._tick_index)
+        timer.slot = self._slots[index % len(self._slots)]
+        timer.slot.add(timer)
+        self._count += 1
+
+    def cancel(self, timer: HeartbeatTimer):
+        """Remove the timer from the wheel."""
+        if timer.slot is not None:
+            timer.slot.discard(timer)
+            timer.slot = None
+            self._count -= 1
+
+        if self._count == 0 and self._handle is not None and not self._firing:
+            self._handle.cancel()
+            self._handle = None
+
+    def _schedule_tick(self):
+        # Wake up once the time window of the next slot is over.
+        delay = (self._tick_index + 1) * self.tick - time.monotonic()
+        self._handle = self.loop.call_later(max(0, delay), self._on_tick)
+
+    def _on_tick(self):
+        """Fire the expired timers of the slots passed since the last tick."""
+        self._handle = None
+        now = time.monotonic()
+        # Last slot with a time window entirely in the past.
+        current = int(now / self.tick) - 1
+        # A stalled loop can skip ticks, but one round covers all the slots.
+        first = max(self._tick_index, current - len(self._slots) + 1)
+
+        expired: list[HeartbeatTimer] = []
+        for index in range(first, current + 1):
+            slot = self._slots[index % len(self._slots)]
+            # Timers with a deadline in a later round stay in the slot.
+            expired.extend(timer for timer in slot if timer.deadline <= now)
+        self._tick_index = current + 1
+
+        self._firing = True
+        try:
+            for timer in expired:
+                self.cancel(timer)
+            for timer in expired:
+                try:
+                    timer.callback()
+                except Exception as ex:  # pylint: disable=broad-except
+                    self.loop.call_exception_handler(
+                        {"message": "Heartbeat callback failed", "exception": ex}
+                    )
+        finally:
+            self._firing = False
+
+        if self._count:
+            self._schedule_tick()
+
+
+def get_heartbeat_wheel(loop: asyncio.AbstractEventLoop) -> HeartbeatWheel:
+    """Return the heartbeat wheel shared by the connections of the loop."""
+    if (wheel := _WHEELS.get(loop)) is None:
+        wheel = _WHEELS[loop] = HeartbeatWheel(loop)
+    return wheel
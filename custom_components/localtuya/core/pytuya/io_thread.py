@@ -0,0 +1,322 @@
+"""Run the Tuya connections on an event loop in a dedicated thread."""
+
+import asyncio
+import logging
+import threading
+import weakref
+from collections.abc import Coroutine, Mapping
+from typing import Any, Callable
+
+from . import QUIRK_DEV_TYPE, SubdeviceState, TuyaListener, TuyaProtocol, connect
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class TuyaIOThread:
+    """Event loop thread owning the sockets, the frames parsing and the heartbeats.
+
+    Listener callbacks are queued and handed to the caller loop in batches, one
+    wake up of the caller loop runs all the callbacks queued since the last batch.
+    Commands are sent to the thread loop and awaited through thread-safe futures.
+    """
+
+    def __init__(self, name: str = "localtuya_io"):
+        """Initialize a new TuyaIOThread."""
+        self.name = name
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self._thread: threading.Thread | None = None
+        self._target_loop: asyncio.AbstractEventLoop | None = None
+        self._lock = threading.Lock()
+        self._pending: list[tuple[Callable, tuple]] = []
+
+    @property
+    def is_running(self) -> bool:
+        return self.loop is not None and self.loop.is_running()
+
+    def start(self):
+        """Start the thread loop, callbacks will be called on the running loop."""
+        if self._thread is not None:
+            return
+
+        self._target_loop = asyncio.get_running_loop()
+        self.loop = asyncio.new_event_loop()
+        started = threading.Event()
+        self.loop.call_soon(started.set)
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+        started.wait()
+
+    def stop(self):
+        """Stop the thread loop, the open connections are aborted."""
+        if self.is_running:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread = None
+
+    def _run(self):
+        loop = self.loop
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_forever()
+            tasks = asyncio.all_tasks(loop)
+            for task in tasks:
+                task.cancel()
+            loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        finally:
+            loop.close()
+
+    async def run(self, coro: Coroutine):
+        """Run the coroutine on the thread loop and return its result."""
+        if not self.is_running:
+            coro.close()
+            raise ConnectionError(f"{self.name} thread is not running")
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        return await asyncio.wrap_future(future)
+
+    def call_soon(self, callback: Callable, *args):
+        """Call a function on the thread loop."""
+        if self.is_running:
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    def post(self, callback: Callable, *args):
+        """Queue a callback to run on the caller loop with the next batch."""
+        with self._lock:
+            schedule = not self._pending
+            self._pending.append((callback, args))
+        if schedule:
+            self._target_loop.call_soon_threadsafe(self._run_pending)
+
+    def _run_pending(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+        for callback, args in pending:
+            try:
+                callback(*args)
+            except Exception:  # pylint: disable=broad-except
+                _LOGGER.exception("Failed to run callback %s", callback)
+
+    async def connect(
+        self,
+        address: str,
+        device_id: str,
+        local_key: str,
+        protocol_version: float,
+        enable_debug: bool,
+        listener: TuyaListener,
+        **kwargs,
+    ) -> "ThreadedProtocol":
+        """Connect to a device from the thread loop."""
+        protocol = ThreadedProtocol(self, listener, kwargs.get("quirks"))
+        # The protocol learns the quirks on the thread loop, the listener dict is
+        # updated on the caller loop.
+        kwargs["quirks"] = dict(protocol.quirks)
+
+        async def _connect():
+            protocol.protocol = await connect(
+                address,
+                device_id,
+                local_key,
+                protocol_version,
+                enable_debug,
+                protocol.listener,
+                **kwargs,
+            )
+
+        await self.run(_connect())
+        protocol.dev_type = protocol.protocol.dev_type
+        return protocol
+
+
+class ThreadedProtocol:
+    """TuyaProtocol running on a TuyaIOThread, used from the caller loop."""
+
+    def __init__(
+        self, io_thread: TuyaIOThread, listener: TuyaListener, quirks: dict = None
+    ):
+        """Initialize a new ThreadedProtocol."""
+        self.io_thread = io_thread
+        self.protocol: TuyaProtocol | None = None
+        # The quirks dict of the listener, only changed on the caller loop.
+        self.quirks = {} if quirks is None else quirks
+        # The dev_type of the protocol, updated with the results of the DPS queries.
+        self.dev_type: str | None = None
+        # The payload of the status being dispatched, see TuyaProtocol.dispatched_dps.
+        self.dispatched_dps: dict = {}
+        # TuyaProtocol keeps a weak reference on its listener.
+        self.listener = ThreadSafeListener(self, listener)
+
+    @property
+    def id(self) -> str:
+        return self.protocol.id
+
+    @property
+    def version(self) -> float:
+        return self.protocol.version
+
+    @property
+    def is_connected(self) -> bool:
+        return (
+            self.protocol is not None
+            and self.io_thread.is_running
+            and bool(self.protocol.is_connected)
+        )
+
+    def enable_debug(self, enable=False, friendly_name=None):
+        self.io_thread.call_soon(self.protocol.enable_debug, enable, friendly_name)
+
+    def add_dps_to_request(self, dp_indicies):
+        self.io_thread.call_soon(self.protocol.add_dps_to_request, dp_indicies)
+
+    def set_updatedps_list(self, update_list):
+        self.io_thread.call_soon(self.protocol.set_updatedps_list, update_list)
+
+    def keep_alive(self, is_gateway: bool = False):
+        # Called once a device or sub-device connected, the sub-devices may have changed.
+        self.listener.sub_devices.refresh()
+        self.io_thread.call_soon(self.protocol.keep_alive, is_gateway)
+
+    async def _run_query(self, coro: Coroutine, copy=True):
+        """Run a DPS query, the queries may switch the protocol dev_type."""
+
+        async def _query():
+            result = await coro
+            # The DPS are the protocol cache, copy them before they leave the thread.
+            return dict(result) if copy else result, self.protocol.dev_type
+
+        result, self.dev_type = await self.io_thread.run(_query())
+        return result
+
+    async def status(self, cid=None) -> dict:
+        return await self._run_query(self.protocol.status(cid=cid))
+
+    async def detect_available_dps(self, cid=None) -> dict:
+        return await self._run_query(self.protocol.detect_available_dps(cid=cid))
+
+    async def confirm_dps(self, dps: list[str], dev_type: str = None, cid=None):
+        return await self._run_query(self.protocol.confirm_dps(dps, dev_type, cid=cid))
+
+    async def reset(self, dpIds=None, cid=None):
+        return await self._run_query(self.protocol.reset(dpIds, cid=cid), copy=False)
+
+    async def update_dps(self, dps=None, cid=None):
+        return await self.io_thread.run(self.protocol.update_dps(dps, cid=cid))
+
+    async def set_dps(self, dps, cid=None):
+        return await self.io_thread.run(self.protocol.set_dps(dps, cid=cid))
+
+    async def dump_trace(self) -> bytes:
+        return await self.io_thread.run(self.protocol.dump_trace())
+
+    async def close(self):
+        if self.io_thread.is_running:
+            await self.io_thread.run(self.protocol.close())
+
+    def __repr__(self):
+        """Return internal string representation of object."""
+        return repr(self.protocol)
+
+
+class ThreadSafeListener(TuyaListener):
+    """Listener called on the thread loop, forwarding the events to the caller loop."""
+
+    def __init__(
+        self,
+        protocol: ThreadedProtocol,
+        listener: TuyaListener,
+        parent: "ThreadSafeListener" = None,
+        cid: str = None,
+    ):
+        """Initialize a new ThreadSafeListener."""
+        self._protocol = protocol
+        self._listener = weakref.ref(listener)
+        self._parent = parent
+        self._cid = cid
+        self._sub_listeners: dict[str, ThreadSafeListener] = {}
+        self.sub_devices = _SubDevicesListeners(self)
+        if parent is None:
+            self.sub_devices.refresh()
+
+    def _get_listener(self) -> TuyaListener | None:
+        """Return the listener, called on the caller loop."""
+        listener = self._listener()
+        if listener is not None and self._parent is not None:
+            # The sub-device may have been removed since the event was queued.
+            parent = self._parent._listener()
+            if parent is None or parent.sub_devices.get(self._cid) is not listener:
+                return None
+        return listener
+
+    def _post(self, name: str, *args):
+        self._protocol.io_thread.post(self._call, name, args)
+
+    def _call(self, name: str, args: tuple):
+        if (listener := self._get_listener()) is not None:
+            getattr(listener, name)(*args)
+
+    def status_updated(self, status):
+        """Device updated status."""
+        # Both dicts keep changing on the thread loop.
+        dispatched_dps = dict(self._protocol.protocol.dispatched_dps)
+        self._protocol.io_thread.post(
+            self._status_updated, dict(status), dispatched_dps
+        )
+
+    def _status_updated(self, status: dict, dispatched_dps: dict):
+        if (listener := self._get_listener()) is not None:
+            self._protocol.dispatched_dps = dispatched_dps
+            listener.status_updated(status)
+
+    def disconnected(self, exc=""):
+        """Device disconnected."""
+        self._post("disconnected", exc)
+
+    def subdevice_state_updated(self, state: SubdeviceState):
+        """Device is offline or online."""
+        self._post("subdevice_state_updated", state)
+
+    def quirks_updated(self, quirks: dict):
+        """Device learned new protocol quirks."""
+        # The dict keeps changing on the thread loop.
+        self._protocol.io_thread.post(self._quirks_updated, dict(quirks))
+
+    def _quirks_updated(self, quirks: dict):
+        # Keep updating the dict the listener persists.
+        protocol = self._protocol
+        protocol.quirks.update(quirks)
+        if dev_type := quirks.get(QUIRK_DEV_TYPE):
+            protocol.dev_type = dev_type
+        if (listener := self._get_listener()) is not None:
+            listener.quirks_updated(protocol.quirks)
+
+
+class _SubDevicesListeners(Mapping):
+    """The sub-devices of a listener, wrapped in thread-safe listeners.
+
+    Read on the thread loop from a snapshot of the listener sub-devices, the
+    snapshot is refreshed on the caller loop.
+    """
+
+    def __init__(self, parent: ThreadSafeListener):
+        self._parent = parent
+        self._devices: dict[str, Any] = {}
+
+    def refresh(self):
+        """Take a new snapshot of the sub-devices, called on the caller loop."""
+        if (listener := self._parent._listener()) is not None:
+            self._devices = dict(listener.sub_devices)
+
+    def __getitem__(self, cid: str) -> ThreadSafeListener:
+        device = self._devices[cid]
+        listeners = self._parent._sub_listeners
+        sub_listener = listeners.get(cid)
+        if sub_listener is None or sub_listener._listener() is not device:
+            sub_listener = ThreadSafeListener(
+                self._parent._protocol, device, self._parent, cid
+            )
+            listeners[cid] = sub_listener
+        return sub_listener
+
+    def __iter__(self):
+        return iter(self._devices)
+
+    def __len__(self):
+        return len(self._devices)
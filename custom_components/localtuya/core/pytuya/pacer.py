@@ -0,0 +1,58 @@
+"""Write pacing for Tuya connections."""
+
+import time
+
+# Default gap between frames and the number of frames that can be sent back to back.
+WRITE_INTERVAL = 0.050
+WRITE_BURST = 4
+# Bounds of the learned gap between frames.
+WRITE_INTERVAL_MIN = 0.010
+WRITE_INTERVAL_MAX = 0.500
+# Replies slower than this are considered as a sign of an overloaded device.
+SLOW_REPLY = 1.0
+
+
+class WritePacer:
+    """Token bucket pacing the frames written to a device.
+
+    Each frame takes a token, tokens are refilled every `interval` seconds up to `burst`.
+    When the bucket is empty the frame is delayed until its token is refilled.
+    The interval shrinks while the device replies quickly, and it backs off when
+    the device is slow, stops replying or drops the connection.
+    """
+
+    def __init__(
+        self,
+        interval: float = WRITE_INTERVAL,
+        burst: int = WRITE_BURST,
+        min_interval: float = WRITE_INTERVAL_MIN,
+        max_interval: float = WRITE_INTERVAL_MAX,
+    ):
+        """Initialize a new WritePacer."""
+        self.interval = interval
+        self.burst = burst
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.tokens = float(burst)
+        self._last_refill = time.monotonic()
+
+    def reserve(self) -> float:
+        """Take a token for a frame and return the seconds to wait before sending it."""
+        now = time.monotonic()
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        self.tokens = min(self.burst, self.tokens + elapsed / self.interval) - 1
+        # Negative tokens are frames already waiting for a refill.
+        return -self.tokens * self.interval if self.tokens < 0 else 0
+
+    def acknowledged(self, reply_time: float):
+        """Adapt the interval to the time the device took to reply to a frame."""
+        if reply_time > SLOW_REPLY:
+            self.interval = min(self.max_interval, self.interval * 1.5)
+        else:
+            self.interval = max(self.min_interval, self.interval * 0.9)
+
+    def backoff(self):
+        """Slow down after the device dropped a frame or the connection."""
+        self.interval = min(self.max_interval, self.interval * 2)
+        self.tokens = min(self.tokens, 0)
@@ -2,16 +2,22 @@
 
 import logging
 import struct
-import hmac
 import binascii
 from hashlib import md5, sha256
 from .const import Affix, MessagesFormat, TuyaHeader, TuyaMessage
-from .cipher import AESCipher
+from .cipher import SessionCrypto
 
 _LOGGER = logging.getLogger(__name__)
 
 
-def pack_message(msg: TuyaMessage, hmac_key: bytes = None):
+def session_crypto(hmac_key: bytes | SessionCrypto) -> SessionCrypto:
+    """Return the crypto context of hmac_key, building it if a raw key was given."""
+    if isinstance(hmac_key, SessionCrypto):
+        return hmac_key
+    return SessionCrypto(hmac_key)
+
+
+def pack_message(msg: TuyaMessage, hmac_key: bytes | SessionCrypto = None):
     """Pack a TuyaMessage into bytes."""
     if msg.prefix == Affix.prefix_55aa.value:
         header_fmt = MessagesFormat.HEADER_55AA
@@ -36,7 +42,7 @@ def pack_message(msg: TuyaMessage, hmac_key: bytes = None):
     data = struct.pack(header_fmt, *header_data)
 
     if msg.prefix == Affix.prefix_6699.value:
-        cipher = AESCipher(hmac_key)
+        cipher = session_crypto(hmac_key).cipher
         if type(msg.retcode) == int:
             raw = struct.pack(MessagesFormat.RETCODE, msg.retcode) + msg.payload
         else:
@@ -52,7 +58,7 @@ def pack_message(msg: TuyaMessage, hmac_key: bytes = None):
     else:
         data += msg.payload
         if hmac_key:
-            crc = hmac.new(hmac_key, data, sha256).digest()
+            crc = session_crypto(hmac_key).hmac_digest(data)
         else:
             crc = binascii.crc32(data) & 0xFFFFFFFF
         # Calculate CRC, add it together with suffix
@@ -62,7 +68,11 @@ def pack_message(msg: TuyaMessage, hmac_key: bytes = None):
 
 
 def unpack_message(
-    data: bytes, hmac_key=None, header=None, no_retcode=False, logger=_LOGGER
+    data: bytes,
+    hmac_key: bytes | SessionCrypto = None,
+    header=None,
+    no_retcode=False,
+    logger=_LOGGER,
 ):
     """Unpack bytes into a TuyaMessage."""
     if header is None:
@@ -109,9 +119,9 @@ def unpack_message(
 
     if header.prefix == Affix.prefix_55aa.value:
         if hmac_key:
-            have_crc = hmac.new(
-                hmac_key, data[: (header_len + header.length) - end_len], sha256
-            ).digest()
+            have_crc = session_crypto(hmac_key).hmac_digest(
+                data[: (header_len + header.length) - end_len]
+            )
         else:
             have_crc = (
                 binascii.crc32(data[: (header_len + header.length) - end_len])
@@ -138,7 +148,7 @@ def unpack_message(
         iv = payload[:12]
         payload = payload[12:]
         try:
-            cipher = AESCipher(hmac_key)
+            cipher = session_crypto(hmac_key).cipher
             payload = cipher.decrypt(
                 payload,
                 use_base64=False,
@@ -0,0 +1,171 @@
+"""Replay the frames trace of a Tuya connection.
+
+    python -m custom_components.localtuya.core.pytuya.replay FILE [--local-key KEY]
+
+FILE is a trace dumped by the `localtuya.dump_trace` service or the diagnostics of
+a device with debug enabled.
+The received data is fed to a MessageDispatcher, the payloads are decrypted with
+the local key when given. The trace doesn't hold the session keys of 3.4 and 3.5
+devices, they are derived from the negotiation frames and the local key.
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import logging
+from typing import NamedTuple
+
+from . import (
+    EmptyListener,
+    MessageDispatcher,
+    TuyaProtocol,
+    derive_session_key,
+    parser,
+)
+from .cipher import SessionCrypto
+from .const import CMDType, TuyaMessage
+from .trace import (
+    TRACE_IN,
+    TRACE_KEY,
+    TRACE_LOCAL_KEY,
+    TRACE_MAGIC,
+    TRACE_OUT,
+    read_trace,
+)
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class ReplayedFrame(NamedTuple):
+    direction: int
+    time: float
+    msg: TuyaMessage
+    # The session key of the frame, None for the local key.
+    key: bytes | None
+
+
+class _ReplayDispatcher(MessageDispatcher):
+    """Dispatcher reporting every received message."""
+
+    def __init__(self, dev_id, protocol_version, on_message):
+        super().__init__(dev_id, lambda *_, **__: None, protocol_version, None)
+        self._on_message = on_message
+
+    def _dispatch(self, msg: TuyaMessage):
+        self._on_message(msg)
+        super()._dispatch(msg)
+
+
+def replay(
+    data: bytes,
+    local_key: bytes | None = None,
+    dispatcher: MessageDispatcher | None = None,
+) -> list[ReplayedFrame]:
+    """Feed the received data of a trace to a dispatcher and return the frames.
+
+    The sent frames are unpacked too. Without the local key, the frames of 3.4 and
+    3.5 devices fail the checksum. The session keys are derived from the nonces of
+    the negotiation frames, when the trace still holds them.
+    """
+    meta, records = read_trace(data)
+    version = float(meta["version"])
+    local_crypto = SessionCrypto(local_key or bytes(16))
+    frames: list[ReplayedFrame] = []
+    record_time, key = 0.0, None
+    nonces: dict[CMDType, bytes] = {}
+
+    def _on_message(msg: TuyaMessage):
+        if msg.cmd == CMDType.SESS_KEY_NEG_RESP:
+            nonces[msg.cmd] = msg.payload
+        frames.append(ReplayedFrame(TRACE_IN, record_time, msg, key))
+
+    def _session_key() -> bytes | None:
+        if not local_key or len(nonces) != 2:
+            return None
+        local_nonce = nonces[CMDType.SESS_KEY_NEG_START]
+        remote_nonce = nonces[CMDType.SESS_KEY_NEG_RESP]
+        if version == 3.4:
+            cipher = local_crypto.cipher
+            local_nonce = cipher.decrypt(local_nonce, False, decode_text=False)
+            remote_nonce = cipher.decrypt(remote_nonce, False, decode_text=False)
+        return derive_session_key(local_crypto, version, local_nonce, remote_nonce[:16])
+
+    if dispatcher is None:
+        dispatcher = _ReplayDispatcher(meta["device_id"], version, _on_message)
+        dispatcher.set_logger(_LOGGER, meta["device_id"])
+    dispatcher.crypto = local_crypto
+
+    for direction, record_time, record_data in records:
+        if direction == TRACE_IN:
+            dispatcher.add_data(record_data)
+        elif direction == TRACE_KEY:
+            key = None if record_data == TRACE_LOCAL_KEY else _session_key()
+            dispatcher.crypto = SessionCrypto(key) if key else local_crypto
+        elif direction == TRACE_OUT:
+            try:
+                msg = parser.unpack_message(
+                    record_data,
+                    hmac_key=dispatcher.crypto if version >= 3.4 else None,
+                    no_retcode=True,
+                    logger=_LOGGER,
+                )
+            except parser.DecodeError:
+                continue
+            if msg.cmd == CMDType.SESS_KEY_NEG_START:
+                nonces.pop(CMDType.SESS_KEY_NEG_RESP, None)
+                nonces[msg.cmd] = msg.payload
+            frames.append(ReplayedFrame(TRACE_OUT, record_time, msg, key))
+    return frames
+
+
+def load_trace_file(path: str) -> bytes:
+    """Return the trace of a trace file or of a device diagnostics file."""
+    with open(path, "rb") as file:
+        data = file.read()
+    if data.startswith(TRACE_MAGIC):
+        return data
+
+    diagnostics = json.loads(data)
+    encoded = diagnostics.get("data", diagnostics).get("frame_trace")
+    if not encoded:
+        raise ValueError(f"No frames trace in {path}")
+    return base64.b64decode(encoded)
+
+
+async def print_trace(data: bytes, local_key: str | None = None):
+    """Print the frames of a trace, with their payloads."""
+    meta, records = read_trace(data)
+    frames = replay(data, local_key.encode("latin1") if local_key else None)
+    print(f"{meta['device_id']} v{meta['version']}: {len(frames)} frames")
+
+    protocol = None
+    if local_key:
+        protocol = TuyaProtocol(
+            meta["device_id"], local_key, meta["version"], False, EmptyListener()
+        )
+    start = records[0].time if records else 0
+    for direction, timestamp, msg, key in frames:
+        payload = msg.payload
+        if protocol is not None and payload:
+            protocol._set_session_key(key or protocol.real_local_key)
+            payload = protocol._decode_payload(payload)
+        arrow = "<-" if direction == TRACE_IN else "->"
+        crc = "" if msg.crc_good else "BAD CRC "
+        print(
+            f"{timestamp - start:10.3f} {arrow} cmd={msg.cmd:<3} seq={msg.seqno:<6}"
+            f" {crc}{payload!r}"
+        )
+
+
+def main():
+    parser_ = argparse.ArgumentParser(description="Replay a frames trace.")
+    parser_.add_argument("file", help="Trace file or device diagnostics")
+    parser_.add_argument("--local-key", help="Decrypt the payloads with the local key")
+    args = parser_.parse_args()
+
+    asyncio.run(print_trace(load_trace_file(args.file), args.local_key))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,612 @@
+"""Run the Tuya connections in worker processes."""
+
+import asyncio
+import importlib
+import itertools
+import logging
+import multiprocessing
+import os
+import pickle
+import subprocess
+import sys
+import time
+import weakref
+import zlib
+from multiprocessing.connection import Connection
+from typing import Any
+
+from . import (
+    QUIRK_DEV_TYPE,
+    SubdeviceState,
+    TuyaListener,
+    TuyaProtocol,
+    WritePacer,
+    connect,
+)
+from .trace import FrameTrace
+
+_LOGGER = logging.getLogger(__name__)
+
+# Shards report their health every interval, silent shards are restarted.
+SHARD_HEALTH_INTERVAL = 5
+SHARD_HEALTH_TIMEOUT = SHARD_HEALTH_INTERVAL * 3
+# Maximum number of messages handled per wake up of the loop.
+SHARD_MAX_BATCH = 100
+
+# Messages are tuples: (kind, request_id, connection_id, *payload).
+# Sent to the shards.
+MSG_CONNECT = "connect"
+MSG_CALL = "call"
+MSG_CALL_SOON = "call_soon"
+MSG_SUB_DEVICES = "sub_devices"
+MSG_DUMP_TRACE = "dump_trace"
+# Sent by the shards.
+MSG_RESULT = "result"
+MSG_STATUS = "status"
+MSG_EVENT = "event"
+MSG_HEALTH = "health"
+
+# Shards only import this package, as a top level package, not Home Assistant.
+_SHARD_BOOTSTRAP = """
+import sys
+from multiprocessing.connection import Connection
+sys.path.insert(0, sys.argv[1])
+from {package}.shard import shard_main
+shard_main(Connection(int(sys.argv[2])))
+"""
+
+
+def shard_main(conn: Connection):
+    """Entry point of a shard process."""
+    asyncio.run(_ShardWorker(conn).run())
+
+
+def _dump_error(ex: Exception):
+    """Return the exception in a form the other process can unpickle."""
+    module = type(ex).__module__
+    if module == __package__ or module.startswith(f"{__package__}."):
+        # The package doesn't have the same name in both processes.
+        return (module[len(__package__) :], type(ex).__name__, ex.args)
+    return ex
+
+
+def _load_error(error) -> Exception:
+    if isinstance(error, tuple):
+        module, name, args = error
+        return getattr(importlib.import_module(module, __package__), name)(*args)
+    return error
+
+
+class _ShardListener(TuyaListener):
+    """Listener of a connection in a shard, streams the events to the main process."""
+
+    def __init__(self, worker: "_ShardWorker", conn_id: int, cid: str = None):
+        self._worker = worker
+        self._conn_id = conn_id
+        self._cid = cid
+        # Values already sent, statuses are sent as deltas of them.
+        self._sent_status: dict = {}
+        self.sub_devices: dict[str, _ShardListener] = {}
+
+    def set_sub_devices(self, cids: list[str]):
+        self.sub_devices = {
+            cid: self.sub_devices.get(cid)
+            or _ShardListener(self._worker, self._conn_id, cid)
+            for cid in cids
+        }
+
+    def status_updated(self, status):
+        """Device updated status."""
+        sent = self._sent_status
+        delta = {
+            dp: value
+            for dp, value in status.items()
+            if dp not in sent or sent[dp] != value
+        }
+        sent.update(delta)
+        # Sent even without delta, a DP reporting the same value may trigger an event.
+        protocol = self._worker.protocols.get(self._conn_id)
+        dispatched_dps = protocol.dispatched_dps if protocol else {}
+        self._worker.send(
+            MSG_STATUS, None, self._conn_id, self._cid, delta, dispatched_dps
+        )
+
+    def disconnected(self, exc=""):
+        """Device disconnected."""
+        self._worker.protocols.pop(self._conn_id, None)
+        self._worker.listeners.pop(self._conn_id, None)
+        self._worker.send(
+            MSG_EVENT, None, self._conn_id, self._cid, "disconnected", str(exc)
+        )
+
+    def subdevice_state_updated(self, state):
+        """Device is offline or online."""
+        self._worker.send(
+            MSG_EVENT,
+            None,
+            self._conn_id,
+            self._cid,
+            "subdevice_state_updated",
+            state.value,
+        )
+
+    def quirks_updated(self, quirks: dict):
+        """Device learned new protocol quirks."""
+        self._worker.send(
+            MSG_EVENT, None, self._conn_id, self._cid, "quirks_updated", quirks
+        )
+
+
+class _ShardWorker:
+    """The connections of a shard process, driven by the messages of the main process."""
+
+    def __init__(self, conn: Connection):
+        self.conn = conn
+        self.protocols: dict[int, TuyaProtocol] = {}
+        self.listeners: dict[int, _ShardListener] = {}
+        # Kept across reconnects, as TuyaDevice does in the main process.
+        self.pacers: dict[str, WritePacer] = {}
+        self.traces: dict[str, FrameTrace] = {}
+        self._tasks: set[asyncio.Task] = set()
+        self._stopped: asyncio.Future = None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self._stopped = loop.create_future()
+        loop.add_reader(self.conn.fileno(), self._on_readable)
+        health = loop.create_task(self._report_health())
+        try:
+            await self._stopped
+        finally:
+            health.cancel()
+            loop.remove_reader(self.conn.fileno())
+            for protocol in list(self.protocols.values()):
+                await protocol.close()
+
+    def send(self, *msg):
+        try:
+            self.conn.send(msg)
+        except (pickle.PicklingError, TypeError, AttributeError) as ex:
+            kind, req_id, conn_id = msg[:3]
+            if kind != MSG_RESULT:
+                raise
+            # Results that can't be pickled are reported as errors.
+            self.conn.send((kind, req_id, conn_id, RuntimeError(str(ex)), None))
+        except OSError:
+            # The main process is gone.
+            if not self._stopped.done():
+                self._stopped.set_result(None)
+
+    def _on_readable(self):
+        try:
+            for _ in range(SHARD_MAX_BATCH):
+                self._handle_message(self.conn.recv())
+                if not self.conn.poll():
+                    break
+        except (EOFError, OSError):
+            if not self._stopped.done():
+                self._stopped.set_result(None)
+
+    def _handle_message(self, msg: tuple):
+        kind, req_id, conn_id, *payload = msg
+        if kind == MSG_CONNECT:
+            self._request(req_id, self._connect(conn_id, *payload))
+        elif kind == MSG_SUB_DEVICES:
+            if listener := self.listeners.get(conn_id):
+                listener.set_sub_devices(payload[0])
+        elif kind == MSG_DUMP_TRACE:
+            # The trace is kept across reconnects, it is dumped by device id.
+            device_id, version = payload
+            trace = self.traces.get(device_id) or FrameTrace()
+            self.send(MSG_RESULT, req_id, conn_id, None, trace.dump(device_id, version))
+        elif (protocol := self.protocols.get(conn_id)) is None:
+            if kind == MSG_CALL:
+                self.send(
+                    MSG_RESULT, req_id, conn_id, ConnectionError("Not connected"), None
+                )
+        elif kind == MSG_CALL:
+            method, args, kwargs = payload
+            self._request(req_id, getattr(protocol, method)(*args, **kwargs))
+        elif kind == MSG_CALL_SOON:
+            method, args, kwargs = payload
+            getattr(protocol, method)(*args, **kwargs)
+
+    def _request(self, req_id: int, coro):
+        task = asyncio.get_running_loop().create_task(self._reply(req_id, coro))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _reply(self, req_id: int, coro):
+        try:
+            result = await coro
+        except Exception as ex:  # pylint: disable=broad-except
+            return self.send(MSG_RESULT, req_id, None, _dump_error(ex), None)
+        self.send(MSG_RESULT, req_id, None, None, result)
+
+    async def _connect(self, conn_id: int, args: tuple, kwargs: dict):
+        listener = self.listeners[conn_id] = _ShardListener(self, conn_id)
+        listener.set_sub_devices(kwargs.pop("sub_devices", ()))
+        device_id = args[1]
+        if device_id not in self.pacers:
+            self.pacers[device_id] = WritePacer(*kwargs.get("pacer", ()))
+        kwargs["pacer"] = self.pacers[device_id]
+        kwargs["trace"] = self.traces.setdefault(device_id, FrameTrace())
+        try:
+            protocol = self.protocols[conn_id] = await connect(
+                *args, listener, **kwargs
+            )
+        except BaseException:
+            self.listeners.pop(conn_id, None)
+            raise
+        return protocol.dev_type
+
+    async def _report_health(self):
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(SHARD_HEALTH_INTERVAL)
+            health = {
+                "pid": os.getpid(),
+                "connections": len(self.protocols),
+                "pending_requests": len(self._tasks),
+                "loop_lag": round(time.monotonic() - start - SHARD_HEALTH_INTERVAL, 3),
+            }
+            self.send(MSG_HEALTH, None, None, health)
+
+
+class ShardedProtocol:
+    """TuyaProtocol running in a shard process, used from the main process."""
+
+    def __init__(
+        self,
+        shard: "TuyaShard",
+        conn_id: int,
+        listener: TuyaListener,
+        device_id,
+        version,
+        quirks,
+    ):
+        """Initialize a new ShardedProtocol."""
+        self.shard = shard
+        self.conn_id = conn_id
+        self.id = device_id
+        self.version = version
+        self.connected = False
+        # The dev_type of the protocol, the learned dev_type quirk updates it.
+        self.dev_type: str | None = None
+        # The payload of the status being dispatched, see TuyaProtocol.dispatched_dps.
+        self.dispatched_dps: dict = {}
+        self._listener = weakref.ref(listener)
+        self._quirks = quirks
+        # Statuses rebuilt from the deltas sent by the shard, by cid.
+        self._status: dict[str | None, dict] = {}
+
+    @property
+    def is_connected(self) -> bool:
+        return self.connected
+
+    def _call_soon(self, method: str, *args, **kwargs):
+        self.shard.send(MSG_CALL_SOON, None, self.conn_id, method, args, kwargs)
+
+    async def _call(self, method: str, *args, **kwargs):
+        return await self.shard.request(MSG_CALL, self.conn_id, method, args, kwargs)
+
+    def enable_debug(self, enable=False, friendly_name=None):
+        self._call_soon("enable_debug", enable, friendly_name)
+
+    def add_dps_to_request(self, dp_indicies):
+        self._call_soon("add_dps_to_request", dp_indicies)
+
+    def set_updatedps_list(self, update_list):
+        self._call_soon("set_updatedps_list", update_list)
+
+    def keep_alive(self, is_gateway: bool = False):
+        if (listener := self._listener()) is not None:
+            self.shard.send(
+                MSG_SUB_DEVICES, None, self.conn_id, list(listener.sub_devices)
+            )
+        self._call_soon("keep_alive", is_gateway)
+
+    async def status(self, cid=None) -> dict:
+        return await self._call("status", cid=cid)
+
+    async def detect_available_dps(self, cid=None) -> dict:
+        return await self._call("detect_available_dps", cid=cid)
+
+    async def confirm_dps(self, dps: list[str], dev_type: str = None, cid=None):
+        # The protocol takes the dev_type of the product, as TuyaProtocol does.
+        if self.version == 3.3 and dev_type:
+            self.dev_type = dev_type
+        return await self._call("confirm_dps", dps, dev_type, cid=cid)
+
+    async def reset(self, dpIds=None, cid=None):
+        return await self._call("reset", dpIds, cid=cid)
+
+    async def update_dps(self, dps=None, cid=None):
+        return await self._call("update_dps", dps, cid=cid)
+
+    async def set_dps(self, dps, cid=None):
+        return await self._call("set_dps", dps, cid=cid)
+
+    async def dump_trace(self) -> bytes:
+        return await self._call("dump_trace")
+
+    async def close(self):
+        # Events of the closing connection are not forwarded anymore.
+        self.shard.protocols.pop(self.conn_id, None)
+        if self.connected:
+            self.connected = False
+            try:
+                await self._call("close")
+            except ConnectionError:
+                pass
+
+    def _get_listener(self, cid: str | None) -> TuyaListener | None:
+        listener = self._listener()
+        if listener is not None and cid:
+            if (listener := listener.sub_devices.get(cid)) is None:
+                _LOGGER.debug(
+                    "[%s] Payload for missing sub-device %s discarded", self.id, cid
+                )
+        return listener
+
+    def status_updated(self, cid: str | None, delta: dict, dispatched_dps: dict):
+        status = self._status.setdefault(cid, {})
+        status.update(delta)
+        if (listener := self._get_listener(cid)) is not None:
+            self.dispatched_dps = dispatched_dps
+            listener.status_updated(status)
+
+    def event(self, cid: str | None, name: str, arg: Any):
+        if name == "disconnected" and not cid:
+            self.connected = False
+            self.shard.protocols.pop(self.conn_id, None)
+        elif name == "subdevice_state_updated":
+            arg = SubdeviceState(arg)
+        elif name == "quirks_updated":
+            # Keep updating the dict the listener persists.
+            self._quirks.update(arg)
+            arg = self._quirks
+            if dev_type := arg.get(QUIRK_DEV_TYPE):
+                self.dev_type = dev_type
+        if (listener := self._get_listener(cid)) is not None:
+            getattr(listener, name)(arg)
+
+    def __repr__(self):
+        """Return internal string representation of object."""
+        return self.id
+
+
+class TuyaShard:
+    """A worker process running a part of the connections."""
+
+    def __init__(self, index: int):
+        """Initialize a new TuyaShard."""
+        self.index = index
+        self.process: subprocess.Popen | None = None
+        self.conn: Connection | None = None
+        self.protocols: dict[int, ShardedProtocol] = {}
+        self.health: dict = {}
+        self.restarts = 0
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._ids = itertools.count(1)
+        self._requests: dict[int, asyncio.Future] = {}
+        self._last_health = 0.0
+        self._watchdog: asyncio.TimerHandle | None = None
+
+    @property
+    def name(self) -> str:
+        return f"localtuya_shard_{self.index}"
+
+    def start(self):
+        """Start the shard process."""
+        self.conn, child_conn = multiprocessing.Pipe()
+        package_dir, package = os.path.split(os.path.dirname(__file__))
+        self.process = subprocess.Popen(
+            [
+                sys.executable,
+                "-c",
+                _SHARD_BOOTSTRAP.format(package=package),
+                package_dir,
+                str(child_conn.fileno()),
+            ],
+            pass_fds=(child_conn.fileno(),),
+        )
+        child_conn.close()
+
+        self._loop = asyncio.get_running_loop()
+        self._loop.add_reader(self.conn.fileno(), self._on_readable)
+        self._last_health = time.monotonic()
+        self._watchdog = self._loop.call_later(
+            SHARD_HEALTH_INTERVAL, self._check_health
+        )
+
+    def stop(self, reason="Shard stopped"):
+        """Stop the shard process, its connections are reported as disconnected."""
+        if self._watchdog is not None:
+            self._watchdog.cancel()
+            self._watchdog = None
+        if self.conn is not None:
+            self._loop.remove_reader(self.conn.fileno())
+            self.conn.close()
+            self.conn = None
+        if self.process is not None:
+            if self.process.poll() is None:
+                self.process.kill()
+                try:
+                    self.process.wait(1)
+                except subprocess.TimeoutExpired:
+                    pass
+            self.process = None
+
+        requests, self._requests = self._requests, {}
+        for future in requests.values():
+            if not future.done():
+                future.set_exception(ConnectionError(reason))
+
+        protocols, self.protocols = self.protocols, {}
+        for protocol in protocols.values():
+            try:
+                protocol.event(None, "disconnected", reason)
+            except Exception:  # pylint: disable=broad-except
+                _LOGGER.exception("Failed to call disconnected callback")
+
+    def restart(self, reason: str):
+        """Replace the shard process by a new one."""
+        _LOGGER.warning("Restarting %s: %s", self.name, reason)
+        self.restarts += 1
+        self.stop(reason)
+        self.start()
+
+    def _check_health(self):
+        self._watchdog = None
+        if (code := self.process.poll()) is not None:
+            return self.restart(f"process exited with code {code}")
+        if time.monotonic() - self._last_health > SHARD_HEALTH_TIMEOUT:
+            return self.restart("no health report received")
+        self._watchdog = self._loop.call_later(
+            SHARD_HEALTH_INTERVAL, self._check_health
+        )
+
+    def send(self, *msg):
+        if self.conn is None:
+            raise ConnectionError(f"{self.name} is not running")
+        try:
+            self.conn.send(msg)
+        except OSError as ex:
+            self.restart(str(ex))
+            raise ConnectionError(f"{self.name} failed: {ex}") from ex
+
+    async def request(self, kind: str, conn_id: int, *payload):
+        """Send a message to the shard and wait for its result."""
+        req_id = next(self._ids)
+        future = self._requests[req_id] = self._loop.create_future()
+        try:
+            self.send(kind, req_id, conn_id, *payload)
+            return await future
+        finally:
+            self._requests.pop(req_id, None)
+
+    def _on_readable(self):
+        try:
+            for _ in range(SHARD_MAX_BATCH):
+                self._handle_message(self.conn.recv())
+                if not self.conn.poll():
+                    break
+        except (EOFError, OSError) as ex:
+            self.restart(f"connection lost: {ex or 'EOF'}")
+
+    def _handle_message(self, msg: tuple):
+        kind, req_id, conn_id, *payload = msg
+        if kind == MSG_RESULT:
+            error, result = payload
+            if (future := self._requests.get(req_id)) and not future.done():
+                if error is not None:
+                    future.set_exception(_load_error(error))
+                else:
+                    future.set_result(result)
+        elif kind == MSG_HEALTH:
+            self.health, self._last_health = payload[0], time.monotonic()
+        elif (protocol := self.protocols.get(conn_id)) is not None:
+            try:
+                if kind == MSG_STATUS:
+                    protocol.status_updated(*payload)
+                elif kind == MSG_EVENT:
+                    protocol.event(*payload)
+            except Exception:  # pylint: disable=broad-except
+                _LOGGER.exception("[%s] Failed to handle %s message", protocol.id, kind)
+
+    async def connect(
+        self,
+        address,
+        device_id,
+        local_key,
+        protocol_version,
+        enable_debug,
+        listener,
+        **kwargs,
+    ) -> ShardedProtocol:
+        """Connect to a device from the shard process."""
+        conn_id = next(self._ids)
+        quirks = kwargs.get("quirks")
+        quirks = {} if quirks is None else quirks
+        kwargs.update(quirks=dict(quirks), sub_devices=list(listener.sub_devices))
+        # The shard keeps its own write pacer and frames trace for the device,
+        # built from the settings of the pacer of the main process.
+        if pacer := kwargs.pop("pacer", None):
+            kwargs["pacer"] = (pacer.interval, pacer.burst)
+        kwargs.pop("trace", None)
+
+        protocol = ShardedProtocol(
+            self, conn_id, listener, device_id, protocol_version, quirks
+        )
+        self.protocols[conn_id] = protocol
+        args = (address, device_id, local_key, protocol_version, enable_debug)
+        try:
+            protocol.dev_type = await self.request(MSG_CONNECT, conn_id, args, kwargs)
+        except BaseException:
+            self.protocols.pop(conn_id, None)
+            raise
+        protocol.connected = True
+        return protocol
+
+
+class TuyaShardPool:
+    """Worker processes sharing the device connections.
+
+    Devices are assigned to a shard by their id. A shard process streams the DP
+    deltas of its connections and reports its health, shards that exit or stop
+    reporting are restarted and their devices reconnect to the new process.
+    """
+
+    def __init__(self, processes: int):
+        """Initialize a new TuyaShardPool."""
+        self.shards = [TuyaShard(index) for index in range(processes)]
+
+    @property
+    def health(self) -> list[dict]:
+        return [
+            {
+                "name": s.name,
+                "restarts": s.restarts,
+                "devices": len(s.protocols),
+                **s.health,
+            }
+            for s in self.shards
+        ]
+
+    def start(self):
+        for shard in self.shards:
+            shard.start()
+
+    def stop(self):
+        for shard in self.shards:
+            shard.stop()
+
+    def get_shard(self, device_id: str) -> TuyaShard:
+        return self.shards[zlib.crc32(device_id.encode()) % len(self.shards)]
+
+    async def dump_trace(self, device_id: str, version: float) -> bytes:
+        """Return the frames trace of a device, connected or not."""
+        shard = self.get_shard(device_id)
+        return await shard.request(MSG_DUMP_TRACE, None, device_id, version)
+
+    async def connect(
+        self,
+        address,
+        device_id,
+        local_key,
+        protocol_version,
+        enable_debug,
+        listener,
+        **kwargs,
+    ) -> ShardedProtocol:
+        """Connect to a device from the shard of the device."""
+        return await self.get_shard(device_id).connect(
+            address,
+            device_id,
+            local_key,
+            protocol_version,
+            enable_debug,
+            listener,
+            **kwargs,
+        )
@@ -0,0 +1,98 @@
+"""Frames trace of Tuya connections, recorded in a bounded buffer.
+
+A trace file is made of:
+    - TRACE_MAGIC, the length of the metadata (uint32) and the metadata as JSON.
+    - The records: direction (uint8), monotonic time (double), data length (uint32), data.
+
+The received data is recorded as read from the socket, so a replay feeds the
+dispatcher with the same fragmentation, see replay.py. The keys are never recorded,
+a replay derives the session keys from the local key.
+"""
+
+import json
+import struct
+import time
+from typing import NamedTuple
+
+TRACE_MAGIC = b"LTTRACE1"
+# The trace keeps the last two segments, a segment holds at least this many bytes.
+TRACE_SEGMENT_SIZE = 8192
+
+TRACE_IN = 0
+TRACE_OUT = 1
+# The frames key changed, the data tells which key.
+TRACE_KEY = 2
+TRACE_LOCAL_KEY = b""
+TRACE_SESSION_KEY = b"session"
+
+RECORD_HEADER = struct.Struct(">BdI")
+META_LENGTH = struct.Struct(">I")
+
+
+class TraceRecord(NamedTuple):
+    direction: int
+    time: float
+    data: bytes
+
+
+class FrameTrace:
+    """Raw frames sent and received by a connection, the oldest are dropped first.
+
+    Records are appended to the current segment, once it is full it replaces the
+    previous segment. Recording is an append to a bytearray, no payload is decoded.
+    """
+
+    __slots__ = ("segment_size", "_current", "_previous")
+
+    def __init__(self, segment_size: int = TRACE_SEGMENT_SIZE):
+        """Initialize a new FrameTrace."""
+        self.segment_size = segment_size
+        self._current = bytearray()
+        self._previous = bytearray()
+
+    @property
+    def size(self) -> int:
+        return len(self._previous) + len(self._current)
+
+    def record(self, direction: int, data: bytes):
+        """Record the data sent or received now."""
+        current = self._current
+        current += RECORD_HEADER.pack(direction, time.monotonic(), len(data))
+        current += data
+        if len(current) >= self.segment_size:
+            self._previous, self._current = current, bytearray()
+
+    def clear(self):
+        self._previous, self._current = bytearray(), bytearray()
+
+    def dump(self, device_id: str, version: float) -> bytes:
+        """Return the trace file of the recorded frames."""
+        meta = {
+            "device_id": device_id,
+            "version": version,
+            "time": time.time(),
+            "monotonic": time.monotonic(),
+        }
+        meta = json.dumps(meta).encode()
+        records = bytes(self._previous) + bytes(self._current)
+        return TRACE_MAGIC + META_LENGTH.pack(len(meta)) + meta + records
+
+
+def read_trace(data: bytes) -> tuple[dict, list[TraceRecord]]:
+    """Return the metadata and the records of a trace file."""
+    if not data.startswith(TRACE_MAGIC):
+        raise ValueError("Not a frames trace")
+
+    pos = len(TRACE_MAGIC)
+    (meta_length,) = META_LENGTH.unpack_from(data, pos)
+    pos += META_LENGTH.size
+    meta = json.loads(data[pos : pos + meta_length])
+    pos += meta_length
+
+    records = []
+    while pos + RECORD_HEADER.size <= len(data):
+        direction, timestamp, length = RECORD_HEADER.unpack_from(data, pos)
+        pos += RECORD_HEADER.size
+        records.append(TraceRecord(direction, timestamp, data[pos : pos + length]))
+        pos += length
+    return meta, records
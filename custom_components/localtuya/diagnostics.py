@@ -2,6 +2,7 @@
 
 from __future__ import annotations
 
+import base64
 import copy
 import logging
 from typing import Any
@@ -11,8 +12,16 @@ from homeassistant.const import CONF_CLIENT_ID, CONF_CLIENT_SECRET, CONF_DEVICES
 from homeassistant.core import HomeAssistant
 from homeassistant.helpers.device_registry import DeviceEntry
 
-from . import HassLocalTuyaData
-from .const import CONF_LOCAL_KEY, CONF_USER_ID, DOMAIN, CONF_NO_CLOUD, DATA_DISCOVERY
+from . import HassLocalTuyaData, async_get_tuya_device
+from .const import (
+    CONF_ENABLE_DEBUG,
+    CONF_LOCAL_KEY,
+    CONF_USER_ID,
+    DOMAIN,
+    CONF_NO_CLOUD,
+    DATA_DISCOVERY,
+    DATA_SHARDS,
+)
 
 CLOUD_DEVICES = "cloud_devices"
 DEVICE_CONFIG = "device_config"
@@ -48,6 +57,8 @@ async def async_get_config_entry_diagnostics(
                 data[CLOUD_DEVICES][dev_id][obf] = obfuscate(ob, obf_len, obf_len)
     if discovery := hass.data[DOMAIN].get(DATA_DISCOVERY):
         data["Discovered_Devices"] = discovery.devices
+    if shards := hass.data[DOMAIN].get(DATA_SHARDS):
+        data["io_shards"] = shards.health
     return data
 
 
@@ -75,6 +86,14 @@ async def async_get_device_diagnostics(
         # local_key_obfuscated = "{local_key[0:3]}...{local_key[-3:]}"
         # data[DEVICE_CLOUD_INFO][CONF_LOCAL_KEY] = local_key_obfuscated
 
+    if tuya_device := async_get_tuya_device(hass, entry, dev_id):
+        data["time_to_first_state"] = tuya_device.time_to_first_state
+        # The traffic of the device is only shared when its debug is enabled.
+        # Replay with: python -m custom_components.localtuya.core.pytuya.replay
+        if data[DEVICE_CONFIG].get(CONF_ENABLE_DEBUG):
+            trace = await tuya_device.async_dump_trace()
+            data["frame_trace"] = base64.b64encode(trace).decode()
+
     # data["log"] = hass.data[DOMAIN][CONF_DEVICES][dev_id].logger.retrieve_log()
     if discovery := hass.data[DOMAIN].get(DATA_DISCOVERY):
         data["Discovered_Devices"] = discovery.devices.get(dev_id)
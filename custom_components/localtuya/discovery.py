@@ -8,6 +8,7 @@ Maintained by @xZetsubou
 
 import os
 import asyncio
+import bisect
 import json
 import logging
 from hashlib import md5
@@ -27,6 +28,8 @@ PREFIX_6699_BIN = b"\x00\x00\x66\x99"
 UDP_COMMAND = b"\x00\x00\x00\x00"
 
 DEFAULT_TIMEOUT = 6.0
+# Devices repeat the same broadcast every few seconds, the decoded packets are kept.
+PACKETS_CACHE_SIZE = 2048
 
 
 def decrypt(msg, key):
@@ -60,10 +63,24 @@ class TuyaDiscovery(asyncio.DatagramProtocol):
 
     def __init__(self, callback=None):
         """Initialize a new BaseDiscovery."""
-        self.devices = {}
+        self._devices: dict[str, dict] = {}
+        # (packed ip, gwId) of the devices, kept sorted so devices is ordered by ip.
+        self._ip_index: list[tuple[bytes, str]] = []
+        self._sorted_devices: dict[str, dict] | None = None
+        # Raw packet -> decoded device, None for the packets that failed to decode.
+        self._packets: dict[bytes, dict | None] = {}
         self._listeners = []
         self._callback = callback
 
+    @property
+    def devices(self) -> dict[str, dict]:
+        """Return the discovered devices ordered by ip."""
+        if self._sorted_devices is None:
+            self._sorted_devices = {
+                gwid: self._devices[gwid] for _, gwid in self._ip_index
+            }
+        return self._sorted_devices
+
     async def start(self):
         """Start discovery by listening to broadcasts."""
         loop = asyncio.get_running_loop()
@@ -88,12 +105,21 @@ class TuyaDiscovery(asyncio.DatagramProtocol):
 
     def datagram_received(self, data, addr):
         """Handle received broadcast message."""
+        packet = data
         try:
-            try:
-                data = decrypt_udp(data)
-            except Exception as ex:  # pylint: disable=broad-except
-                data = data.decode()
-            decoded = json.loads(data)
+            if packet in self._packets:
+                if (decoded := self._packets[packet]) is None:
+                    return
+            else:
+                if len(self._packets) >= PACKETS_CACHE_SIZE:
+                    # Drop the oldest packet, dicts keep the insertion order.
+                    del self._packets[next(iter(self._packets))]
+                self._packets[packet] = None
+                try:
+                    data = decrypt_udp(data)
+                except Exception as ex:  # pylint: disable=broad-except
+                    data = data.decode()
+                decoded = self._packets[packet] = json.loads(data)
             self.device_found(decoded)
         except (json.JSONDecodeError, Exception) as ex:
             # _LOGGER.debug("Bordcast from app from ip: %s", addr[0])
@@ -101,20 +127,24 @@ class TuyaDiscovery(asyncio.DatagramProtocol):
                 "Failed to decode broadcast from %r: %r [%s]", addr[0], data, ex
             )
 
+    @staticmethod
+    def _ip_key(device: dict) -> tuple[bytes, str]:
+        return inet_aton(device.get("ip", "0")), device.get("gwId") or ""
+
     def device_found(self, device):
         """Discover a new device."""
         gwid, ip = device.get("gwId"), device.get("ip")
         # If device found but the ip changed.
-        if gwid in self.devices and (self.devices[gwid].get("ip") != ip):
-            self.devices.pop(gwid)
-
-        if gwid not in self.devices:
-            self.devices[gwid] = device
-            # Sort devices by ip.
-            sort_devices = sorted(
-                self.devices.items(), key=lambda i: inet_aton(i[1].get("ip", "0"))
-            )
-            self.devices = dict(sort_devices)
+        if (known := self._devices.get(gwid)) is not None and known.get("ip") != ip:
+            self._devices.pop(gwid)
+            key = self._ip_key(known)
+            del self._ip_index[bisect.bisect_left(self._ip_index, key)]
+            self._sorted_devices = None
+
+        if gwid not in self._devices:
+            bisect.insort(self._ip_index, self._ip_key(device))
+            self._devices[gwid] = device
+            self._sorted_devices = None
 
             _LOGGER.debug("Discovered device: %s", device)
         if self._callback:
@@ -1,7 +1,8 @@
 """Code shared between all platforms."""
 
 import logging
-from typing import Any, Coroutine, Callable
+from collections import ChainMap
+from typing import Any, Coroutine, Callable, Mapping
 
 from homeassistant.core import HomeAssistant, State
 from homeassistant.config_entries import ConfigEntry
@@ -22,10 +23,7 @@ from homeassistant.const import (
     ATTR_VIA_DEVICE,
 )
 from homeassistant.helpers.device_registry import DeviceInfo
-from homeassistant.helpers.dispatcher import (
-    async_dispatcher_connect,
-    async_dispatcher_send,
-)
+from homeassistant.helpers.dispatcher import async_dispatcher_send
 
 from homeassistant.helpers.restore_state import RestoreEntity
 from homeassistant.helpers.entity_platform import AddEntitiesCallback
@@ -99,6 +97,7 @@ async def async_setup_entry(
                         entity_config[CONF_ID],
                         # we need add_entites_callback in-case we want to add sub-entites, such as electric sensor "phase_a"
                         add_entites_callback=async_add_entities,
+                        dps_config_fields=dps_config_fields,
                     )
                 )
     # Once the entities have been created, add to the TuyaDevice instance
@@ -141,7 +140,11 @@ class LocalTuyaEntity(RestoreEntity, pytuya.ContextualLogger):
         self._device_config = DeviceConfig(device_config)
         self._config = get_entity_config(device_config, dp_id)
         self._dp_id = dp_id
-        self._status = {}
+        # Values written by the entity, e.g. restored states, in front of the device
+        # status view. They are dropped once the device reports the same DPs.
+        self._status: ChainMap = ChainMap({})
+        # Version of the device status this entity was last updated with.
+        self._status_version: int | None = None
         self._state = None
         self._last_state = None
         self._stored_states: State | None = None
@@ -149,6 +152,8 @@ class LocalTuyaEntity(RestoreEntity, pytuya.ContextualLogger):
         self.componet_add_entities: AddEntitiesCallback = kwargs.get(
             "add_entites_callback"
         )
+        # Config keys holding DP ids, entities without them are updated on every DP.
+        self._dps_config_fields: list | None = kwargs.get("dps_config_fields")
         self._loaded = False
 
         # Default value is available to be provided by Platform entities if required
@@ -171,31 +176,65 @@ class LocalTuyaEntity(RestoreEntity, pytuya.ContextualLogger):
             self._stored_states = stored_data
             self.status_restored(stored_data)
 
-        def _update_handler(status: dict | None):
-            """Update entity state when status was updated."""
-            last_status = self._status.copy()
+        def _update_handler(status: Mapping | None, changed: set | None = None):
+            """Update entity state when status was updated, changed has the updated DPs."""
+            if status is None:
+                # Disconnected, the entity has no status until the device reconnects.
+                had_status = any(self._status.maps)
+                self._status, self._status_version = ChainMap({}), None
+                if not self._loaded:
+                    self._loaded = True
+                    self.connection_made()
+                if had_status:
+                    self.schedule_update_ha_state()
+                return
+
+            last_version = self._status_version
+            self._attach_status(status)
 
-            self._status = {} if status is None else {**self._status, **status}
+            if changed is not None and self._loaded:
+                # Only called when the DPs of this entity changed.
+                self.status_updated()
+                return self.schedule_update_ha_state()
 
             if not self._loaded:
                 self._loaded = True
                 self.connection_made()
 
-            if status != last_status:
+            if self._status_version != last_version:
                 if status:
                     self.status_updated()
 
                 self.schedule_update_ha_state()
 
-        signal = f"localtuya_{self._device_config.id}"
-
         self.async_on_remove(
-            async_dispatcher_connect(self.hass, signal, _update_handler)
+            self._device.async_subscribe_dps(self.subscribed_dps, _update_handler)
         )
 
         signal = f"localtuya_entity_{self._device_config.id}"
         async_dispatcher_send(self.hass, signal, self.entity_id)
 
+    def _attach_status(self, status: Mapping):
+        """Read the device status through the entity status, drop outdated values."""
+        overlay = self._status.maps[0]
+        if len(self._status.maps) == 1:
+            self._status = ChainMap(overlay, status)
+        for dp in [dp for dp in overlay if dp in status]:
+            del overlay[dp]
+        self._status_version = self._device.status_version
+
+    @property
+    def subscribed_dps(self) -> set[str] | None:
+        """Return the DPs used by this entity, None if they are unknown."""
+        if self._dps_config_fields is None:
+            return None
+
+        dps = {str(self._dp_id)}
+        for field in self._dps_config_fields:
+            if (dp := self._config.get(field)) is not None and dp != "":
+                dps.add(str(dp))
+        return dps
+
     @property
     def extra_state_attributes(self):
         """Return entity specific state attributes to be saved.
@@ -209,7 +248,7 @@ class LocalTuyaEntity(RestoreEntity, pytuya.ContextualLogger):
         elif self._last_state is not None:
             attributes[ATTR_STATE] = self._last_state
 
-        self.debug(f"Entity {self.name} - Additional attributes: {attributes}")
+        self.debug("Entity %s - Additional attributes: %s", self.name, attributes)
         return attributes
 
     @property
@@ -249,7 +288,7 @@ class LocalTuyaEntity(RestoreEntity, pytuya.ContextualLogger):
     @property
     def available(self) -> bool:
         """Return if device is available or not."""
-        return (len(self._status) > 0) or self._device.connected
+        return any(self._status.maps) or self._device.connected
 
     @property
     def entity_category(self) -> str:
@@ -327,10 +366,8 @@ class LocalTuyaEntity(RestoreEntity, pytuya.ContextualLogger):
         Override in subclasses and update entity initialization based on detected DPS.
         """
         stored_data = self._stored_states
+        # The device status only holds the "0" placeholder, it isn't a DP value.
         if self._status == RESTORE_STATES and stored_data:
-            self._status.pop("0", True)
-            if self._dp_id in self._status:
-                return
             if stored_data.state not in (STATE_UNAVAILABLE, STATE_UNKNOWN):
                 self.debug(f"{self.name}: Restore state: {stored_data.state}")
                 self._status[self._dp_id] = stored_data.state
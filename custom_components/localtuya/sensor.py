@@ -150,7 +150,10 @@ class LocalTuyaSensor(LocalTuyaEntity, SensorEntity):
 
         for sensor in (ATTR_CURRENT, ATTR_POWER, ATTR_VOLTAGE):
             sub_entity = LocalTuyaSensor(
-                self._device, self._device_config.as_dict(), self._dp_id
+                self._device,
+                self._device_config.as_dict(),
+                self._dp_id,
+                dps_config_fields=self._dps_config_fields,
             )
             setattr(sub_entity, "_attr_sub_sensor", sensor)
             setattr(sub_entity, "_attr_unique_id", f"{self.unique_id}_{sensor}")
@@ -0,0 +1,491 @@
+"""Micro-benchmarks of the protocol hot paths, the per frame costs.
+
+    python -m tests.benchmark                 # Print the timings
+    python -m tests.benchmark --check         # Fail on timings over the thresholds
+    python -m tests.benchmark --update        # Write the thresholds of this machine
+    python -m tests.benchmark -k add_data     # Run the matching benchmarks only
+
+The *_no_logging benchmarks run the same code with the debug logs removed from the
+source, the baseline of the debug logs cost when the device debug is disabled. The
+debug_logs_cost ratios compare both, their thresholds are ratios, not timings.
+
+The corpora are fixed payloads encrypted with fixed keys and IVs, so every run
+measures the same bytes. The thresholds in benchmark_thresholds.json are in
+microseconds per operation, measured on the reference machine with a margin.
+"""
+
+import argparse
+import ast
+import asyncio
+import inspect
+import json
+import logging
+import struct
+import sys
+import textwrap
+import timeit
+from collections.abc import Callable
+from functools import partial
+from pathlib import Path
+
+from custom_components.localtuya.core import pytuya
+from custom_components.localtuya.core.pytuya import (
+    NO_PROTOCOL_HEADER_CMDS,
+    EmptyListener,
+    PROTOCOL_3x_HEADER,
+    MessageDispatcher,
+    TuyaProtocol,
+    parser,
+)
+from custom_components.localtuya.core.pytuya.cipher import SessionCrypto
+from custom_components.localtuya.core.pytuya.const import (
+    Affix,
+    CMDType,
+    MessagesFormat,
+    TuyaMessage,
+)
+
+THRESHOLDS_FILE = Path(__file__).with_name("benchmark_thresholds.json")
+THRESHOLDS_MARGIN = 1.5
+REPEAT = 5
+
+DEVICE_ID = "bf0123456789abcdefgh"
+LOCAL_KEY = "0123456789abcdef"
+SESSION_KEY = b"fedcba9876543210"
+IV = b"0123456789ab"
+VERSIONS = (3.3, 3.4, 3.5)
+FRAMES_PER_STREAM = 12
+FRAGMENT_SIZE = 7
+
+# Status payloads reported by devices: a switch, a light and a gateway sub-device.
+CORPUS = [
+    {"dps": {"1": True}, "t": 1700000000},
+    {
+        "dps": {
+            "20": True,
+            "21": "colour",
+            "22": 1000,
+            "23": 500,
+            "24": "00f003e803e8",
+            "25": "000e0d0000000000000000c80000",
+            "26": 0,
+        },
+        "t": 1700000000,
+    },
+    {
+        "dps": {str(dp): dp * 10 for dp in range(1, 31)},
+        "cid": "a4c138f2d1e9b0c7",
+        "t": 1700000000,
+    },
+]
+COMMAND_DPS = {"1": True, "2": 50, "3": "auto"}
+
+_LOGGER = logging.getLogger(__name__)
+
+# Benchmark name -> setup returning the function to time and its operations per call.
+BENCHMARKS: dict[str, Callable[[], tuple[Callable[[], object], int]]] = {}
+
+
+def benchmark(name: str, versions=None):
+    """Register a benchmark setup, once per protocol version if versions is given."""
+
+    def decorator(setup):
+        if versions is None:
+            BENCHMARKS[name] = setup
+        for version in versions or ():
+            BENCHMARKS[f"{name}[{version}]"] = partial(setup, version)
+        return setup
+
+    return decorator
+
+
+def frame_key(version: float) -> bytes:
+    """Return the key of the frames, 3.4 and 3.5 use the negotiated session key."""
+    return SESSION_KEY if version >= 3.4 else LOCAL_KEY.encode()
+
+
+def device_payload(version: float, data: dict) -> bytes:
+    """Return the JSON payload of a device status as sent by version."""
+    if version >= 3.4:
+        nested = {"dps": data["dps"]}
+        if "cid" in data:
+            nested["cid"] = data["cid"]
+        data = {"protocol": 4, "t": data["t"], "data": nested}
+    return json.dumps(data, separators=(",", ":")).encode()
+
+
+def device_frame(version: float, payload: bytes, cmd=CMDType.STATUS, seqno=0):
+    """Return a frame sent by a device, encrypted the way devices do."""
+    crypto = SessionCrypto(frame_key(version))
+    header = str(version).encode() + PROTOCOL_3x_HEADER
+    if cmd in NO_PROTOCOL_HEADER_CMDS:
+        header = b""
+
+    if version >= 3.5:
+        prefix = Affix.prefix_6699.value
+        msg = TuyaMessage(seqno, cmd, 0, header + payload, 0, True, prefix, IV)
+        return parser.pack_message(msg, hmac_key=crypto)
+    if version >= 3.4:
+        payload = crypto.cipher.encrypt(header + payload, False)
+    else:
+        payload = header + crypto.cipher.encrypt(payload, False)
+
+    retcode = struct.pack(MessagesFormat.RETCODE, 0)
+    msg = TuyaMessage(seqno, cmd, 0, retcode + payload, 0)
+    return parser.pack_message(msg, hmac_key=crypto if version >= 3.4 else None)
+
+
+def device_frames(version: float) -> list[bytes]:
+    """Return the frames of the corpus for version."""
+    return [device_frame(version, device_payload(version, d)) for d in CORPUS]
+
+
+def create_protocol(version: float) -> TuyaProtocol:
+    """Return a protocol with the session key of the corpus, must run in a loop."""
+    protocol = TuyaProtocol(DEVICE_ID, LOCAL_KEY, version, False, EmptyListener())
+    if version >= 3.4:
+        protocol._set_session_key(SESSION_KEY)
+    return protocol
+
+
+def create_dispatcher(version: float, cls=MessageDispatcher) -> MessageDispatcher:
+    crypto = SessionCrypto(frame_key(version))
+    dispatcher = cls(DEVICE_ID, lambda *_, **__: None, version, crypto)
+    dispatcher.set_logger(_LOGGER, DEVICE_ID)
+    return dispatcher
+
+
+class _StripDebugLogs(ast.NodeTransformer):
+    """Remove the debug logs and the debug_enabled checks of a function."""
+
+    @staticmethod
+    def _is_debug_check(node) -> bool:
+        names = [n for n in ast.walk(node) if isinstance(n, (ast.Name, ast.Attribute))]
+        return any(
+            getattr(n, "id", None) == "debug"
+            or getattr(n, "attr", "") == "debug_enabled"
+            for n in names
+        )
+
+    def visit_Expr(self, node):
+        call = node.value
+        if isinstance(call, ast.Call) and getattr(call.func, "attr", "") == "debug":
+            return None
+        return node
+
+    def visit_Return(self, node):
+        # return self.debug(...)
+        if node.value is not None and self.visit_Expr(ast.Expr(node.value)) is None:
+            return ast.Return(None)
+        return node
+
+    def visit_Assign(self, node):
+        return None if self._is_debug_check(node.value) else node
+
+    def visit_If(self, node):
+        if self._is_debug_check(node.test):
+            return [self.visit(n) for n in node.orelse] or None
+        self.generic_visit(node)
+        node.body = node.body or [ast.Pass()]
+        return node
+
+
+def strip_debug_logs(cls: type, methods: tuple[str, ...]) -> type:
+    """Return a subclass of cls whose methods are compiled without the debug logs."""
+    namespace = {}
+    for name in methods:
+        source = textwrap.dedent(inspect.getsource(getattr(cls, name)))
+        tree = ast.fix_missing_locations(_StripDebugLogs().visit(ast.parse(source)))
+        code = compile(tree, inspect.getsourcefile(cls), "exec")
+        scope = {}
+        exec(code, vars(pytuya), scope)  # pylint: disable=exec-used
+        namespace[name] = scope[name]
+    return type(f"{cls.__name__}NoLogging", (cls,), namespace)
+
+
+DispatcherNoLogging = strip_debug_logs(
+    MessageDispatcher, ("add_data", "_dispatch", "_release_listener")
+)
+
+
+@benchmark("parse_header", VERSIONS)
+def _parse_header(version):
+    frames = device_frames(version)
+
+    def run():
+        for frame in frames:
+            parser.parse_header(frame)
+
+    return run, len(frames)
+
+
+@benchmark("unpack_message", VERSIONS)
+def _unpack_message(version):
+    frames = device_frames(version)
+    crypto = SessionCrypto(frame_key(version)) if version >= 3.4 else None
+
+    def run():
+        for frame in frames:
+            parser.unpack_message(frame, hmac_key=crypto)
+
+    return run, len(frames)
+
+
+@benchmark("pack_message", VERSIONS)
+def _pack_message(version):
+    crypto = SessionCrypto(frame_key(version)) if version >= 3.4 else None
+    if version >= 3.5:
+        prefix, iv = Affix.prefix_6699.value, IV
+        payloads = [device_payload(version, d) for d in CORPUS]
+    else:
+        prefix, iv = Affix.prefix_55aa.value, None
+        payloads = [
+            parser.unpack_message(f, crypto).payload for f in device_frames(version)
+        ]
+    messages = [TuyaMessage(1, 7, None, p, 0, True, prefix, iv) for p in payloads]
+
+    def run():
+        for msg in messages:
+            parser.pack_message(msg, hmac_key=crypto)
+
+    return run, len(messages)
+
+
+@benchmark("aes_ecb_encrypt")
+def _aes_ecb_encrypt():
+    cipher = SessionCrypto(SESSION_KEY).cipher
+    payloads = [device_payload(3.3, d) for d in CORPUS]
+
+    def run():
+        for payload in payloads:
+            cipher.encrypt(payload, False)
+
+    return run, len(payloads)
+
+
+@benchmark("aes_ecb_decrypt")
+def _aes_ecb_decrypt():
+    cipher = SessionCrypto(SESSION_KEY).cipher
+    payloads = [cipher.encrypt(device_payload(3.3, d), False) for d in CORPUS]
+
+    def run():
+        for payload in payloads:
+            cipher.decrypt(payload, False, decode_text=False)
+
+    return run, len(payloads)
+
+
+@benchmark("aes_gcm_encrypt")
+def _aes_gcm_encrypt():
+    cipher = SessionCrypto(SESSION_KEY).cipher
+    payloads = [device_payload(3.5, d) for d in CORPUS]
+    header = b"\0" * 14
+
+    def run():
+        for payload in payloads:
+            cipher.encrypt(payload, False, pad=False, iv=IV, header=header)
+
+    return run, len(payloads)
+
+
+@benchmark("aes_gcm_decrypt")
+def _aes_gcm_decrypt():
+    cipher = SessionCrypto(SESSION_KEY).cipher
+    header = b"\0" * 14
+    payloads = [
+        cipher.encrypt(device_payload(3.5, d), False, pad=False, iv=IV, header=header)
+        for d in CORPUS
+    ]
+    # IV, cipher text and the 16 bytes tag.
+    parts = [(p[12:-16], p[-16:]) for p in payloads]
+
+    def run():
+        for enc, tag in parts:
+            cipher.decrypt(enc, False, False, iv=IV, header=header, tag=tag)
+
+    return run, len(parts)
+
+
+@benchmark("generate_payload", VERSIONS)
+def _generate_payload(version):
+    protocol = create_protocol(version)
+
+    def run():
+        protocol._generate_payload(CMDType.CONTROL, COMMAND_DPS)
+        protocol._generate_payload(CMDType.DP_QUERY)
+        protocol._generate_payload(CMDType.HEART_BEAT)
+
+    return run, 3
+
+
+@benchmark("encode_message", VERSIONS)
+def _encode_message(version):
+    protocol = create_protocol(version)
+    messages = [
+        protocol._generate_payload(CMDType.CONTROL, COMMAND_DPS),
+        protocol._generate_payload(CMDType.DP_QUERY),
+        protocol._generate_payload(CMDType.HEART_BEAT),
+    ]
+
+    def run():
+        for msg in messages:
+            protocol._encode_message(msg)
+
+    return run, len(messages)
+
+
+@benchmark("decode_payload", VERSIONS)
+def _decode_payload(version):
+    protocol = create_protocol(version)
+    crypto = protocol.crypto if version >= 3.4 else None
+    payloads = [
+        parser.unpack_message(f, crypto).payload for f in device_frames(version)
+    ]
+
+    def run():
+        for payload in payloads:
+            protocol._decode_payload(payload)
+
+    return run, len(payloads)
+
+
+def _stream(version: float) -> bytes:
+    frames = device_frames(version)
+    return b"".join(frames[i % len(frames)] for i in range(FRAMES_PER_STREAM))
+
+
+@benchmark("add_data_coalesced", VERSIONS)
+def _add_data_coalesced(version):
+    """All the frames are received in a single read."""
+    dispatcher = create_dispatcher(version)
+    stream = _stream(version)
+    return partial(dispatcher.add_data, stream), FRAMES_PER_STREAM
+
+
+@benchmark("add_data_no_logging", VERSIONS)
+def _add_data_no_logging(version):
+    """add_data_coalesced without the debug logs."""
+    dispatcher = create_dispatcher(version, DispatcherNoLogging)
+    stream = _stream(version)
+    return partial(dispatcher.add_data, stream), FRAMES_PER_STREAM
+
+
+@benchmark("add_data_fragmented", VERSIONS)
+def _add_data_fragmented(version):
+    """The frames are received in reads of FRAGMENT_SIZE bytes."""
+    dispatcher = create_dispatcher(version)
+    stream = _stream(version)
+    chunks = [
+        stream[i : i + FRAGMENT_SIZE] for i in range(0, len(stream), FRAGMENT_SIZE)
+    ]
+
+    def run():
+        for chunk in chunks:
+            dispatcher.add_data(chunk)
+
+    return run, FRAMES_PER_STREAM
+
+
+# Timing ratios checked against their threshold: name -> (benchmark, baseline).
+RATIOS = {
+    f"debug_logs_cost[{version}]": (
+        f"add_data_coalesced[{version}]",
+        f"add_data_no_logging[{version}]",
+    )
+    for version in VERSIONS
+}
+
+
+def measure(func: Callable[[], object], ops: int, quick=False) -> float:
+    """Return the best time of func in microseconds per operation."""
+    timer = timeit.Timer(func)
+    if quick:
+        return timer.timeit(1) / ops * 1e6
+    number, _ = timer.autorange()
+    return min(timer.repeat(REPEAT, number)) / number / ops * 1e6
+
+
+async def run_benchmarks(pattern: str | None = None, quick=False) -> dict[str, float]:
+    """Return the microseconds per operation of the benchmarks matching pattern."""
+    results = {}
+    for name, setup in BENCHMARKS.items():
+        if pattern and pattern not in name:
+            continue
+        func, ops = setup()
+        results[name] = measure(func, ops, quick)
+    return results
+
+
+def ratios(results: dict[str, float]) -> dict[str, float]:
+    """Return the ratios of RATIOS between the measured benchmarks."""
+    return {
+        name: results[bench] / results[baseline]
+        for name, (bench, baseline) in RATIOS.items()
+        if bench in results and baseline in results
+    }
+
+
+def load_thresholds() -> dict[str, float]:
+    if not THRESHOLDS_FILE.exists():
+        return {}
+    return json.loads(THRESHOLDS_FILE.read_text())
+
+
+def save_thresholds(results: dict[str, float]):
+    thresholds = load_thresholds()
+    # The ratios thresholds are limits set by hand.
+    thresholds.update(
+        {
+            name: round(us * THRESHOLDS_MARGIN, 2)
+            for name, us in results.items()
+            if name not in RATIOS
+        }
+    )
+    content = json.dumps(dict(sorted(thresholds.items())), indent=2)
+    THRESHOLDS_FILE.write_text(content + "\n")
+
+
+def regressions(
+    results: dict[str, float], thresholds: dict[str, float], tolerance: float = 1.0
+) -> dict[str, tuple[float, float]]:
+    """Return the benchmarks slower than their threshold: name -> (time, threshold)."""
+    return {
+        name: (us, thresholds[name])
+        for name, us in results.items()
+        if name in thresholds and us > thresholds[name] * tolerance
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-k", dest="pattern", help="Run the matching benchmarks")
+    parser.add_argument("--check", action="store_true", help="Compare to thresholds")
+    parser.add_argument("--update", action="store_true", help="Write the thresholds")
+    parser.add_argument(
+        "--tolerance", type=float, default=1.0, help="Thresholds multiplier"
+    )
+    parser.add_argument("--json", action="store_true", help="Print the JSON results")
+    args = parser.parse_args()
+
+    results = asyncio.run(run_benchmarks(args.pattern))
+    results.update(ratios(results))
+    thresholds = load_thresholds()
+    slow = regressions(results, thresholds, args.tolerance)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for name, us in results.items():
+            limit = thresholds.get(name)
+            status = "SLOW" if name in slow else ""
+            limit = f"{limit:10.2f}" if limit else " " * 10
+            unit = "x    " if name in RATIOS else "us/op"
+            print(f"{name:>28}: {us:10.2f} {unit}  threshold {limit}  {status}")
+
+    if args.update:
+        save_thresholds(results)
+    elif args.check and slow:
+        sys.exit(f"{len(slow)} benchmarks are over their threshold: {', '.join(slow)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,13 @@
+"""Fixtures of localtuya tests."""
+
+import asyncio
+
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def restore_asyncio():
+    """Undo the asyncio patches of `init`, so they don't leak into the next tests."""
+    yield
+    asyncio.create_task = asyncio.tasks.create_task
+    asyncio.get_running_loop = asyncio.events.get_running_loop
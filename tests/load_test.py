@@ -0,0 +1,241 @@
+"""Load test the device connections against simulated devices.
+
+Every simulated device listens on its own loopback address (127.1.x.y), they run
+on a separate thread so the measured event loop only runs the integration side:
+TuyaDevice, TuyaProtocol and the entities subscriptions.
+
+    python -m tests.load_test --devices 1000 --version 3.4
+
+Reports the connect time, the time to the first state of the devices, the
+commands round trip latency and the event loop lag during the test.
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import resource
+import threading
+import time
+from typing import Any
+
+from homeassistant.config_entries import ConfigEntry
+from homeassistant.core import HomeAssistant
+
+from custom_components.localtuya import coordinator
+from custom_components.localtuya.const import DOMAIN
+
+from . import create_entry
+from .simulator import SimulatedDevice
+
+LAG_INTERVAL = 0.01
+
+
+def host_address(index: int) -> str:
+    """Return the loopback address of the device index."""
+    return f"127.1.{index // 250}.{index % 250 + 1}"
+
+
+def percentiles(values: list[float]) -> dict[str, float | None]:
+    """Return the p50, p95, p99 and max of values in milliseconds."""
+    values = sorted(values)
+    result = {}
+    for name, pct in (("p50", 50), ("p95", 95), ("p99", 99), ("max", 100)):
+        if not values:
+            result[name] = None
+            continue
+        index = min(len(values) - 1, max(0, math.ceil(pct / 100 * len(values)) - 1))
+        result[name] = round(values[index] * 1000, 2)
+    return result
+
+
+class SimulatorThread:
+    """Run the simulated devices on an event loop in a dedicated thread."""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+
+    async def run(self, coros):
+        """Run the coroutines concurrently on the thread loop."""
+        if not self._thread.is_alive():
+            self._thread.start()
+
+        async def _gather():
+            return await asyncio.gather(*coros)
+
+        future = asyncio.run_coroutine_threadsafe(_gather(), self.loop)
+        return await asyncio.wrap_future(future)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+
+
+class LoopLagMonitor:
+    """Measure how late the event loop wakes up a sleeping task."""
+
+    def __init__(self, interval: float = LAG_INTERVAL):
+        self.interval = interval
+        self.lags: list[float] = []
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, time.monotonic() - start - self.interval))
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+
+def create_simulators(count: int, version: float) -> list[SimulatedDevice]:
+    return [
+        SimulatedDevice(
+            f"bfsim{index:015d}",
+            f"localkey{index:08d}",
+            version,
+            {"1": False, "2": 0, "3": "auto"},
+        )
+        for index in range(count)
+    ]
+
+
+def create_devices(
+    hass: HomeAssistant, simulators: list[SimulatedDevice], commands_delay: int
+) -> list[coordinator.TuyaDevice]:
+    """Return the TuyaDevices of the simulators, within a single config entry."""
+    config = {
+        sim.id: {
+            "host": sim.host,
+            "device_id": sim.id,
+            "local_key": sim.local_key.decode(),
+            "protocol_version": str(sim.version),
+            "friendly_name": sim.id,
+            "commands_delay": commands_delay,
+            "entities": [],
+        }
+        for sim in simulators
+    }
+    entry = ConfigEntry(**create_entry(config))
+    hass.data.setdefault(DOMAIN, {})
+    hass.data[DOMAIN][entry.entry_id] = coordinator.HassLocalTuyaData(None, {})
+    return [coordinator.TuyaDevice(hass, entry, conf) for conf in config.values()]
+
+
+async def send_command(device: coordinator.TuyaDevice, value: bool) -> float | None:
+    """Return the time to get the state change of a command, None if it failed."""
+    changed = asyncio.get_running_loop().create_future()
+
+    def _handler(status, _changed):
+        if status is not None and status.get("1") == value and not changed.done():
+            changed.set_result(time.monotonic())
+
+    unsubscribe = device.async_subscribe_dps({"1"}, _handler)
+    start = time.monotonic()
+    try:
+        await device.set_dp(value, "1")
+        return await asyncio.wait_for(changed, 5) - start
+    except TimeoutError:
+        return None
+    finally:
+        unsubscribe()
+
+
+async def run_load_test(
+    devices: int = 1000,
+    version: float = 3.3,
+    commands: int = 3,
+    connect_limit: int = coordinator.STARTUP_CONNECT_LIMIT,
+    commands_delay: int = 0,
+) -> dict[str, Any]:
+    """Connect TuyaDevices to simulated devices, send them commands and report."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    needed = devices * 3 + 256
+    if soft != resource.RLIM_INFINITY and soft < needed:
+        soft = needed if hard == resource.RLIM_INFINITY else min(needed, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+
+    simulators = create_simulators(devices, version)
+    sim_thread = SimulatorThread()
+    await sim_thread.run(
+        [sim.start(host_address(i)) for i, sim in enumerate(simulators)]
+    )
+
+    hass = HomeAssistant("")
+    lag = LoopLagMonitor()
+    lag.start()
+    tuya_devices = create_devices(hass, simulators, commands_delay)
+    try:
+        start = time.monotonic()
+        await coordinator.async_connect_devices(hass, tuya_devices, connect_limit)
+        connect_time = time.monotonic() - start
+        connected = [device for device in tuya_devices if device.connected]
+
+        latencies, failed = [], 0
+        for index in range(commands):
+            results = await asyncio.gather(
+                *(send_command(device, index % 2 == 0) for device in connected)
+            )
+            latencies.extend(r for r in results if r is not None)
+            failed += sum(1 for r in results if r is None)
+    finally:
+        await lag.stop()
+        await asyncio.gather(*(device.close() for device in tuya_devices))
+        await sim_thread.run([sim.stop() for sim in simulators])
+        sim_thread.stop()
+
+    first_states = [d.time_to_first_state for d in tuya_devices]
+    return {
+        "devices": devices,
+        "version": version,
+        "connected": len(connected),
+        "connect_time_s": round(connect_time, 3),
+        "time_to_first_state_ms": percentiles([t for t in first_states if t]),
+        "commands": len(latencies),
+        "commands_failed": failed,
+        "command_latency_ms": percentiles(latencies),
+        "loop_lag_ms": percentiles(lag.lags),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--devices", type=int, default=1000)
+    parser.add_argument("--version", type=float, default=3.3)
+    parser.add_argument("--commands", type=int, default=3, help="Commands per device")
+    parser.add_argument(
+        "--connect-limit", type=int, default=coordinator.STARTUP_CONNECT_LIMIT
+    )
+    parser.add_argument("--commands-delay", type=int, default=0, help="milliseconds")
+    parser.add_argument("--json", action="store_true", help="Print the JSON report")
+    args = parser.parse_args()
+
+    report = asyncio.run(
+        run_load_test(
+            args.devices,
+            args.version,
+            args.commands,
+            args.connect_limit,
+            args.commands_delay,
+        )
+    )
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    for key, value in report.items():
+        if isinstance(value, dict):
+            value = " ".join(f"{k}={v}" for k, v in value.items())
+        print(f"{key:>24}: {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+"""A local mock of the Tuya OpenAPI, serving an account devices over HTTP.
+
+    server = await MockOpenApi({"bf01": mock_device("bf01")}).start()
+    api = server.create_api()
+    await api.async_connect()
+    ...
+    await api.async_close()
+    await server.stop()
+
+Every request is recorded with the client address it came from, so the tests can
+check how many requests and connections were used. fail() queues the errors of
+the next requests to a path, delay slows every request down.
+"""
+
+import asyncio
+import json
+import time
+from typing import Any, NamedTuple
+
+from aiohttp import web
+
+from custom_components.localtuya.core.cloud_api import (
+    CLOUD_BATCH_SIZE,
+    CloudRequestScheduler,
+    TuyaCloudApi,
+)
+
+USER_ID = "az1700000000000test"
+ACCESS_TOKEN = "mock_access_token"
+
+
+class MockRequest(NamedTuple):
+    method: str
+    path: str
+    query: dict[str, str]
+    peer: tuple
+
+
+def mock_device(device_id: str, dps: dict[str, str] | None = None, **kwargs) -> dict:
+    """Return a cloud device, dps maps the dp ids to their codes."""
+    dps = {"1": "switch_1"} if dps is None else dps
+    device = {
+        "id": device_id,
+        "name": f"Device {device_id}",
+        "local_key": f"key{device_id}"[:16],
+        "category": "kg",
+        "product_id": "mockproduct",
+        "product_name": "Mock switch",
+        "online": True,
+        "update_time": 1700000000,
+        "mock_dps": dps,
+    }
+    device.update(kwargs)
+    return device
+
+
+class MockOpenApi:
+    """Serve the OpenAPI endpoints used by TuyaCloudApi."""
+
+    def __init__(self, devices: dict[str, dict] | None = None, user_id=USER_ID):
+        self.devices = devices or {}
+        self.user_id = user_id
+        self.requests: list[MockRequest] = []
+        self.delay = 0.0
+        self.in_flight = self.max_in_flight = 0
+        self.url = ""
+        self._failures: dict[str, list[int]] = {}
+        self._runner: web.AppRunner | None = None
+
+        app = web.Application(middlewares=[self._record])
+        app.router.add_get("/v1.0/token", self._token)
+        app.router.add_get("/v1.0/users/{uid}/devices", self._devices)
+        app.router.add_get("/v1.0/devices", self._devices_details)
+        app.router.add_get("/v1.1/devices/{id}/specifications", self._specifications)
+        app.router.add_get("/v2.0/cloud/thing/{id}/shadow/properties", self._properties)
+        app.router.add_get("/v2.0/cloud/thing/{id}/model", self._model)
+        self.app = app
+
+    @property
+    def connections(self) -> set[tuple]:
+        """Return the client addresses of the requests, one per connection."""
+        return {request.peer for request in self.requests}
+
+    def fail(self, path: str, *errors: int):
+        """Answer the next requests to path with errors, HTTP status for 4xx-5xx."""
+        self._failures.setdefault(path, []).extend(errors)
+
+    def paths(self, prefix="") -> list[str]:
+        return [r.path for r in self.requests if r.path.startswith(prefix)]
+
+    async def start(self, host="127.0.0.1", port=0):
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}"
+        return self
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+    def create_api(self, session=None, scheduler=None) -> TuyaCloudApi:
+        """Return a TuyaCloudApi sending its requests to this server.
+
+        The default scheduler has no rate budget, to keep the tests fast.
+        """
+        scheduler = scheduler or CloudRequestScheduler(requests_per_second=0)
+        api = TuyaCloudApi(
+            "eu", "client_id", "secret", self.user_id, session, scheduler
+        )
+        api._base_url = self.url
+        return api
+
+    @web.middleware
+    async def _record(self, request: web.Request, handler):
+        peer = request.transport.get_extra_info("peername")
+        self.requests.append(
+            MockRequest(request.method, request.path, dict(request.query), peer)
+        )
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if self.delay:
+                await asyncio.sleep(self.delay)
+            if errors := self._failures.get(request.path):
+                if 400 <= (error := errors.pop(0)) < 600:
+                    return web.Response(status=error, text="error")
+                return self._error(error, "mock error")
+            if request.path != "/v1.0/token":
+                if request.headers.get("access_token") != ACCESS_TOKEN:
+                    return self._error(1010, "token invalid")
+            return await handler(request)
+        finally:
+            self.in_flight -= 1
+
+    @staticmethod
+    def _result(result: Any) -> web.Response:
+        data = {"success": True, "result": result, "t": int(time.time() * 1000)}
+        return web.json_response(data)
+
+    @staticmethod
+    def _error(code: int, msg: str) -> web.Response:
+        data = {"success": False, "code": code, "msg": msg}
+        return web.json_response(data)
+
+    def _device(self, request: web.Request) -> dict | None:
+        return self.devices.get(request.match_info["id"])
+
+    async def _token(self, request: web.Request):
+        return self._result({"access_token": ACCESS_TOKEN, "expire_time": 7200})
+
+    @staticmethod
+    def _details(device: dict) -> dict:
+        return {k: v for k, v in device.items() if k != "mock_dps"}
+
+    async def _devices(self, request: web.Request):
+        if request.match_info["uid"] != self.user_id:
+            return self._error(1106, "permission deny")
+        return self._result([self._details(dev) for dev in self.devices.values()])
+
+    async def _devices_details(self, request: web.Request):
+        device_ids = request.query.get("device_ids", "").split(",")
+        if len(device_ids) > CLOUD_BATCH_SIZE:
+            return self._error(1109, "param is illegal")
+        devices = [
+            self._details(self.devices[dev_id])
+            for dev_id in device_ids
+            if dev_id in self.devices
+        ]
+        return self._result({"devices": devices, "total": len(devices)})
+
+    async def _specifications(self, request: web.Request):
+        if (device := self._device(request)) is None:
+            return self._error(1106, "permission deny")
+        functions = [
+            {"dp_id": int(dp_id), "code": code, "type": "Boolean", "values": "{}"}
+            for dp_id, code in device["mock_dps"].items()
+        ]
+        return self._result({"category": device["category"], "functions": functions})
+
+    async def _properties(self, request: web.Request):
+        if (device := self._device(request)) is None:
+            return self._error(1106, "permission deny")
+        properties = [
+            {"dp_id": int(dp_id), "code": code, "type": "bool", "value": False}
+            for dp_id, code in device["mock_dps"].items()
+        ]
+        return self._result({"properties": properties})
+
+    async def _model(self, request: web.Request):
+        if (device := self._device(request)) is None:
+            return self._error(1106, "permission deny")
+        properties = [
+            {
+                "abilityId": int(dp_id),
+                "code": code,
+                "accessMode": "rw",
+                "typeSpec": {"type": "bool"},
+            }
+            for dp_id, code in device["mock_dps"].items()
+        ]
+        model = {"modelId": "mock", "services": [{"properties": properties}]}
+        return self._result({"model": json.dumps(model)})
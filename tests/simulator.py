@@ -0,0 +1,374 @@
+"""Simulated Tuya devices speaking the LAN protocols 3.1 to 3.5.
+
+The frames are built and parsed with pytuya's own parser and ciphers, so the
+simulator follows the wire format the integration expects from real devices:
+    - 3.1: plain JSON replies, base64 encrypted CONTROL payloads.
+    - 3.2 and 3.3: ECB encrypted payloads, "type_0d" devices reject DP_QUERY.
+    - 3.4: session key negotiation, HMAC signed 55AA frames.
+    - 3.5: session key negotiation, GCM encrypted 6699 frames.
+Gateways answer for their sub-devices and the sub-devices online query.
+"""
+
+import asyncio
+import json
+import os
+import socket
+import struct
+import time
+from hashlib import md5
+from typing import Any
+
+from custom_components.localtuya.core.pytuya import (
+    NO_PROTOCOL_HEADER_CMDS,
+    PROTOCOL_3x_HEADER,
+    parser,
+)
+from custom_components.localtuya.core.pytuya.cipher import AESCipher, SessionCrypto
+from custom_components.localtuya.core.pytuya.const import (
+    Affix,
+    CMDType,
+    MessagesFormat,
+    TuyaMessage,
+)
+
+UDP_KEY = md5(b"yGAdlopoPVldABfn").digest()
+DEVICE_PORT = 6668
+DISCOVERY_PORT = 6666
+DISCOVERY_ENCRYPTED_PORT = 6667
+
+DATA_UNVALID = b"json obj data unvalid"  # codespell:ignore
+HEADER_LEN_6699 = struct.calcsize(MessagesFormat.HEADER_6699)
+PREFIX_6699 = Affix.prefix_6699.value
+SESS_KEY_CMDS = (CMDType.SESS_KEY_NEG_START, CMDType.SESS_KEY_NEG_FINISH)
+
+
+class SimulatedDevice:
+    """A Tuya device (or gateway) listening for LAN connections."""
+
+    def __init__(
+        self,
+        device_id: str,
+        local_key: str,
+        version: float = 3.3,
+        dps: dict[str, Any] | None = None,
+        *,
+        dev_type: str = "type_0a",
+        sub_devices: dict[str, dict[str, Any]] | None = None,
+        product_key: str = "simulated",
+        no_updatedps_reply: bool = False,
+        reply_delay: float = 0,
+    ):
+        """Initialize a new SimulatedDevice.
+
+        Args:
+            dev_type: "type_0d" devices reply DATA_UNVALID to DP_QUERY (3.3 only).
+            sub_devices: the sub-devices DPs by cid, makes the device a gateway.
+            no_updatedps_reply: the device doesn't answer the UPDATEDPS command.
+            reply_delay: seconds to wait before answering a request.
+        """
+        self.id = device_id
+        self.local_key = local_key.encode("latin1")
+        self.version = float(version)
+        self.dps = {"1": False} if dps is None else dict(dps)
+        self.dev_type = dev_type
+        self.sub_devices = {cid: dict(d) for cid, d in (sub_devices or {}).items()}
+        self.online_sub_devices = set(self.sub_devices)
+        self.product_key = product_key
+        self.no_updatedps_reply = no_updatedps_reply
+        self.reply_delay = reply_delay
+        self.host: str | None = None
+        self.port: int | None = None
+        # Received requests: (command, decoded payload)
+        self.requests: list[tuple[int, Any]] = []
+        self._server: asyncio.Server | None = None
+        self._sessions: set[_DeviceSession] = set()
+
+    @property
+    def version_bytes(self) -> bytes:
+        return str(self.version).encode("latin1")
+
+    @property
+    def connections(self) -> int:
+        return len(self._sessions)
+
+    async def start(self, host: str = "127.0.0.1", port: int = DEVICE_PORT):
+        """Start listening, port 0 picks a free port."""
+        loop = asyncio.get_running_loop()
+        self._server = await loop.create_server(
+            lambda: _DeviceSession(self), host, port
+        )
+        self.host, self.port = self._server.sockets[0].getsockname()[:2]
+        return self
+
+    async def stop(self):
+        """Stop listening and drop the open connections."""
+        if self._server is not None:
+            self._server.close()
+        self.close_connections()
+        if self._server is not None:
+            await self._server.wait_closed()
+            self._server = None
+
+    def close_connections(self):
+        """Drop the open connections, like a device rebooting."""
+        for session in list(self._sessions):
+            session.transport.abort()
+
+    def get_dps(self, cid: str | None = None) -> dict[str, Any] | None:
+        """Return the DPs of the device, or of the sub-device cid."""
+        return self.sub_devices.get(cid) if cid else self.dps
+
+    def set_dps(self, dps: dict[str, Any], cid: str | None = None):
+        """Change DPs locally (e.g. the device button) and report them."""
+        self.get_dps(cid).update(dps)
+        for session in self._sessions:
+            session.send_status(dps, cid)
+
+    def set_sub_device_online(self, cid: str, online: bool):
+        """Change the state reported by the sub-devices online query."""
+        if online:
+            self.online_sub_devices.add(cid)
+        else:
+            self.online_sub_devices.discard(cid)
+
+    def discovery_message(self) -> bytes:
+        """Return the UDP broadcast of the device."""
+        payload = json.dumps(
+            {
+                "ip": self.host or "127.0.0.1",
+                "gwId": self.id,
+                "active": 2,
+                "ability": 0,
+                "mode": 0,
+                "encrypt": self.version >= 3.2,
+                "productKey": self.product_key,
+                "version": str(self.version),
+            }
+        ).encode()
+        retcode = struct.pack(MessagesFormat.RETCODE, 0)
+
+        if self.version >= 3.5:
+            msg = TuyaMessage(
+                0, CMDType.UDP_NEW, 0, payload, 0, True, PREFIX_6699, True
+            )
+            return parser.pack_message(msg, hmac_key=UDP_KEY)
+        if self.version >= 3.2:
+            payload = AESCipher(UDP_KEY).encrypt(payload, False)
+            msg = TuyaMessage(0, CMDType.UDP_NEW, 0, retcode + payload, 0)
+            return parser.pack_message(msg)
+        # Plain broadcasts use the command 0.
+        return parser.pack_message(TuyaMessage(0, 0, 0, retcode + payload, 0))
+
+    @property
+    def discovery_port(self) -> int:
+        if self.version >= 3.2:
+            return DISCOVERY_ENCRYPTED_PORT
+        return DISCOVERY_PORT
+
+    async def broadcast(self, host: str = "255.255.255.255", port: int | None = None):
+        """Send the UDP broadcast of the device once."""
+        loop = asyncio.get_running_loop()
+        transport, _ = await loop.create_datagram_endpoint(
+            asyncio.DatagramProtocol, allow_broadcast=True, family=socket.AF_INET
+        )
+        try:
+            transport.sendto(
+                self.discovery_message(), (host, port or self.discovery_port)
+            )
+        finally:
+            transport.close()
+
+    def __repr__(self):
+        return f"SimulatedDevice({self.id}, {self.version}, {self.host}:{self.port})"
+
+
+class _DeviceSession(asyncio.Protocol):
+    """One client connection to a SimulatedDevice."""
+
+    def __init__(self, device: SimulatedDevice):
+        self.device = device
+        self.version = device.version
+        self.real_crypto = self.crypto = SessionCrypto(device.local_key)
+        self.version_header = device.version_bytes + PROTOCOL_3x_HEADER
+        self.transport: asyncio.Transport | None = None
+        self.seqno = 0
+        self.remote_nonce = b""
+        self.local_nonce = b""
+        self._buffer = bytearray()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.device._sessions.add(self)
+
+    def connection_lost(self, exc):
+        self.device._sessions.discard(self)
+
+    def data_received(self, data):
+        buffer = self._buffer
+        buffer += data
+        while len(buffer) >= HEADER_LEN_6699:
+            header = parser.parse_header(bytes(buffer[:HEADER_LEN_6699]))
+            if len(buffer) < header.total_length:
+                break
+            frame = bytes(buffer[: header.total_length])
+            del buffer[: header.total_length]
+            msg = parser.unpack_message(
+                frame,
+                header=header,
+                hmac_key=self.crypto if self.version >= 3.4 else None,
+                no_retcode=True,
+            )
+            # The session key must be known before parsing the next frames.
+            if self.device.reply_delay and msg.cmd not in SESS_KEY_CMDS:
+                loop = asyncio.get_running_loop()
+                loop.call_later(self.device.reply_delay, self._handle, msg)
+            else:
+                self._handle(msg)
+
+    def _send(self, cmd: int, payload: bytes, seqno: int | None = None):
+        """Encrypt and send a frame, the seqno of the device is used by default."""
+        if seqno is None:
+            self.seqno += 1
+            seqno = self.seqno
+        if self.transport is None or self.transport.is_closing():
+            return
+
+        if self.version >= 3.4 and payload and cmd not in NO_PROTOCOL_HEADER_CMDS:
+            payload = self.version_header + payload
+        cipher = self.crypto.cipher
+        if self.version >= 3.5:
+            msg = TuyaMessage(seqno, cmd, 0, payload, 0, True, PREFIX_6699, True)
+            return self.transport.write(parser.pack_message(msg, self.crypto))
+
+        if self.version >= 3.4:
+            if payload:
+                payload = cipher.encrypt(payload, False)
+        elif self.version >= 3.2 and payload:
+            payload = cipher.encrypt(payload, False)
+            if cmd not in NO_PROTOCOL_HEADER_CMDS:
+                payload = self.version_header + payload
+
+        retcode = struct.pack(MessagesFormat.RETCODE, 0)
+        msg = TuyaMessage(seqno, cmd, 0, retcode + payload, 0)
+        hmac_key = self.crypto if self.version >= 3.4 else None
+        self.transport.write(parser.pack_message(msg, hmac_key))
+
+    def _send_json(self, cmd: int, data: dict, seqno: int | None = None):
+        self._send(cmd, json.dumps(data, separators=(",", ":")).encode(), seqno)
+
+    def _decode(self, msg: TuyaMessage) -> bytes:
+        """Return the decrypted payload of a client frame."""
+        payload = msg.payload
+        if not payload:
+            return payload
+        cipher = self.crypto.cipher
+        if self.version >= 3.4:
+            if self.version == 3.4:
+                payload = cipher.decrypt(payload, False, decode_text=False)
+            if payload.startswith(self.version_header):
+                payload = payload[len(self.version_header) :]
+        elif self.version >= 3.2:
+            if payload.startswith(self.device.version_bytes):
+                payload = payload[len(self.version_header) :]
+            payload = cipher.decrypt(payload, False, decode_text=False)
+        elif payload.startswith(b"3.1"):
+            # Version, 16 characters of the md5 digest and base64 encrypted data.
+            payload = cipher.decrypt(payload[19:], decode_text=False)
+        return payload
+
+    def _handle(self, msg: TuyaMessage):
+        if self.transport is None or self.transport.is_closing():
+            return
+
+        cmd = msg.cmd
+        if cmd == CMDType.SESS_KEY_NEG_START:
+            return self._negotiate_start(msg)
+        if cmd == CMDType.SESS_KEY_NEG_FINISH:
+            return self._negotiate_finish(msg)
+
+        payload = self._decode(msg)
+        data = json.loads(payload) if payload else {}
+        self.device.requests.append((cmd, data))
+        # 3.4+ protocols nest the cid and the DPs in "data".
+        nested = data.get("data") if isinstance(data.get("data"), dict) else {}
+        cid = data.get("cid") or nested.get("cid")
+        dps = data.get("dps", nested.get("dps"))
+
+        if cmd == CMDType.HEART_BEAT:
+            self._send(cmd, b"", msg.seqno)
+        elif cmd in (CMDType.DP_QUERY, CMDType.DP_QUERY_NEW):
+            if self.device.dev_type == "type_0d" and cmd == CMDType.DP_QUERY:
+                return self._send(cmd, DATA_UNVALID, msg.seqno)
+            self._reply_status(cmd, msg.seqno, cid)
+        elif cmd in (CMDType.CONTROL, CMDType.CONTROL_NEW):
+            if dps is not None and all(value is None for value in dps.values()):
+                # type_0d devices query their status with CONTROL_NEW.
+                return self._reply_status(cmd, msg.seqno, cid, dps or None)
+            self._send(cmd, b"", msg.seqno)
+            if dps and (current := self.device.get_dps(cid)) is not None:
+                current.update(dps)
+                for session in self.device._sessions:
+                    session.send_status(dps, cid)
+        elif cmd == CMDType.UPDATEDPS:
+            if not self.device.no_updatedps_reply:
+                current = self.device.get_dps(cid) or {}
+                dp_ids = [str(dp) for dp in data.get("dpId", [])]
+                self.send_status({dp: current[dp] for dp in dp_ids if dp in current})
+        elif cmd == CMDType.LAN_EXT_STREAM and self.version >= 3.4:
+            # 3.3 gateways don't answer the sub-devices query.
+            online = self.device.online_sub_devices
+            offline = set(self.device.sub_devices) - online
+            report = {"online": sorted(online), "offline": sorted(offline)}
+            data = {"reqType": "subdev_online_stat_report", "data": report}
+            self._send_json(cmd, data, msg.seqno)
+
+    def _reply_status(self, cmd, seqno, cid=None, requested=None):
+        current = self.device.get_dps(cid)
+        if current is None:
+            return self._send(cmd, b"devid not found", seqno)
+        dps = current
+        if requested is not None:
+            dps = {dp: v for dp, v in current.items() if dp in requested}
+        data = {"devId": self.device.id, "dps": dps}
+        if cid:
+            data["cid"] = cid
+        self._send_json(cmd, data, seqno)
+
+    def send_status(self, dps: dict, cid: str | None = None):
+        """Report changed DPs."""
+        if self.version >= 3.4 and self.crypto is self.real_crypto:
+            return  # The session key isn't negotiated yet.
+        t = int(time.time())
+        if self.version >= 3.4:
+            nested = {"dps": dps, **({"cid": cid} if cid else {})}
+            data = {"protocol": 4, "t": t, "data": nested}
+        else:
+            data = {"devId": self.device.id, "dps": dps, "t": t}
+            if cid:
+                data["cid"] = cid
+        self._send_json(CMDType.STATUS, data, 0)
+
+    def _negotiate_start(self, msg: TuyaMessage):
+        payload = msg.payload
+        if self.version == 3.4:
+            payload = self.real_crypto.cipher.decrypt(payload, False, False)
+        self.local_nonce = payload[:16]
+        self.remote_nonce = os.urandom(16)
+        reply = self.remote_nonce + self.real_crypto.hmac_digest(self.local_nonce)
+        self._send(CMDType.SESS_KEY_NEG_RESP, reply, msg.seqno)
+
+    def _negotiate_finish(self, msg: TuyaMessage):
+        payload = msg.payload
+        if self.version == 3.4:
+            payload = self.real_crypto.cipher.decrypt(payload, False, False)
+        if payload[:32] != self.real_crypto.hmac_digest(self.remote_nonce):
+            return self.transport.close()
+
+        key = bytes(a ^ b for a, b in zip(self.local_nonce, self.remote_nonce))
+        cipher = self.real_crypto.cipher
+        if self.version == 3.4:
+            key = cipher.encrypt(key, False, pad=False)
+        else:
+            iv = self.local_nonce[:12]
+            key = cipher.encrypt(key, use_base64=False, pad=False, iv=iv)[12:28]
+        self.crypto = SessionCrypto(key)
@@ -0,0 +1,53 @@
+"""Test for localtuya."""
+
+from . import *
+from custom_components.localtuya.core.pytuya import parser
+from .benchmark import (
+    CORPUS,
+    VERSIONS,
+    DispatcherNoLogging,
+    create_dispatcher,
+    create_protocol,
+    device_frames,
+    load_thresholds,
+    ratios,
+    regressions,
+    run_benchmarks,
+)
+
+
+@pytest.mark.parametrize("version", VERSIONS)
+async def test_benchmark_corpus(version):
+    # The corpus must be decoded, not measure the errors handling.
+    protocol = create_protocol(version)
+    crypto = protocol.crypto if version >= 3.4 else None
+    for frame, data in zip(device_frames(version), CORPUS):
+        msg = parser.unpack_message(frame, hmac_key=crypto)
+        assert msg.crc_good
+        decoded = protocol._decode_payload(msg.payload)
+        assert decoded["dps"] == data["dps"]
+        assert decoded.get("cid") == data.get("cid")
+
+
+async def test_benchmarks():
+    results = await run_benchmarks(quick=True)
+    results.update(ratios(results))
+    thresholds = load_thresholds()
+    assert set(results) == set(thresholds)
+    assert all(us > 0 for us in results.values())
+
+    assert regressions({"a": 2.0, "b": 1.0}, {"a": 1.0, "b": 1.0}) == {"a": (2.0, 1.0)}
+    assert regressions({"a": 2.0}, {"a": 1.0}, tolerance=2) == {}
+
+
+def test_debug_logs_cost():
+    # The stripped dispatcher still dispatches every frame.
+    dispatcher = create_dispatcher(3.4, DispatcherNoLogging)
+    dispatcher.callback_status_update = messages = Mock()
+    dispatcher.add_data(b"".join(device_frames(3.4)))
+    assert messages.call_count == len(CORPUS)
+
+    # The cost is checked by the benchmark runner, timings are not stable in tests.
+    assert ratios({"add_data_coalesced[3.3]": 3, "add_data_no_logging[3.3]": 2}) == {
+        "debug_logs_cost[3.3]": 1.5
+    }
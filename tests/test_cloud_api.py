@@ -0,0 +1,258 @@
+"""Test for localtuya."""
+
+import json
+
+import aiohttp
+
+from . import *
+from custom_components.localtuya.core.cloud_api import (
+    CloudCache,
+    CloudRequestScheduler,
+)
+from .openapi_server import MockOpenApi, mock_device
+
+
+@pytest.fixture
+async def server():
+    devices = {f"bfmock{i:02d}": mock_device(f"bfmock{i:02d}") for i in range(5)}
+    server = await MockOpenApi(devices).start()
+    yield server
+    await server.stop()
+
+
+async def test_cloud_connection_pool(server):
+    api = server.create_api()
+    assert await api.async_connect() == (True, "ok")
+    await api.async_get_devices_dps_query()
+    assert set(api.device_list) == set(server.devices)
+    assert api.device_list["bfmock01"]["dps_data"]["1"]["code"] == "switch_1"
+
+    # The requests reuse the connections of the pool.
+    assert len(server.requests) == 2 + 3 * len(server.devices)
+    assert len(server.connections) <= api._session.connector.limit_per_host
+
+    session = api._session
+    await api.async_close()
+    assert session.closed and api._session is None
+    # The pool is created again on the next request.
+    assert await api.async_get_access_token() == "ok"
+    await api.async_close()
+
+
+async def test_cloud_shared_session(server):
+    session = aiohttp.ClientSession()
+    api = server.create_api(session)
+    assert await api.async_connect() == (True, "ok")
+    assert api._session is session
+
+    # A given session, Home Assistant one in the config flow, is left open.
+    await api.async_close()
+    assert not session.closed
+    await session.close()
+
+
+async def test_cloud_scheduler_budget(server):
+    server.devices = {
+        f"bfmock{i:02d}": mock_device(f"bfmock{i:02d}") for i in range(20)
+    }
+    server.delay = 0.01
+    scheduler = CloudRequestScheduler(max_concurrent=4, requests_per_second=0)
+    api = server.create_api(scheduler=scheduler)
+    await api.async_connect()
+
+    progress = []
+    results = await api.async_get_devices_dps_query(lambda *p: progress.append(p))
+    assert set(results) == set(server.devices)
+    assert server.max_in_flight == 4
+    assert progress[-1] == (20, 20) and len(progress) == 20
+
+    # The rate budget spaces the requests out.
+    api.scheduler = CloudRequestScheduler(requests_per_second=50)
+    server.delay = 0
+    start = time.monotonic()
+    await asyncio.gather(
+        *(api.async_get_device_specifications(f"bfmock{i:02d}") for i in range(10))
+    )
+    assert time.monotonic() - start >= 9 / 50
+    await api.async_close()
+
+
+async def test_cloud_scheduler_retries(server):
+    scheduler = CloudRequestScheduler(requests_per_second=0, backoff=0.001)
+    api = server.create_api(scheduler=scheduler)
+    await api.async_connect()
+
+    # Rate limited and server errors are retried, others are not.
+    path = "/v1.1/devices/bfmock00/specifications"
+    server.fail(path, 429, 500)
+    resp, msg = await api.async_get_device_specifications("bfmock00")
+    assert msg == "ok" and server.paths(path) == [path] * 3
+
+    server.fail(path, 1106)
+    assert (await api.async_get_device_specifications("bfmock00"))[1].startswith(
+        "Error 1106"
+    )
+    assert len(server.paths(path)) == 4
+
+    # Out of retries, the device is missing from the partial results.
+    for device_id in ("bfmock01", "bfmock02"):
+        for kind in ("shadow/properties", "model"):
+            server.fail(f"/v2.0/cloud/thing/{device_id}/{kind}", *[503] * 4)
+        server.fail(f"/v1.1/devices/{device_id}/specifications", *[503] * 4)
+    results = await api.async_get_devices_dps_query()
+    assert set(results) == set(server.devices) - {"bfmock01", "bfmock02"}
+    await api.async_close()
+
+    # Commands are only sent again when they were rate limited.
+    assert scheduler.should_retry("POST", {"success": False, "code": 429})
+    assert not scheduler.should_retry("POST", {"success": False, "code": 500})
+    assert not scheduler.should_retry("POST", False)
+
+    delays = [scheduler.backoff(attempt) for attempt in range(3)]
+    assert 0.0005 <= delays[0] <= 0.0015 and delays[2] <= 0.006
+
+
+async def test_cloud_cache(server):
+    data, saves = {}, Mock()
+    api = server.create_api()
+    api.cache = CloudCache(data, saves)
+    await api.async_connect()
+    assert len(await api.async_get_devices_dps_query()) == 5
+    await api.async_close()
+    assert saves.called and json.loads(json.dumps(data)) == data
+
+    # After a restart, nothing is requested while the cache is fresh.
+    server.requests.clear()
+    api = server.create_api()
+    api.cache = CloudCache(data)
+    assert await api.async_connect() == (True, "ok")
+    assert len(await api.async_get_devices_dps_query()) == 5
+    assert api.device_list["bfmock03"]["dps_data"]["1"]["code"] == "switch_1"
+    assert server.requests == []
+
+    # An updated device is fetched again.
+    server.devices["bfmock03"]["update_time"] += 1
+    server.devices["bfmock03"]["mock_dps"] = {"1": "switch_1", "2": "countdown"}
+    api._last_devices_update = 0  # Skip the update interval.
+    await api.async_get_devices_list(force_update=True)
+    await api.async_get_devices_dps_query()
+    assert "2" in api.device_list["bfmock03"]["dps_data"]
+    assert server.paths("/v1.1/devices/") == ["/v1.1/devices/bfmock03/specifications"]
+    await api.async_close()
+
+
+async def test_cloud_cache_revalidation(server):
+    data = {}
+    api = server.create_api()
+    api.cache = CloudCache(data)
+    await api.async_connect()
+    await api.async_get_devices_dps_query()
+    await api.async_close()
+
+    # Stale data is returned at once, then refreshed in the background.
+    server.requests.clear()
+    server.devices["bfmock00"]["name"] = "Renamed"
+    api = server.create_api()
+    api.cache = CloudCache(data, ttl={"devices": 0, "dps_data": 0})
+    await api.async_connect()
+    dps_data = await api.async_get_device_functions("bfmock01")
+    assert dps_data and api.device_list["bfmock00"]["name"] == "Device bfmock00"
+    assert len(api._revalidations) == 2
+
+    await asyncio.gather(*api._revalidations.values())
+    assert api.device_list["bfmock00"]["name"] == "Renamed"
+    assert data["devices"]["data"]["bfmock00"]["name"] == "Renamed"
+    assert len(server.paths("/v1.1/devices/bfmock01")) == 1
+    await api.async_close()
+
+
+async def test_cloud_single_flight(server):
+    server.delay = 0.02
+    api = server.create_api()
+
+    # After a router reboot, every device asks for its local key at once.
+    results = await asyncio.gather(
+        *(api.async_get_devices_list(force_update=True) for _ in range(20)),
+        *(api.async_get_device_specifications("bfmock00") for _ in range(5)),
+        api.async_get_device_specifications("bfmock01"),
+    )
+    assert results[:20] == ["ok"] * 20
+    assert all(msg == "ok" for _, msg in results[20:])
+    assert server.paths("/v1.0/token") == ["/v1.0/token"]
+    assert len(server.paths("/v1.0/users/")) == 1
+    assert len(server.paths("/v1.1/devices/bfmock00")) == 1
+    assert len(server.paths("/v1.1/devices/bfmock01")) == 1
+
+    # An expired token is refreshed once for all the waiting requests.
+    api._token_expire_time = 0
+    await asyncio.gather(
+        *(api.async_get_device_specifications(dev_id) for dev_id in server.devices)
+    )
+    assert len(server.paths("/v1.0/token")) == 2
+    assert not api._in_flight
+
+    # A cancelled caller leaves the shared request to the others.
+    request = asyncio.create_task(api.async_get_device_specifications("bfmock02"))
+    other = asyncio.create_task(api.async_get_device_specifications("bfmock02"))
+    await asyncio.sleep(0.005)
+    request.cancel()
+    assert (await other)[1] == "ok"
+    await api.async_close()
+
+
+async def test_cloud_batch_details(server):
+    server.devices = {
+        f"bfmock{i:02d}": mock_device(f"bfmock{i:02d}") for i in range(45)
+    }
+    api = server.create_api()
+    api.cache = CloudCache(data := {})
+    await api.async_connect()
+    await api.async_get_devices_dps_query()
+    server.requests.clear()
+
+    # The details are fetched by the API maximum of devices per request.
+    server.devices["bfmock07"]["local_key"] = "newkey"
+    server.devices["bfmock07"]["update_time"] += 1
+    devices = await api.async_get_devices_details([*server.devices, "bfunknown"])
+    assert set(devices) == set(server.devices)
+    assert [len(r.query["device_ids"].split(",")) for r in server.requests] == [
+        20,
+        20,
+        6,
+    ]
+    assert api.device_list["bfmock07"]["local_key"] == "newkey"
+    assert api.device_list["bfmock07"]["dps_data"]
+    # The cached DPS of the updated device are dropped, the others are kept.
+    assert data["devices"]["data"]["bfmock07"]["local_key"] == "newkey"
+    assert set(data["dps_data"]) == set(server.devices) - {"bfmock07"}
+
+    # The devices asking for their details together share batch requests.
+    server.requests.clear()
+    results = await asyncio.gather(
+        *(api.async_get_device_details(dev_id) for dev_id in server.devices),
+        api.async_get_device_details("bfmock00"),
+        api.async_get_device_details("bfunknown"),
+    )
+    assert results[7]["local_key"] == "newkey" and results[-1] is None
+    assert results[0] == results[-2]
+    assert len(server.paths("/v1.0/devices")) == 3
+    await api.async_close()
+
+
+async def test_cloud_batch_details_close(server):
+    api = server.create_api()
+    await api.async_connect()
+
+    # Closed during the batch window, the waiting devices get no details.
+    waiters = [
+        asyncio.create_task(api.async_get_device_details(dev_id))
+        for dev_id in ("bfmock00", "bfmock01")
+    ]
+    await asyncio.sleep(0)
+    await api.async_close()
+    assert await asyncio.gather(*waiters) == [None, None]
+    assert not api._pending_details
+
+    # The api is still usable after it was closed.
+    assert (await api.async_get_device_details("bfmock02"))["id"] == "bfmock02"
+    await api.async_close()
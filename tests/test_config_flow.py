@@ -0,0 +1,194 @@
+"""Test for localtuya."""
+
+import logging
+
+from . import *
+from custom_components.localtuya import config_flow
+from custom_components.localtuya.core.pytuya.io_thread import TuyaIOThread
+from custom_components.localtuya.core.pytuya.shard import TuyaShardPool
+from .simulator import SimulatedDevice
+
+DATA = {**DEVICE_CONFIG, "enable_debug": False}
+
+
+def mock_connect(monkeypatch, results: dict):
+    attempts = []
+
+    async def connect(host, dev_id, local_key, version, enable_debug):
+        attempts.append(version)
+        delay, result = results[version]
+        await asyncio.sleep(delay)
+        if isinstance(result, Exception):
+            raise result
+        # A BaseException is raised by the DPS detection.
+        detect = AsyncMock(
+            **(
+                {"side_effect": result}
+                if isinstance(result, BaseException)
+                else {"return_value": result}
+            )
+        )
+        return Mock(close=AsyncMock(), detect_available_dps=detect)
+
+    monkeypatch.setattr(config_flow.pytuya, "connect", connect)
+    monkeypatch.setattr(config_flow, "PROBE_HEAD_START", 0.05)
+    return attempts
+
+
+async def test_probe_discovered_version(monkeypatch):
+    attempts = mock_connect(monkeypatch, {3.4: (0, {"1": True})})
+    logger = Mock()
+
+    interface, version, dps = await config_flow.probe_protocol_versions(
+        logger, DATA, ["3.4", "3.3", "3.5"]
+    )
+    assert version == "3.4" and dps == {"1": True}
+    assert attempts == [3.4]
+    interface.close.assert_not_called()
+
+
+async def test_probe_parallel_versions(monkeypatch):
+    results = {
+        3.3: (0.2, {}),
+        3.1: (0, ConnectionAbortedError()),
+        3.4: (0.01, {}),
+        3.5: (0.05, {"1": True}),
+    }
+    attempts = mock_connect(monkeypatch, results)
+
+    interface, version, dps = await config_flow.probe_protocol_versions(
+        Mock(), DATA, ["3.3", "3.1", "3.4", "3.5"]
+    )
+    assert version == "3.5" and dps == {"1": True}
+    assert sorted(attempts) == [3.1, 3.3, 3.4, 3.5]
+    interface.close.assert_not_called()
+
+
+async def test_probe_dropped_versions(monkeypatch):
+    # A device closing the wrong version connection cancels the DPS detection,
+    # single connection devices refuse the parallel attempts.
+    results = {
+        3.3: (0, asyncio.CancelledError()),
+        3.1: (0, ConnectionRefusedError()),
+        3.4: (0.01, {"1": True}),
+    }
+    attempts = mock_connect(monkeypatch, results)
+
+    interface, version, dps = await config_flow.probe_protocol_versions(
+        Mock(), DATA, ["3.3", "3.1", "3.4"]
+    )
+    assert version == "3.4" and dps == {"1": True}
+    assert sorted(attempts) == [3.1, 3.3, 3.4]
+
+
+async def test_probe_unreachable_host(monkeypatch):
+    mock_connect(monkeypatch, {3.3: (0, OSError(113, "No route to host"))})
+
+    with pytest.raises(OSError):
+        await config_flow.probe_protocol_versions(Mock(), DATA, ["3.3", "3.4"])
+
+
+async def test_detect_dps_known_product():
+    product = {"version": 3.3, "dps": ["1", "2"], "dev_type": "type_0d"}
+    interface = Mock(
+        version=3.3,
+        confirm_dps=AsyncMock(return_value={"1": True, "2": 5}),
+        detect_available_dps=AsyncMock(return_value={"1": True}),
+    )
+
+    assert await config_flow.detect_dps(interface, product=product) == {
+        "1": True,
+        "2": 5,
+    }
+    interface.confirm_dps.assert_awaited_once_with(["1", "2"], "type_0d", cid=None)
+    interface.detect_available_dps.assert_not_called()
+
+    # Falls back to the detection if the device doesn't confirm the product DPS.
+    interface.confirm_dps.return_value = {}
+    assert await config_flow.detect_dps(interface, product=product) == {"1": True}
+
+    # Products are bound to the protocol version.
+    interface.confirm_dps.reset_mock()
+    interface.version = 3.4
+    await config_flow.detect_dps(interface, product=product)
+    interface.confirm_dps.assert_not_called()
+
+
+@pytest.fixture
+async def proxy_connect(request):
+    """Return the connect of the I/O thread or of a shards pool."""
+    if request.param == "io_thread":
+        runner = TuyaIOThread()
+    else:
+        runner = TuyaShardPool(1)
+    runner.start()
+    yield runner.connect
+    runner.stop()
+
+
+@pytest.mark.parametrize("proxy_connect", ["io_thread", "processes"], indirect=True)
+async def test_validate_sub_device_proxy(proxy_connect):
+    sub_devices = {"cid1": {"1": True, "2": 5}}
+    sim = SimulatedDevice(
+        DATA["device_id"], DATA["local_key"], 3.4, {}, sub_devices=sub_devices
+    )
+    await sim.start(port=0)
+    try:
+        interface = await proxy_connect(
+            sim.host,
+            sim.id,
+            DATA["local_key"],
+            3.4,
+            False,
+            Mock(sub_devices={}),
+            port=sim.port,
+        )
+        assert interface.dev_type == "v3.4"
+
+        # The sub-device DPS are detected through the gateway connection.
+        gateway = Mock(connected=True, is_connecting=False, _interface=interface)
+        entry_runtime = Mock(
+            devices={sim.host: gateway}, cloud_data=Mock(device_list={})
+        )
+        data = {**DATA, "host": sim.host, "node_id": "cid1", "protocol_version": "3.4"}
+        result = await config_flow.validate_input(entry_runtime, data)
+        assert result["dps_strings"] == ["1 ( value: True )", "2 ( value: 5 )"]
+        assert interface.is_connected
+        await interface.close()
+    finally:
+        await sim.stop()
+
+
+@pytest.mark.parametrize("proxy_connect", ["io_thread", "processes"], indirect=True)
+async def test_proxy_dev_type(proxy_connect):
+    sim = SimulatedDevice(DATA["device_id"], DATA["local_key"], 3.3, {"1": True})
+    sim.dev_type = "type_0d"
+    await sim.start(port=0)
+    try:
+        interface = await proxy_connect(
+            sim.host,
+            sim.id,
+            DATA["local_key"],
+            3.3,
+            False,
+            Mock(sub_devices={}),
+            port=sim.port,
+        )
+        assert interface.dev_type == "type_0a"
+        assert await interface.detect_available_dps() == {"1": True}
+        # The detection switched the device to type_0d.
+        assert interface.dev_type == "type_0d"
+        await interface.close()
+    finally:
+        await sim.stop()
+
+
+def test_dps_query_progress_log(caplog):
+    caplog.set_level(logging.DEBUG, config_flow.__name__)
+    for done in range(1, 26):
+        config_flow.log_dps_query_progress(done, 25)
+    assert [r.getMessage() for r in caplog.records] == [
+        "Fetched the cloud DPS of 10/25 devices",
+        "Fetched the cloud DPS of 20/25 devices",
+        "Fetched the cloud DPS of 25/25 devices",
+    ]
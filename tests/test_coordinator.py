@@ -0,0 +1,225 @@
+"""Test for localtuya."""
+
+from homeassistant.core import State
+from homeassistant.exceptions import HomeAssistantError
+
+from . import *
+from custom_components.localtuya.const import RESTORE_STATES
+from custom_components.localtuya.core.pytuya.pacer import WRITE_BURST, WRITE_INTERVAL
+from custom_components.localtuya.switch import LocalTuyaSwitch, DOMAIN as SWITCH_DOMAIN
+
+CONFIG = {
+    DEVICE_NAME: {
+        **DEVICE_CONFIG,
+        "entities": [
+            {
+                "friendly_name": "Switch 1",
+                "id": "1",
+                "platform": "switch",
+            },
+            {
+                "friendly_name": "Switch 2",
+                "id": "2",
+                "platform": "switch",
+            },
+        ],
+    }
+}
+
+
+async def test_coalesced_commands(monkeypatch):
+    device = await init(CONFIG, SWITCH_DOMAIN, LocalTuyaSwitch)
+    monkeypatch.setattr(asyncio, "create_task", asyncio.tasks.create_task)
+    device._interface = AsyncMock()
+
+    await asyncio.gather(device.set_dp(True, "1"), device.set_dps({"2": False}))
+    device._interface.set_dps.assert_awaited_once_with(
+        {"1": True, "2": False}, cid=device._node_id
+    )
+    assert device._task_set_status is None
+
+    await device.set_dp(False, "1")
+    device._interface.set_dps.assert_awaited_with({"1": False}, cid=device._node_id)
+    assert device._interface.set_dps.await_count == 2
+
+
+async def test_coalesced_commands_in_flight(monkeypatch):
+    device = await init(CONFIG, SWITCH_DOMAIN, LocalTuyaSwitch)
+    monkeypatch.setattr(asyncio, "create_task", asyncio.tasks.create_task)
+    device._interface = AsyncMock()
+    sending, sent = 0, []
+
+    async def set_dps(payload, cid=None):
+        nonlocal sending
+        sending += 1
+        assert sending == 1, "Overlapping sends"
+        await asyncio.sleep(0.02)
+        sending -= 1
+        sent.append(payload)
+
+    # A command received while a payload is sent waits for its own send.
+    device._interface.set_dps.side_effect = set_dps
+    first = asyncio.create_task(device.set_dp(True, "1"))
+    await asyncio.sleep(0.01)
+    assert device._task_set_status is not None
+    await asyncio.gather(first, device.set_dp(False, "2"))
+    assert sent == [{"1": True}, {"2": False}]
+    await asyncio.sleep(0)
+    assert device._task_set_status is None
+
+    # The send errors reach all the coalesced callers.
+    device._interface.set_dps.side_effect = TimeoutError
+    results = await asyncio.gather(
+        device.set_dp(True, "1"), device.set_dp(True, "2"), return_exceptions=True
+    )
+    assert [type(r) for r in results] == [HomeAssistantError] * 2
+    assert isinstance(results[0].__cause__, TimeoutError)
+
+    # close() cancels the send in flight.
+    device._interface.set_dps.side_effect = set_dps
+    command = asyncio.create_task(device.set_dp(True, "1"))
+    await asyncio.sleep(0.01)
+    await device.close()
+    with pytest.raises(asyncio.CancelledError):
+        await command
+    assert sent == [{"1": True}, {"2": False}]
+
+
+async def test_set_dp_error(monkeypatch):
+    device = await init(CONFIG, SWITCH_DOMAIN, LocalTuyaSwitch)
+    monkeypatch.setattr(asyncio, "create_task", asyncio.tasks.create_task)
+    device._interface = AsyncMock()
+    device._interface.set_dps.side_effect = TimeoutError
+    entity = get_entites(device)[0]
+
+    # The entity service call fails with an error HA reports to the user.
+    with pytest.raises(HomeAssistantError, match="Failed to set values"):
+        await entity.async_turn_on()
+    device._interface.set_dps.assert_awaited_once_with({"1": True}, cid=None)
+
+
+async def test_startup_connect_priority():
+    hass = HomeAssistant("")
+    hass.data["localtuya"] = {"discovery": Mock(devices={"reliable": {}})}
+    connecting, order, peak = 0, [], 0
+
+    def create_device(dev_id, sub_devices={}, sleep_time=0):
+        async def async_connect():
+            nonlocal connecting, peak
+            connecting += 1
+            peak = max(peak, connecting)
+            await asyncio.sleep(0.01)
+            connecting -= 1
+            order.append(dev_id)
+
+        return Mock(
+            id=dev_id,
+            sub_devices=sub_devices,
+            _device_config=Mock(sleep_time=sleep_time),
+            _fake_gateway=False,
+            time_to_first_state=None,
+            async_connect=async_connect,
+        )
+
+    devices = [
+        create_device("sleepy", sleep_time=10),
+        create_device("unknown"),
+        create_device("reliable"),
+        create_device("gateway", sub_devices={"cid": Mock()}),
+    ]
+    await coordinator.async_connect_devices(hass, devices, limit=1)
+    assert order == ["gateway", "reliable", "unknown", "sleepy"]
+
+    order.clear()
+    await coordinator.async_connect_devices(hass, devices * 3, limit=4)
+    assert len(order) == 12 and peak == 4
+
+
+async def test_dps_subscriptions():
+    device = await init(CONFIG, SWITCH_DOMAIN, LocalTuyaSwitch)
+    device.status_updated = coordinator.TuyaDevice.status_updated.__get__(device)
+    calls = {"1": [], "2": [], "all": []}
+    device.async_subscribe_dps({"1"}, lambda s, c: calls["1"].append(c))
+    unsub = device.async_subscribe_dps({"2"}, lambda s, c: calls["2"].append(c))
+    device.async_subscribe_dps(None, lambda s, c: calls["all"].append(c))
+
+    # The first status is dispatched to all entities.
+    device.status_updated({"1": True, "2": False})
+    assert calls == {"1": [None], "2": [None], "all": [None]}
+
+    device.status_updated({"1": False, "2": False})
+    assert calls["1"][-1] == {"1"} and len(calls["2"]) == 1
+    assert calls["all"][-1] == {"1"}
+
+    # Same values are ignored unless the DP state was reset.
+    device.status_updated({"1": False, "2": False})
+    assert len(calls["1"]) == 2 and len(calls["all"]) == 2
+    device.reset_dp_state("2")
+    device.status_updated({"1": False, "2": False})
+    assert calls["2"][-1] == {"2"} and len(calls["1"]) == 2
+
+    unsub()
+    device.status_updated({"2": True})
+    assert len(calls["2"]) == 2 and "2" not in device._dps_subscribers
+
+
+async def test_entity_subscribed_dps():
+    device = await init(CONFIG, SWITCH_DOMAIN, LocalTuyaSwitch)
+    entities = get_entites(device)
+    assert [e.subscribed_dps for e in entities] == [{"1"}, {"2"}]
+
+
+async def test_shared_status_store():
+    device = await init(CONFIG, SWITCH_DOMAIN, LocalTuyaSwitch)
+    device.status_updated = coordinator.TuyaDevice.status_updated.__get__(device)
+    entity = get_entites(device)[0]
+
+    device.status_updated({"1": True, "2": False})
+    version = device.status_version
+    with pytest.raises(TypeError):
+        device.status_view["1"] = False
+
+    # Values written by the entity are dropped once the device reports the DP.
+    entity._status.update({"1": "restored", "3": 5})
+    entity._attach_status(device.status_view)
+    assert entity._status.maps[1] is device.status_view
+    assert entity._status_version == version
+    assert entity.dp_value("1") is True and entity.dp_value("3") == 5
+    assert "3" not in device.status_view
+
+    device.status_updated({"1": False})
+    assert device.status_version == version + 1
+    assert entity.dp_value("1") is False
+
+    device.status_updated({"1": False})
+    assert device.status_version == version + 1
+
+
+async def test_write_pacer_config():
+    config = {DEVICE_NAME: {**CONFIG[DEVICE_NAME], "write_interval": 200}}
+    config[DEVICE_NAME]["write_burst"] = 2
+    device = await init(config, SWITCH_DOMAIN, LocalTuyaSwitch)
+    assert device._write_pacer.interval == 0.2
+    assert device._write_pacer.burst == 2 and device._write_pacer.tokens == 2
+
+    # The defaults of the pacer are used when not configured.
+    device = await init(CONFIG, SWITCH_DOMAIN, LocalTuyaSwitch)
+    assert device._write_pacer.interval == WRITE_INTERVAL
+    assert device._write_pacer.burst == WRITE_BURST
+
+
+async def test_restore_states_placeholder():
+    device = await init(CONFIG, SWITCH_DOMAIN, LocalTuyaSwitch)
+    device.status_updated = coordinator.TuyaDevice.status_updated.__get__(device)
+    entity = get_entites(device)[0]
+    entity._stored_states = State("switch.switch_1", "on")
+
+    device.status_updated(RESTORE_STATES)
+    entity._attach_status(device.status_view)
+    entity.connection_made()
+    assert entity.dp_value("1") == "on"
+    assert entity._status.maps[0] == {"1": "on"}
+
+    device.status_updated({"1": False})
+    entity._attach_status(device.status_view)
+    assert entity.dp_value("1") is False
@@ -0,0 +1,29 @@
+"""Test for localtuya."""
+
+import base64
+
+from . import *
+from custom_components.localtuya.core.pytuya.trace import TRACE_MAGIC
+from custom_components.localtuya.diagnostics import async_get_device_diagnostics
+from custom_components.localtuya.switch import LocalTuyaSwitch, DOMAIN as SWITCH_DOMAIN
+
+ENTITIES = [{"friendly_name": "Switch 1", "id": "1", "platform": "switch"}]
+
+
+async def get_diagnostics(enable_debug: bool) -> dict:
+    config = {DEVICE_NAME: {**DEVICE_CONFIG, "enable_debug": enable_debug}}
+    config[DEVICE_NAME]["entities"] = ENTITIES
+    device = await init(config, SWITCH_DOMAIN, LocalTuyaSwitch)
+    # The devices of the test entries are keyed by DEVICE_NAME.
+    device_entry = Mock(identifiers={(DOMAIN, f"local_{DEVICE_NAME}")})
+    return await async_get_device_diagnostics(device.hass, device._entry, device_entry)
+
+
+async def test_device_diagnostics_trace():
+    data = await get_diagnostics(False)
+    assert "time_to_first_state" in data
+    # The frames trace is only shared for the devices being debugged.
+    assert "frame_trace" not in data
+
+    data = await get_diagnostics(True)
+    assert base64.b64decode(data["frame_trace"]).startswith(TRACE_MAGIC)
@@ -1,6 +1,14 @@
 """Test for localtuya."""
 
+from homeassistant.config_entries import SIGNAL_CONFIG_ENTRY_CHANGED
+from homeassistant.helpers.dispatcher import async_dispatcher_send
+
 from . import *
+from custom_components.localtuya import (
+    async_config_entry_by_device_id,
+    async_get_device_index,
+)
+from custom_components.localtuya import discovery as discovery_module
 from custom_components.localtuya.discovery import TuyaDiscovery
 
 
@@ -19,3 +27,63 @@ async def test_dsicovery():
 
     mock_callback.assert_called()
     assert len(discovery.devices) == 3
+
+
+async def test_discovery_packets_cache(monkeypatch):
+    decrypt = Mock(wraps=discovery_module.decrypt_udp)
+    monkeypatch.setattr(discovery_module, "decrypt_udp", decrypt)
+    mock_callback = Mock()
+    discovery = TuyaDiscovery(mock_callback)
+
+    for _ in range(3):
+        discovery.datagram_received(DEVICE3_3, ("192.168.1.10", 6667))
+        discovery.datagram_received(b"not a broadcast", ("192.168.1.11", 6667))
+    # The repeated broadcasts are decoded once, but still reported.
+    assert decrypt.call_count == 2
+    assert mock_callback.call_count == 3
+    assert len(discovery.devices) == 1
+
+    monkeypatch.setattr(discovery_module, "PACKETS_CACHE_SIZE", 2)
+    discovery.datagram_received(DEVICE3_4, ("192.168.1.12", 6667))
+    discovery.datagram_received(DEVICE3_3, ("192.168.1.10", 6667))
+    assert decrypt.call_count == 4
+
+
+async def test_discovery_devices_order():
+    discovery = TuyaDiscovery()
+    for gwid, ip in (("a", "10.0.0.20"), ("b", "10.0.0.3"), ("c", "10.0.0.100")):
+        discovery.device_found({"gwId": gwid, "ip": ip})
+    assert list(discovery.devices) == ["b", "a", "c"]
+
+    # A device moved to another address.
+    discovery.device_found({"gwId": "c", "ip": "10.0.0.1"})
+    assert list(discovery.devices) == ["c", "b", "a"]
+    assert discovery.devices["c"]["ip"] == "10.0.0.1"
+
+
+async def test_device_entry_index():
+    hass = HomeAssistant("")
+    hass.data[DOMAIN] = {}
+    gateway = {"gateway_id": "gw1", "node_id": "node1", "host": "10.0.0.2"}
+    entry1 = ConfigEntry(**create_entry({"dev1": {}, "sub1": gateway}))
+    entry2 = ConfigEntry(**create_entry({"dev2": {}, "dev1": {}}))
+    entries = {entry.entry_id: entry for entry in (entry1, entry2)}
+    hass.config_entries = Mock()
+    hass.config_entries.async_entries.side_effect = lambda _: list(entries.values())
+    hass.config_entries.async_get_entry.side_effect = entries.get
+
+    assert async_config_entry_by_device_id(hass, "dev1") is entry1
+    assert async_config_entry_by_device_id(hass, "gw1") is entry1
+    assert async_config_entry_by_device_id(hass, "dev2") is entry2
+    assert async_config_entry_by_device_id(hass, "dev3") is None
+    assert async_get_device_index(hass).sub_devices("gw1") == ["sub1"]
+    assert hass.config_entries.async_entries.call_count == 1
+
+    # The index is rebuilt once an entry of the integration changes.
+    entry3 = ConfigEntry(**{**create_entry({"dev3": {}}), "domain": DOMAIN})
+    entries[entry3.entry_id] = entry3
+    other = ConfigEntry(**create_entry({}))
+    async_dispatcher_send(hass, SIGNAL_CONFIG_ENTRY_CHANGED, None, other)
+    assert async_config_entry_by_device_id(hass, "dev3") is None
+    async_dispatcher_send(hass, SIGNAL_CONFIG_ENTRY_CHANGED, None, entry3)
+    assert async_config_entry_by_device_id(hass, "dev3") is entry3
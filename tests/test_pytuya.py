@@ -0,0 +1,575 @@
+"""Test for localtuya."""
+
+import json
+import logging
+import threading
+
+from . import *
+from custom_components.localtuya.core.pytuya import (
+    NO_UPDATEDPS_REPLY_TIMEOUTS,
+    QUIRK_DEV_TYPE,
+    MessageDispatcher,
+    TuyaProtocol,
+    connect,
+    get_payload_template,
+    parser,
+)
+from custom_components.localtuya.core.pytuya.cipher import SessionCrypto
+from custom_components.localtuya.core.pytuya.heartbeat import (
+    HeartbeatTimer,
+    HeartbeatWheel,
+)
+from custom_components.localtuya.core.pytuya.io_thread import (
+    ThreadedProtocol,
+    TuyaIOThread,
+)
+from custom_components.localtuya.core.pytuya.pacer import WritePacer
+from custom_components.localtuya.core.pytuya.replay import print_trace, replay
+from custom_components.localtuya.core.pytuya.trace import (
+    TRACE_IN,
+    TRACE_OUT,
+    FrameTrace,
+    read_trace,
+)
+from custom_components.localtuya.core.pytuya.parser import DecodeError
+from custom_components.localtuya.core.pytuya.shard import (
+    TuyaShardPool,
+    _ShardWorker,
+    _dump_error,
+    _load_error,
+)
+from custom_components.localtuya.core.pytuya.const import (
+    Affix,
+    CMDType,
+    TuyaMessage,
+)
+
+from .simulator import SimulatedDevice
+
+DEVICE_ID = DEVICE_CONFIG["device_id"]
+LOCAL_KEY = DEVICE_CONFIG["local_key"].encode("latin1")
+
+
+def create_dispatcher(version=3.3, key=LOCAL_KEY):
+    messages = []
+    dispatcher = MessageDispatcher(
+        DEVICE_ID,
+        lambda msg, ack=False: messages.append(msg),
+        version,
+        SessionCrypto(key),
+    )
+    dispatcher.set_logger(logging.getLogger(__name__), DEVICE_ID)
+    return dispatcher, messages
+
+
+def create_frames(count, prefix=Affix.prefix_55aa.value, hmac_key=None):
+    return [
+        parser.pack_message(
+            TuyaMessage(seqno, 8, 0, b'{"dps":{"1":%d}}' % seqno, 0, True, prefix),
+            hmac_key=hmac_key,
+        )
+        for seqno in range(1, count + 1)
+    ]
+
+
+def test_dispatcher_coalesced_frames():
+    dispatcher, messages = create_dispatcher()
+    frames = create_frames(3)
+    partial = create_frames(4)[-1]
+
+    dispatcher.add_data(b"".join(frames) + partial[:10])
+    assert [msg.seqno for msg in messages] == [1, 2, 3]
+    assert dispatcher.buffer == partial[:10]
+
+    dispatcher.add_data(partial[10:])
+    assert [msg.seqno for msg in messages] == [1, 2, 3, 4]
+    assert len(dispatcher.buffer) == 0
+
+
+def test_dispatcher_fragmented_frames():
+    dispatcher, messages = create_dispatcher(3.5)
+    stream = b"garbage" + b"".join(create_frames(5, Affix.prefix_6699.value, LOCAL_KEY))
+
+    for i in range(0, len(stream), 7):
+        dispatcher.add_data(stream[i : i + 7])
+
+    assert [msg.seqno for msg in messages] == [1, 2, 3, 4, 5]
+    assert messages[0].payload == b'{"dps":{"1":1}}'
+    assert len(dispatcher.buffer) == 0
+
+
+async def test_debug_logging():
+    protocol = TuyaProtocol(DEVICE_ID, DEVICE_CONFIG["local_key"], 3.5, False, Mock())
+    assert not protocol.debug_enabled and not protocol.dispatcher.debug_enabled
+    protocol.enable_debug(True)
+    assert protocol.debug_enabled and protocol.dispatcher.debug_enabled
+    protocol.enable_debug(False)
+
+    # Nothing is logged on the frames path when the debug is disabled.
+    logger = protocol._logger = protocol.dispatcher._logger = Mock()
+    frames = create_frames(3, Affix.prefix_6699.value, protocol.crypto)
+    protocol.dispatcher.add_data(b"".join(frames))
+    protocol._encode_message(protocol._generate_payload(CMDType.CONTROL, {"1": 1}))
+    protocol._decode_payload(b'{"dps":{"1":1}}')
+    logger.log.assert_not_called()
+
+    protocol.debug("Forced", force=True)
+    logger.log.assert_called_once_with(logging.DEBUG, "Forced")
+
+
+async def test_protocol_session_crypto():
+    listener = Mock(sub_devices={})
+    protocol = TuyaProtocol(DEVICE_ID, DEVICE_CONFIG["local_key"], 3.4, False, listener)
+    assert protocol.crypto is protocol.real_crypto
+    assert protocol.dispatcher.crypto is protocol.crypto
+
+    session_key = b"0123456789abcdef"
+    protocol._set_session_key(session_key)
+    crypto = protocol.crypto
+    assert crypto.key == session_key and protocol.dispatcher.crypto is crypto
+
+    payload = protocol.version_header + b'{"dps":{"1":true}}'
+    retcode = b"\x00" * 4
+    frame = parser.pack_message(
+        TuyaMessage(1, 8, 0, retcode + crypto.cipher.encrypt(payload, False), 0),
+        hmac_key=crypto,
+    )
+    protocol.data_received(frame)
+    listener.status_updated.assert_called_once_with({"1": True})
+
+    protocol.clean_up_session()
+    assert protocol.crypto is protocol.real_crypto
+
+
+async def test_generate_payload_template():
+    protocol = TuyaProtocol(DEVICE_ID, DEVICE_CONFIG["local_key"], 3.4, False, Mock())
+
+    payload = protocol._generate_payload(CMDType.CONTROL, {"1": True}, nodeId="cid")
+    assert payload.cmd == CMDType.CONTROL_NEW
+    assert json.loads(payload.payload)["data"] == {"cid": "cid", "dps": {"1": True}}
+
+    # The cached template must not keep values of previous payloads.
+    payload = protocol._generate_payload(CMDType.CONTROL, {"2": False})
+    assert json.loads(payload.payload)["data"] == {"dps": {"2": False}}
+    assert get_payload_template("v3.4", CMDType.CONTROL).json_data["data"] == {
+        "cid": ""
+    }
+
+
+async def test_dispatcher_timeout_isolation():
+    dispatcher, _ = create_dispatcher()
+    frame = create_frames(2)[-1]
+
+    waiter = asyncio.ensure_future(dispatcher.wait_for(2, CMDType.STATUS))
+    with pytest.raises(TimeoutError):
+        await dispatcher.wait_for(1, CMDType.STATUS, timeout=0.01)
+
+    # The timed out request must not cancel the other waiting requests.
+    dispatcher.add_data(frame)
+    assert (await waiter).seqno == 2
+    assert dispatcher.listeners == {}
+
+
+async def test_dispatcher_special_seqno_waiters():
+    dispatcher, _ = create_dispatcher()
+    seqno = MessageDispatcher.HEARTBEAT_SEQNO
+    retcode = b"\x00" * 4
+    heartbeat = parser.pack_message(TuyaMessage(0, CMDType.HEART_BEAT, 0, retcode, 0))
+
+    waiters = [
+        asyncio.ensure_future(dispatcher.wait_for(seqno, CMDType.HEART_BEAT))
+        for _ in range(2)
+    ]
+    await asyncio.sleep(0)
+    assert len(dispatcher.listeners[seqno]) == 2
+
+    dispatcher.add_data(heartbeat)
+    await asyncio.sleep(0)
+    assert waiters[0].done() and not waiters[1].done()
+
+    dispatcher.add_data(heartbeat)
+    await asyncio.gather(*waiters)
+    assert dispatcher.listeners == {}
+
+
+def test_write_pacer():
+    pacer = WritePacer(interval=0.05, burst=3)
+
+    assert [pacer.reserve() for _ in range(3)] == [0, 0, 0]
+    assert 0.09 < pacer.reserve() + pacer.reserve() <= 0.15
+
+    pacer.acknowledged(0.02)
+    assert pacer.interval < 0.05
+
+    interval = pacer.interval
+    pacer.backoff()
+    assert pacer.interval == interval * 2
+    assert pacer.reserve() > 0
+
+
+async def test_heartbeat_wheel():
+    wheel = HeartbeatWheel(asyncio.events.get_running_loop(), interval=0.2, slots=8)
+    fired = []
+    timers = [HeartbeatTimer(lambda i=i: fired.append(i)) for i in range(3)]
+
+    wheel.schedule(timers[0], 0.05)
+    wheel.schedule(timers[1], 0.15)
+    wheel.schedule(timers[2], 0.15)
+    wheel.cancel(timers[2])
+    assert len(wheel) == 2
+
+    await asyncio.sleep(0.35)
+    assert fired == [0, 1]
+    assert len(wheel) == 0 and wheel._handle is None
+
+
+async def test_heartbeat_skipped_on_traffic():
+    protocol = TuyaProtocol(DEVICE_ID, DEVICE_CONFIG["local_key"], 3.3, False, Mock())
+    protocol.heartbeat = protocol._heartbeat_action = AsyncMock()
+    protocol.keep_alive()
+    timer = protocol._heartbeat_timer
+    assert timer.scheduled
+
+    # A device that just sent a frame and received a command doesn't need a heartbeat.
+    protocol.dispatcher.last_frame_time = protocol._last_command_sent = time.monotonic()
+    protocol._heartbeat_due()
+    assert protocol._heartbeat_task is None and timer.scheduled
+    protocol.heartbeat.assert_not_called()
+
+    protocol.dispatcher.last_frame_time = 0
+    protocol._heartbeat_due()
+    await protocol._heartbeat_task
+    protocol.heartbeat.assert_awaited_once()
+    assert timer.scheduled
+
+    protocol.clean_up_session()
+    assert protocol._heartbeat_timer is None and not timer.scheduled
+
+
+async def test_protocol_quirks():
+    listener = Mock(sub_devices={})
+    quirks = {}
+    protocol = TuyaProtocol(
+        DEVICE_ID, DEVICE_CONFIG["local_key"], 3.3, False, listener, quirks=quirks
+    )
+    assert protocol.dev_type == "type_0a"
+
+    payload = protocol.crypto.cipher.encrypt(b"data unvalid", False)  # codespell:ignore
+    assert protocol._decode_payload(protocol.version_header + payload) is None
+    assert protocol.dev_type == "type_0d" and quirks == {"dev_type": "type_0d"}
+    listener.quirks_updated.assert_called_once_with(quirks)
+
+    # Next connections start with the learned dev_type and keep it on reset.
+    protocol = TuyaProtocol(
+        DEVICE_ID, DEVICE_CONFIG["local_key"], 3.3, False, listener, quirks=quirks
+    )
+    assert protocol.dev_type == "type_0d"
+
+    quirks["no_updatedps_reply"] = True
+    protocol.transport = Mock(is_closing=Mock(return_value=False))
+    assert await protocol.reset([18]) is True
+    assert protocol.dev_type == "type_0d"
+    protocol.transport.write.assert_called_once()
+
+    # The quirk is only sent through a connected transport.
+    protocol.transport.is_closing.return_value = True
+    assert await protocol.reset([18]) is None
+    protocol.transport.write.assert_called_once()
+
+
+async def test_protocol_no_updatedps_reply_quirk():
+    listener = Mock(sub_devices={})
+    quirks = {}
+    protocol = TuyaProtocol(
+        DEVICE_ID, DEVICE_CONFIG["local_key"], 3.3, False, listener, quirks=quirks
+    )
+    protocol.transport = Mock(is_closing=Mock(return_value=False))
+    protocol.dispatcher.wait_for = AsyncMock(side_effect=TimeoutError)
+
+    # A single timeout, even across reconnects, does not make the quirk.
+    for timeouts in range(1, NO_UPDATEDPS_REPLY_TIMEOUTS):
+        with pytest.raises(TimeoutError):
+            await protocol.reset([18])
+        assert quirks == {"updatedps_timeouts": timeouts}
+    protocol.dispatcher.wait_for = AsyncMock(return_value=None)
+    await protocol.reset([18])
+    assert quirks == {}
+
+    protocol.dispatcher.wait_for = AsyncMock(side_effect=TimeoutError)
+    for _ in range(NO_UPDATEDPS_REPLY_TIMEOUTS):
+        with pytest.raises(TimeoutError):
+            await protocol.reset([18])
+    assert quirks["no_updatedps_reply"] is True
+    listener.quirks_updated.assert_called_once_with(quirks)
+
+    # The quirk is forgotten once the device answers UPDATEDPS.
+    protocol.dispatcher._dispatch(TuyaMessage(0, CMDType.UPDATEDPS, 0, b"", 0))
+    assert quirks == {"no_updatedps_reply": False}
+
+
+async def test_protocol_confirm_dps():
+    protocol = TuyaProtocol(DEVICE_ID, DEVICE_CONFIG["local_key"], 3.3, False, Mock())
+    protocol.status = AsyncMock(return_value={"1": True, "2": 0, "3": "on"})
+
+    assert await protocol.confirm_dps(["1", "3"], "type_0d") == {
+        "1": True,
+        "2": 0,
+        "3": "on",
+    }
+    assert protocol.dev_type == "type_0d"
+    assert list(protocol.dps_to_request) == ["1", "3"]
+    protocol.status.assert_awaited_once()
+
+    assert await protocol.confirm_dps(["1", "4"]) == {}
+
+
+async def test_io_thread():
+    crypto = SessionCrypto(LOCAL_KEY)
+    header = TuyaProtocol(
+        DEVICE_ID, DEVICE_CONFIG["local_key"], 3.4, False, Mock()
+    ).version_header
+    payload = crypto.cipher.encrypt(header + b'{"dps":{"1":true}}', False)
+    frame = parser.pack_message(
+        TuyaMessage(1, 8, 0, b"\x00" * 4 + payload, 0), hmac_key=crypto
+    )
+
+    async def handle_client(reader, writer):
+        writer.write(frame)
+        await reader.read()
+        writer.close()
+
+    server = await asyncio.start_server(handle_client, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    io_thread = TuyaIOThread()
+    io_thread.start()
+
+    updated = asyncio.Event()
+    threads = []
+    listener = Mock(sub_devices={})
+    listener.status_updated.side_effect = lambda _: [
+        threads.append(threading.get_ident()),
+        updated.set(),
+    ]
+    try:
+        protocol = await io_thread.connect(
+            "127.0.0.1",
+            DEVICE_ID,
+            DEVICE_CONFIG["local_key"],
+            3.4,
+            False,
+            listener,
+            port=port,
+        )
+        assert protocol.is_connected
+        assert protocol.protocol.loop is io_thread.loop
+
+        # Statuses are received on the thread and delivered on the caller loop.
+        await asyncio.wait_for(updated.wait(), 1)
+        listener.status_updated.assert_called_once_with({"1": True})
+        assert threads == [threading.get_ident()]
+        assert protocol.dispatched_dps == {"1": True}
+
+        await protocol.close()
+        assert not protocol.is_connected
+    finally:
+        io_thread.stop()
+        server.close()
+
+
+async def test_io_thread_listener():
+    io_thread = TuyaIOThread()
+    io_thread.start()
+    sub_device = Mock()
+    gateway = Mock(sub_devices={"node": sub_device})
+    quirks = {"other": True}
+    protocol = ThreadedProtocol(io_thread, gateway, quirks)
+    protocol.protocol = Mock(dispatched_dps={})
+    listener = protocol.listener
+    thread_quirks = {"other": True, QUIRK_DEV_TYPE: "type_0d"}
+
+    async def call(func):
+        return func()
+
+    def on_thread(func):
+        return io_thread.run(call(func))
+
+    def dispatch():
+        listener.sub_devices["node"].status_updated({"1": True})
+        listener.quirks_updated(thread_quirks)
+        thread_quirks["timeouts"] = 1
+
+    try:
+        # The thread reads the sub-devices snapshot and posts copies of its dicts.
+        await on_thread(dispatch)
+        await asyncio.sleep(0.05)
+        sub_device.status_updated.assert_called_once_with({"1": True})
+        gateway.quirks_updated.assert_called_once_with(quirks)
+        assert quirks == {"other": True, QUIRK_DEV_TYPE: "type_0d"}
+        assert protocol.dev_type == "type_0d"
+
+        # The snapshot is refreshed on the caller loop, removed sub-devices are skipped.
+        gateway.sub_devices = {"new": Mock()}
+        sub_listener = listener.sub_devices["node"]
+        assert await on_thread(lambda: list(listener.sub_devices)) == ["node"]
+        await on_thread(lambda: sub_listener.status_updated({"1": False}))
+        protocol.keep_alive(True)
+        assert await on_thread(lambda: list(listener.sub_devices)) == ["new"]
+        await asyncio.sleep(0.05)
+        sub_device.status_updated.assert_called_once()
+    finally:
+        io_thread.stop()
+
+
+async def test_shard_pool():
+    crypto = SessionCrypto(LOCAL_KEY)
+    header = TuyaProtocol(
+        DEVICE_ID, DEVICE_CONFIG["local_key"], 3.4, False, Mock()
+    ).version_header
+    frames = [
+        parser.pack_message(
+            TuyaMessage(
+                seqno,
+                8,
+                0,
+                b"\x00" * 4 + crypto.cipher.encrypt(header + payload, False),
+                0,
+            ),
+            hmac_key=crypto,
+        )
+        for seqno, payload in enumerate(
+            [b'{"dps":{"1":true,"2":5}}', b'{"dps":{"2":6}}'], start=1
+        )
+    ]
+
+    async def handle_client(reader, writer):
+        for frame in frames:
+            writer.write(frame)
+            await asyncio.sleep(0.05)
+        await reader.read()
+        writer.close()
+
+    server = await asyncio.start_server(handle_client, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    pool = TuyaShardPool(1)
+    pool.start()
+    shard = pool.get_shard(DEVICE_ID)
+
+    statuses = []
+    updated = asyncio.Event()
+    listener = Mock(sub_devices={})
+    listener.status_updated.side_effect = lambda status: [
+        statuses.append(dict(status)),
+        len(statuses) == 2 and updated.set(),
+    ]
+    try:
+        protocol = await pool.connect(
+            "127.0.0.1",
+            DEVICE_ID,
+            DEVICE_CONFIG["local_key"],
+            3.4,
+            False,
+            listener,
+            port=port,
+        )
+        assert protocol.is_connected and shard.protocols
+
+        # The shard sends deltas, the listener gets the whole status.
+        await asyncio.wait_for(updated.wait(), 5)
+        assert statuses == [{"1": True, "2": 5}, {"1": True, "2": 6}]
+        assert protocol.dispatched_dps == {"2": 6}
+
+        # The shard records the trace, it is dumped by device id.
+        _, records = read_trace(await pool.dump_trace(DEVICE_ID, 3.4))
+        assert TRACE_IN in {r.direction for r in records}
+
+        # A dead shard is restarted and its devices are disconnected.
+        process = shard.process
+        process.kill()
+        for _ in range(50):
+            if shard.restarts:
+                break
+            await asyncio.sleep(0.1)
+        listener.disconnected.assert_called_once()
+        assert not protocol.is_connected and not shard.protocols
+        assert shard.restarts == 1 and shard.process is not process
+        assert shard.process.poll() is None
+    finally:
+        pool.stop()
+        server.close()
+
+
+async def test_shard_worker_pacer(monkeypatch):
+    connect = AsyncMock(return_value=Mock(dev_type="type_0a"))
+    monkeypatch.setattr(
+        "custom_components.localtuya.core.pytuya.shard.connect", connect
+    )
+    worker = _ShardWorker(Mock())
+    args = ("127.0.0.1", DEVICE_ID, DEVICE_CONFIG["local_key"], 3.4, False)
+
+    # The pacer is built from the settings of the main process pacer.
+    await worker._connect(1, args, {"pacer": (0.2, 2)})
+    pacer = connect.call_args.kwargs["pacer"]
+    assert (pacer.interval, pacer.burst) == (0.2, 2)
+
+    # It is kept across reconnects, with its learned interval.
+    pacer.backoff()
+    await worker._connect(2, args, {"pacer": (0.2, 2)})
+    assert connect.call_args.kwargs["pacer"] is pacer and pacer.interval == 0.4
+
+
+def test_shard_errors():
+    # The package has another name in the shards, its exceptions are sent by name.
+    error = _dump_error(DecodeError("bad frame"))
+    assert error == (".parser", "DecodeError", ("bad frame",))
+    assert isinstance(_load_error(error), DecodeError)
+
+    error = OSError(113, "No route to host")
+    assert _load_error(_dump_error(error)) is error
+
+
+@pytest.mark.parametrize("version", [3.4, 3.5])
+async def test_frame_trace(capsys, version):
+    sim = SimulatedDevice(DEVICE_ID, DEVICE_CONFIG["local_key"], version, {"1": True})
+    await sim.start(port=0)
+    trace = FrameTrace()
+    try:
+        protocol = await connect(
+            sim.host,
+            DEVICE_ID,
+            DEVICE_CONFIG["local_key"],
+            version,
+            False,
+            Mock(sub_devices={}),
+            sim.port,
+            trace=trace,
+        )
+        await protocol.status()
+        await protocol.set_dps({"1": False})
+        await asyncio.sleep(0.05)
+        await protocol.close()
+    finally:
+        await sim.stop()
+
+    data = await protocol.dump_trace()
+    meta, records = read_trace(data)
+    assert meta["device_id"] == DEVICE_ID and meta["version"] == version
+    frames = replay(data, LOCAL_KEY)
+    received = [f.msg.cmd for f in frames if f.direction == TRACE_IN]
+    sent = [f.msg.cmd for f in frames if f.direction == TRACE_OUT]
+    assert sent == [3, 5, 16, 13] and received == [4, 16, 13, 8]
+    assert all(f.msg.crc_good for f in frames)
+    # The session key is derived from the negotiation, no key is in the trace.
+    (session_key,) = {f.key for f in frames if f.key}
+    assert LOCAL_KEY not in data and session_key not in data
+    assert not any(f.key for f in replay(data))
+
+    await print_trace(data, DEVICE_CONFIG["local_key"])
+    assert "{'1': False}" in capsys.readouterr().out
+
+    # The trace keeps the last two segments.
+    trace = FrameTrace(segment_size=100)
+    for index in range(9):
+        trace.record(TRACE_IN, bytes([index]) * 40)
+    _, records = read_trace(trace.dump(DEVICE_ID, 3.3))
+    assert [r.data[0] for r in records] == [6, 7, 8]
+    assert trace.size < 200
@@ -0,0 +1,128 @@
+"""Test for localtuya."""
+
+import json
+import socket
+
+from . import *
+from .load_test import run_load_test
+from .simulator import SimulatedDevice
+from custom_components.localtuya.core.pytuya import QUIRK_DEV_TYPE, connect
+from custom_components.localtuya.core.pytuya.const import SubdeviceState
+from custom_components.localtuya.discovery import TuyaDiscovery, decrypt_udp
+
+DEVICE_ID = DEVICE_CONFIG["device_id"]
+LOCAL_KEY = DEVICE_CONFIG["local_key"]
+
+
+class UDPReceiver(asyncio.DatagramProtocol):
+    def __init__(self, received: asyncio.Future):
+        self.received = received
+
+    def datagram_received(self, data, addr):
+        if not self.received.done():
+            self.received.set_result(data)
+
+
+async def connect_simulator(sim: SimulatedDevice, listener=None, **kwargs):
+    listener = listener or Mock(sub_devices={})
+    return await connect(
+        sim.host, sim.id, LOCAL_KEY, sim.version, False, listener, sim.port, **kwargs
+    )
+
+
+@pytest.mark.parametrize("version", [3.1, 3.2, 3.3, 3.4, 3.5])
+async def test_simulator_protocols(version):
+    sim = await SimulatedDevice(DEVICE_ID, LOCAL_KEY, version, {"1": True}).start(
+        port=0
+    )
+    updated = asyncio.Event()
+    listener = Mock(sub_devices={})
+    listener.status_updated.side_effect = lambda _: updated.set()
+    try:
+        protocol = await connect_simulator(sim, listener)
+        assert await protocol.status() == {"1": True}
+
+        await protocol.set_dps({"1": False})
+        await asyncio.wait_for(updated.wait(), 1)
+        listener.status_updated.assert_called_with({"1": False})
+        assert sim.dps == {"1": False}
+
+        # Changes made on the device are reported too.
+        updated.clear()
+        sim.set_dps({"2": 10})
+        await asyncio.wait_for(updated.wait(), 1)
+        listener.status_updated.assert_called_with({"1": False, "2": 10})
+        assert await protocol.heartbeat() is None
+        await protocol.close()
+    finally:
+        await sim.stop()
+
+
+async def test_simulator_type_0d():
+    sim = SimulatedDevice(DEVICE_ID, LOCAL_KEY, 3.3, {"1": True}, dev_type="type_0d")
+    await sim.start(port=0)
+    try:
+        protocol = await connect_simulator(sim)
+        assert await protocol.status() == {"1": True}
+        assert protocol.quirks == {QUIRK_DEV_TYPE: "type_0d"}
+        assert [cmd for cmd, _ in sim.requests] == [10, 13]
+        await protocol.close()
+    finally:
+        await sim.stop()
+
+
+async def test_simulator_gateway():
+    sub_devices = {"cid1": {"1": True}, "cid2": {"1": False}}
+    sim = SimulatedDevice(DEVICE_ID, LOCAL_KEY, 3.4, {}, sub_devices=sub_devices)
+    await sim.start(port=0)
+    sub_listener = Mock(sub_devices={})
+    listener = Mock(sub_devices={"cid1": sub_listener, "cid2": Mock()})
+    try:
+        protocol = await connect_simulator(sim, listener)
+        assert await protocol.status(cid="cid2") == {"1": False}
+
+        updated = asyncio.Event()
+        sub_listener.status_updated.side_effect = lambda _: updated.set()
+        await protocol.set_dps({"1": False}, cid="cid1")
+        await asyncio.wait_for(updated.wait(), 1)
+        sub_listener.status_updated.assert_called_with({"1": False})
+
+        sim.set_sub_device_online("cid2", False)
+        await protocol.subdevices_query()
+        await asyncio.sleep(0)
+        sub_listener.subdevice_state_updated.assert_called_with(SubdeviceState.ONLINE)
+        offline = listener.sub_devices["cid2"].subdevice_state_updated
+        offline.assert_called_with(SubdeviceState.OFFLINE)
+        await protocol.close()
+    finally:
+        await sim.stop()
+
+
+async def test_simulator_discovery():
+    found = Mock()
+    discovery = TuyaDiscovery(found)
+    for index, version in enumerate([3.1, 3.3, 3.4, 3.5]):
+        sim = SimulatedDevice(f"bfsim{index}", LOCAL_KEY, version)
+        discovery.datagram_received(sim.discovery_message(), ("127.0.0.1", 6667))
+        found.assert_called_with(discovery.devices[sim.id])
+        assert discovery.devices[sim.id]["version"] == str(version)
+
+    # The broadcasts are sent on UDP.
+    loop = asyncio.get_running_loop()
+    received = loop.create_future()
+    transport, _ = await loop.create_datagram_endpoint(
+        lambda: UDPReceiver(received), ("127.0.0.1", 0), family=socket.AF_INET
+    )
+    try:
+        await sim.broadcast("127.0.0.1", transport.get_extra_info("sockname")[1])
+        data = await asyncio.wait_for(received, 1)
+        assert json.loads(decrypt_udp(data))["gwId"] == sim.id
+    finally:
+        transport.close()
+
+
+async def test_load_harness():
+    report = await run_load_test(devices=20, version=3.4, commands=2)
+    assert report["connected"] == 20
+    assert report["commands"] == 40 and report["commands_failed"] == 0
+    assert report["command_latency_ms"]["max"] is not None